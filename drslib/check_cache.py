@@ -0,0 +1,154 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Persistent cache of PublisherTree checker verdicts.
+
+Running the checkers of :mod:`drslib.drs_tree_check` tests every link
+of the latest version.  For datasets that have not changed since they
+last passed this work is wasted.  The names of the checkers that passed
+are therefore recorded in a file in the publication directory together
+with a fingerprint of the directories the checks read.  While the
+fingerprint is unchanged those checkers are skipped.
+
+The fingerprint is built from directory metadata only: the names of the
+entries of the publication directory, the target of the ``latest`` link
+and the modification time and entry count of every directory below the
+files directory and the checked version directories.  Creating,
+removing or replacing a link or file changes the modification time of
+its directory so any change made through drslib, or by hand, is
+detected without reading a single link.
+
+Only passes are cached.  Failures are always checked again so that the
+checker instances needed for repair are available.
+
+The cache is off unless enabled with
+:meth:`drslib.drs_tree.DRSTree.set_check_cache` or the ``--check-cache``
+option of ``drs_tool`` since it writes to every publication directory
+checked.
+
+"""
+
+import os
+import os.path as op
+import json
+
+from drslib.drs import DRSFileSystem
+
+import logging
+log = logging.getLogger(__name__)
+
+CHECK_CACHE_FILE = '.drslib_checks'
+
+
+class CheckCache(object):
+    """
+    The cached checker verdicts of a single publication-level dataset.
+
+    :ivar path: Path of the cache file.
+
+    """
+
+    def __init__(self, pub_dir, listings=None):
+        """
+        :param listings: A :class:`drslib.listing.ListingCache` through
+            which the publication directory is listed.
+
+        """
+        self.pub_dir = pub_dir
+        self.path = op.join(pub_dir, CHECK_CACHE_FILE)
+        self._listings = listings
+
+    def fingerprint(self, all_versions=False):
+        """
+        Compute the fingerprint of the publication directory.
+
+        :param all_versions: If True include every version directory,
+            otherwise only the latest.
+
+        """
+        if self._listings is None:
+            names = os.listdir(self.pub_dir)
+        else:
+            names = self._listings.listdir(self.pub_dir)
+        entries = sorted(x for x in names if x[0] != '.')
+
+        latest = op.join(self.pub_dir, DRSFileSystem.VERSIONING_LATEST_DIR)
+        if op.islink(latest):
+            latest_target = os.readlink(latest)
+        else:
+            latest_target = None
+
+        versions = sorted(int(x[1:]) for x in entries if x[0] == 'v')
+        if not all_versions:
+            versions = versions[-1:]
+
+        dirs = []
+        for top in [DRSFileSystem.VERSIONING_FILES_DIR] + ['v%d' % v for v in versions]:
+            for dirpath, dirnames, filenames in os.walk(op.join(self.pub_dir, top)):
+                dirnames.sort()
+                dirs.append([op.relpath(dirpath, self.pub_dir),
+                             os.stat(dirpath).st_mtime,
+                             len(dirnames) + len(filenames)])
+
+        return {'entries': entries, 'latest': latest_target, 'dirs': dirs}
+
+    def passed(self, fingerprint):
+        """
+        :return: The set of names of checkers that passed when the
+            publication directory last had this fingerprint.
+
+        """
+        if not op.exists(self.path):
+            return set()
+
+        try:
+            rec = json.load(open(self.path))
+        except ValueError:
+            log.warning('Ignoring corrupt check cache %s' % self.path)
+            return set()
+
+        # Normalise tuples and byte strings as json would
+        if rec.get('fingerprint') != json.loads(json.dumps(fingerprint)):
+            return set()
+
+        return set(str(x) for x in rec.get('passed', []))
+
+    def save(self, fingerprint, passed):
+        """
+        Record the names of the checkers that passed with `fingerprint`.
+
+        The file is replaced atomically so that a concurrent reader never
+        sees a partial record.  The cache is only an optimisation so
+        failing to write it, for instance in a read-only archive, is
+        logged and otherwise ignored.
+
+        :return: True if the cache was written.
+
+        """
+        tmp_path = '%s.%d' % (self.path, os.getpid())
+        try:
+            fh = open(tmp_path, 'w')
+            try:
+                json.dump({'fingerprint': fingerprint, 'passed': sorted(passed)}, fh)
+            finally:
+                fh.close()
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError), e:
+            log.warning('Cannot save check cache %s: %s' % (self.path, e))
+            if op.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return False
+
+        return True
+
+    def remove(self):
+        if op.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,189 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Persistent store of file checksums.
+
+Checksums calculated while a file is copied into the DRS structure are
+recorded so that mapfile generation does not need to read the file
+again.  See :func:`drslib.mapfile.copy_with_checksum`.
+
+The store is a file in the publication directory holding one JSON
+record per line, in the manner of :mod:`drslib.journal`.  Records are
+keyed by file identity: the inode number, size and modification time of
+the file.  A file that is replaced or modified therefore never matches
+a stale record.  Later records replace earlier ones and a truncated
+final line is ignored.  Once superseded records outnumber the others
+the store is rewritten without them.
+
+"""
+
+import os
+import json
+
+import logging
+log = logging.getLogger(__name__)
+
+CHECKSUM_FILE = '.drslib_checksums'
+
+
+class ChecksumStore(object):
+    """
+    The checksum store of a single publication-level dataset.
+
+    :ivar path: Path of the store file.
+
+    """
+
+    def __init__(self, pub_dir):
+        self.path = os.path.join(pub_dir, CHECKSUM_FILE)
+        self._records = None
+        # Identity of the latest record of each path
+        self._paths = {}
+        # Number of lines in the store file
+        self._lines = 0
+
+    def get(self, path, checksum_type=None):
+        """
+        :param checksum_type: If not None only a checksum of this type,
+            ignoring case, is returned.
+        :return: (checksum_type, checksum) recorded for the file at
+            `path` or None.
+
+        """
+        rec = self._load().get(_identity(os.stat(path)))
+        if rec is None:
+            return None
+        if checksum_type is not None and rec['checksum_type'].upper() != checksum_type.upper():
+            return None
+        return str(rec['checksum_type']), str(rec['checksum'])
+
+    def lookup(self, path):
+        """
+        Return the latest record for `path` without checking that the
+        file is unchanged since it was recorded.
+
+        :return: (size, checksum_type, checksum) or None.
+
+        """
+        records = self._load()
+        rec = records.get(self._paths.get(path))
+        if rec is None:
+            return None
+        return rec['size'], str(rec['checksum_type']), str(rec['checksum'])
+
+    def add(self, path, checksum_type, checksum):
+        """
+        Record the checksum of the file at `path`.
+
+        The store is only an optimisation so failing to write it, for
+        instance in a read-only archive, is logged and otherwise ignored.
+
+        :return: True if the checksum was recorded.
+
+        """
+        try:
+            st = os.stat(path)
+            rec = {'path': path, 'ino': st.st_ino, 'size': st.st_size,
+                   'mtime': st.st_mtime, 'checksum_type': checksum_type,
+                   'checksum': checksum}
+
+            records = self._load()
+            fh = open(self.path, 'a')
+            try:
+                fh.write(json.dumps(rec) + '\n')
+            finally:
+                fh.close()
+        except (IOError, OSError), e:
+            log.warning('Cannot record checksum of %s in %s: %s' % (path, self.path, e))
+            return False
+
+        self._lines += 1
+        self._add_record(records, rec)
+        if self._lines > 2 * len(records):
+            self.compact()
+
+        return True
+
+    def compact(self):
+        """
+        Rewrite the store keeping only the latest record of each file
+        that still exists with the recorded identity.  The file is
+        replaced atomically.
+
+        :return: True if the store was rewritten.
+
+        """
+        records = {}
+        for key, rec in self._load().items():
+            try:
+                if _identity(os.stat(rec['path'])) == key:
+                    records[key] = rec
+            except OSError:
+                pass
+
+        tmp_path = '%s.%d' % (self.path, os.getpid())
+        try:
+            fh = open(tmp_path, 'w')
+            try:
+                for key in sorted(records):
+                    fh.write(json.dumps(records[key]) + '\n')
+            finally:
+                fh.close()
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError), e:
+            log.warning('Cannot compact checksum store %s: %s' % (self.path, e))
+            if os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return False
+
+        self._records = records
+        self._paths = dict((rec['path'], key) for key, rec in records.items())
+        self._lines = len(records)
+        return True
+
+    def _add_record(self, records, rec):
+        # A later record of the same path supersedes the earlier identity
+        key = (rec['ino'], rec['size'], rec['mtime'])
+        old_key = self._paths.get(rec['path'])
+        if old_key != key and rec['path'] == records.get(old_key, {}).get('path'):
+            del records[old_key]
+        records[key] = rec
+        self._paths[rec['path']] = key
+
+    def _load(self):
+        if self._records is not None:
+            return self._records
+
+        self._records = {}
+        self._paths = {}
+        self._lines = 0
+        if not os.path.exists(self.path):
+            return self._records
+
+        fh = open(self.path)
+        try:
+            for line in fh:
+                self._lines += 1
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    log.warning('Ignoring corrupt checksum record in %s: %s' %
+                                (self.path, repr(line)))
+                    continue
+                self._add_record(self._records, rec)
+        finally:
+            fh.close()
+
+        return self._records
+
+
+def _identity(st):
+    return (st.st_ino, st.st_size, st.st_mtime)
@@ -356,6 +356,11 @@ def make_translator(prefix, with_version=True, table_store=None):
 class CMIP5FileSystem(DRSFileSystem):
     drs_cls = CmipDRS
 
+    # var_table_model_experiment_ensemble[_subset][_extended].nc, with an
+    # extra leading component for gridspec files
+    FILENAME_SIGNATURE = (r'[^_]+_[^_]+_[^_]+_[^_]+_(?:[^_]+_)?'
+                          r'r\d+(?:i\d+)?(?:p\d+)?(?:_[^_]+){0,2}\.nc')
+
     def __init__(self, drs_root, table_store=None):
         super(CMIP5FileSystem, self).__init__(drs_root)
 
@@ -364,6 +369,28 @@ class CMIP5FileSystem(DRSFileSystem):
     def filename_to_drs(self, filename):
         return self._vtrans.filename_to_drs(filename)
 
+    def discovery_vocabularies(self):
+        """
+        Vocabularies of experiments, frequencies and realms are taken
+        from the translator and tables from the MIP tables.  Institutes
+        and models are not included as the translator accepts values
+        outside its lists.  Empty vocabularies, e.g. when no MIP tables
+        are available, are not included.
+
+        """
+        vocabs = {}
+        for handler in self._vtrans.handlers:
+            component = getattr(handler, 'component', None)
+            if component in ['experiment', 'frequency', 'realm']:
+                if handler.vocab:
+                    vocabs[component] = set(handler.vocab)
+
+        tables = self._vtrans.table_store.tables
+        if tables:
+            vocabs['table'] = set(tables)
+
+        return dict((k, v) for (k, v) in vocabs.items() if k in self._pub_attrs)
+
     def filepath_to_drs(self, filepath):
         return self._vtrans.filepath_to_drs(filepath)
 
@@ -141,6 +141,7 @@ try:
 except:
     import mapfile
     checksum_func = mapfile.calc_md5
+    checksum_type = 'MD5'
 else:
     #!TODO: Move this into metaconfig
     package_name, callable_name = checksum_func_str.split(':')
@@ -151,6 +152,13 @@ else:
     if not callable(checksum_func):
         raise ValueError("checksum_func %s:%s is not callable" % (package_name, callable_name))
 
+    # The type of checksum returned by checksum_func.  If not set it is
+    # taken from the first checksum calculated for each mapfile.
+    try:
+        checksum_type = config.get('hooks', 'checksum_type')
+    except:
+        checksum_type = None
+
 
 ##############################################################################
 # DRS Schemes
@@ -6,9 +6,11 @@ Implement CORDEX specific DRS scheme.
 import re
 import os
 
-from drslib.drs import BaseDRS, DRSFileSystem, _ensemble_to_rip, _rip_to_ensemble
+from drslib.drs import (BaseDRS, DRSFileSystem, _ensemble_to_rip, _rip_to_ensemble,
+                        _memoize_decoder)
 from drslib import config
 from drslib.exceptions import TranslationError
+from drslib.translate import _to_date, _from_date
 
 
 
@@ -28,8 +30,6 @@ class CordexDRS(BaseDRS):
 
     @classmethod
     def _encode_component(klass, component, value):
-        from drslib.translate import _from_date
-
         if value is None:
             return '%'
         elif component == 'ensemble':
@@ -49,8 +49,6 @@ class CordexDRS(BaseDRS):
 
     @classmethod
     def _decode_component(cls, component, value):
-        from drslib.translate import _to_date
-        
         if value == '%':
             ret = None
         elif component == 'ensemble':
@@ -83,35 +81,59 @@ class CordexDRS(BaseDRS):
         return ret
 
 
+# VariableName_Domain_GCMModelName_CMIP5ExperimentName_CMIP5EnsembleMember_RCMModelName_RCMVersionID_Frequency_StartTime-EndTime.nc 
+# Components are separated by "_" so each is matched without backtracking.
+_filename_re = re.compile(r'(?P<variable>[^_]*)_(?P<domain>[^_]*)_(?P<gcm_model>[^_]*)_'
+                          r'(?P<experiment>[^_]*)_(?P<ensemble>[^_]*)_'
+                          r'(?P<institute>[^_-]*)-(?P<rcm_model>[^_]*)_(?P<rcm_version>[^_]*)_'
+                          r'(?P<frequency>[^_]*)(?:_(?P<subset>.*?))?\.nc$')
+
+
 class CordexFileSystem(DRSFileSystem):
     drs_cls = CordexDRS
 
+    # The ensemble is followed by institute-rcm_model, rcm_version and frequency
+    FILENAME_SIGNATURE = (r'[^_]+_[^_]+_[^_]+_[^_]+_r\d+i\d+p\d+_'
+                          r'[^_-]+-[^_]+_[^_]+_[^_]+(?:_[^_]+)?\.nc')
+
     def filename_to_drs(self, filename):
         """
         Return a DRS instance deduced from a filename.
 
         """
-        
+        return self._filename_to_drs(filename, self.drs_cls._decode_component)
+
+    def filenames_to_drs(self, filenames):
+        decode = _memoize_decoder(self.drs_cls)
+        for filename in filenames:
+            try:
+                yield filename, self._filename_to_drs(filename, decode)
+            except TranslationError:
+                yield filename, None
+
+    def _filename_to_drs(self, filename, decode):
         if self._is_ignored(filename):
             raise TranslationError()
 
-        # VariableName_Domain_GCMModelName_CMIP5ExperimentName_CMIP5EnsembleMember_RCMModelName_RCMVersionID_Frequency_StartTime-EndTime.nc 
-        m = re.match(r'(?P<variable>.*?)_(?P<domain>.*?)_(?P<gcm_model>.*?)_(?P<experiment>.*?)_(?P<ensemble>.*?)_(?P<institute>.*?)-(?P<rcm_model>.*?)_(?P<rcm_version>.*?)_(?P<frequency>.*?)(?:_(?P<subset>.*?))?\.nc', filename)
+        m = _filename_re.match(filename)
         if not m:
             raise TranslationError()
 
-        comp_dict = m.groupdict()
+        (variable, domain, gcm_model, experiment, ensemble, institute, 
+         rcm_model, rcm_version, frequency, subset) = m.groups()
 
         drs = self.drs_cls(activity='cordex')
-        for component in ['variable', 'domain', 'gcm_model', 'experiment',
-                          'ensemble', 'institute', 'rcm_model', 'rcm_version', 'frequency', 
-                          'subset']:
-            comp_val = comp_dict[component]
-            
-            if component == 'rcm_model' and comp_val is not None:
-                drs[component] = "%s-%s" % (comp_dict['institute'], comp_dict['rcm_model'])
-            elif comp_val is not None:
-                drs[component] = drs._decode_component(component, comp_val)
+        drs['variable'] = decode('variable', variable)
+        drs['domain'] = decode('domain', domain)
+        drs['gcm_model'] = decode('gcm_model', gcm_model)
+        drs['experiment'] = decode('experiment', experiment)
+        drs['ensemble'] = decode('ensemble', ensemble)
+        drs['institute'] = decode('institute', institute)
+        drs['rcm_model'] = "%s-%s" % (institute, rcm_model)
+        drs['rcm_version'] = decode('rcm_version', rcm_version)
+        drs['frequency'] = decode('frequency', frequency)
+        if subset is not None:
+            drs['subset'] = decode('subset', subset)
 
         return drs
 
@@ -0,0 +1,261 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Temporal coverage, gap and overlap analysis of DRS files.
+
+The temporal subset of every file is converted to a pair of integer time
+keys: the start of the first period and the exclusive end of the last
+period, in seconds.  Files are then grouped by dataset, variable and
+version and sorted by start key so that gaps and overlaps between
+consecutive files are found with array operations rather than by
+comparing pairs of subset tuples with
+:func:`drslib.translate.drs_dates_overlap`.
+
+The exclusive end of a subset depends on the precision of its end date.
+``199012`` ends at the start of January 1991 and ``19901231`` at the
+start of 1st January 1991.  For sub-daily frequencies the end date is
+the last time point so the end is extended by the time step.
+
+Time keys use the proleptic Gregorian calendar.  So that datasets on
+360-day and no-leap calendars are not reported as having gaps at the
+end of each month, a file ending on or after the 28th of February or
+the 30th of any other month is treated as extending to the end of the
+month.  As a result a missing 31st day is never reported as a gap.
+
+Climatology files and files without a temporal subset are ignored.
+This module requires NumPy, which is installed with the
+``drslib[coverage]`` extra.
+
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError('drslib.coverage requires NumPy.  '
+                      'Install it with "pip install drslib[coverage]"')
+
+import logging
+log = logging.getLogger(__name__)
+
+SECONDS_PER_DAY = 86400
+
+# Time steps of sub-daily frequencies in seconds
+FREQUENCY_STEPS = {
+    '1hr': 3600,
+    '3hr': 3 * 3600,
+    '6hr': 6 * 3600,
+    }
+
+# Seconds in one unit of the least significant field of a date with
+# 4, 5 or 6 fields
+_PRECISION_UNITS = np.array([0, 0, 0, 0, 3600, 60, 1], dtype=np.int64)
+
+
+def analyse_coverage(drspaths):
+    """
+    Analyse the temporal coverage of files grouped by dataset, variable
+    and version.
+
+    :param drspaths: An iterable of (filepath, drs) tuples.
+    :return: A list of coverage records sorted by dataset_id, variable
+        and version.  Each record is a dictionary with the keys
+
+        dataset_id, variable, version
+          Identify the group of files.  version is None for unversioned
+          files.
+        files
+          The number of files analysed.
+        start, end
+          The start and exclusive end of the whole group as date strings.
+        span_days, covered_days
+          The days from start to end and the days covered by at least one
+          file.
+        gaps
+          A list of dictionaries with keys start, end, days, after and
+          before giving the missing period and the files either side.
+        overlaps
+          A list of dictionaries with keys start, end, days and files
+          giving the period covered twice and the two files concerned.
+
+    """
+    group_ids = {}
+    groups = []
+    filepaths = []
+    dates = []
+    steps = []
+
+    for filepath, drs in drspaths:
+        subset = drs.get('subset')
+        if subset is None or subset[2]:
+            continue
+        n1, n2 = subset[:2]
+        if n2 is None:
+            n2 = n1
+
+        group_key = (drs.to_dataset_id(), drs.get('variable'), drs.get('version'))
+        group = group_ids.get(group_key)
+        if group is None:
+            group = group_ids[group_key] = len(group_ids)
+
+        groups.append(group)
+        filepaths.append(filepath)
+        dates.append(_date_fields(n1) + _date_fields(n2))
+        steps.append(FREQUENCY_STEPS.get(drs.get('frequency'), 0))
+
+    if not groups:
+        return []
+
+    groups = np.array(groups, dtype=np.int64)
+    dates = np.array(dates, dtype=np.int64)
+    start = _start_keys(dates[:, :6])
+    end = _end_keys(dates[:, 6:], np.array(steps, dtype=np.int64))
+
+    # Sort by group then start and find the running end of each group
+    order = np.lexsort((end, start, groups))
+    groups, start, end = groups[order], start[order], end[order]
+    filepaths = [filepaths[i] for i in order]
+
+    first = np.ones(len(groups), dtype=bool)
+    first[1:] = groups[1:] != groups[:-1]
+
+    # Accumulate the running end over ranks offset by group so that one
+    # accumulation does not cross groups
+    keys, ranks = np.unique(np.concatenate([start, end]), return_inverse=True)
+    end_rank = ranks[len(groups):] + groups * len(keys)
+    run_rank = np.maximum.accumulate(end_rank)
+    run_end = keys[run_rank - groups * len(keys)]
+
+    # Index of the file that sets the running end
+    idx = np.arange(len(groups))
+    holder = np.maximum.accumulate(np.where(end_rank == run_rank, idx, 0))
+
+    prev_end = np.empty_like(run_end)
+    prev_end[1:] = run_end[:-1]
+    prev_holder = np.empty_like(holder)
+    prev_holder[1:] = holder[:-1]
+
+    # The part of each file not covered by earlier files
+    covered = np.where(first, end - start,
+                       np.maximum(0, end - np.maximum(start, prev_end)))
+
+    gap_rows = np.flatnonzero(~first & (start > prev_end))
+    overlap_rows = np.flatnonzero(~first & (start < prev_end))
+
+    bounds = np.flatnonzero(first)
+    covered_sums = np.add.reduceat(covered, bounds)
+    group_end = np.maximum.reduceat(run_end, bounds)
+
+    keys_by_group = dict((v, k) for k, v in group_ids.items())
+    records = []
+    for i, row in enumerate(bounds):
+        dataset_id, variable, version = keys_by_group[groups[row]]
+        records.append(dict(dataset_id=dataset_id, variable=variable,
+                            version=version,
+                            files=int((bounds[i + 1] if i + 1 < len(bounds) else len(groups)) - row),
+                            start=key_to_date(start[row]),
+                            end=key_to_date(group_end[i]),
+                            span_days=float(group_end[i] - start[row]) / SECONDS_PER_DAY,
+                            covered_days=float(covered_sums[i]) / SECONDS_PER_DAY,
+                            gaps=[], overlaps=[]))
+
+    record_of_row = np.cumsum(first) - 1
+    for row in gap_rows:
+        records[record_of_row[row]]['gaps'].append(dict(
+                start=key_to_date(prev_end[row]), end=key_to_date(start[row]),
+                days=float(start[row] - prev_end[row]) / SECONDS_PER_DAY,
+                after=filepaths[prev_holder[row]], before=filepaths[row]))
+    for row in overlap_rows:
+        overlap_end = min(prev_end[row], end[row])
+        records[record_of_row[row]]['overlaps'].append(dict(
+                start=key_to_date(start[row]), end=key_to_date(overlap_end),
+                days=float(overlap_end - start[row]) / SECONDS_PER_DAY,
+                files=[filepaths[prev_holder[row]], filepaths[row]]))
+
+    records.sort(key=lambda r: (r['dataset_id'], r['variable'], r['version']))
+    return records
+
+
+def key_to_date(key):
+    """
+    Convert a time key to a date string 'YYYY-MM-DD hh:mm:ss'.
+
+    """
+    days, seconds = divmod(int(key), SECONDS_PER_DAY)
+    y, m, d = _civil_from_days(days)
+    h, seconds = divmod(seconds, 3600)
+    mn, sec = divmod(seconds, 60)
+
+    return '%04d-%02d-%02d %02d:%02d:%02d' % (y, m, d, h, mn, sec)
+
+#-----------------------------------------------------------------------------
+
+def _date_fields(date):
+    # Missing fields of (y, m, d, h, mn, sec) become -1
+    return [-1 if x is None else x for x in date]
+
+
+def _days_from_civil(y, m, d):
+    # Days since 1970-01-01 of proleptic Gregorian dates.
+    # See http://howardhinnant.github.io/date_algorithms.html
+    y = y - (m <= 2)
+    era = np.floor_divide(y, 400)
+    yoe = y - era * 400
+    doy = (153 * (m + np.where(m > 2, -3, 9)) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+
+    return era * 146097 + doe - 719468
+
+
+def _civil_from_days(z):
+    # Inverse of _days_from_civil for a single day number
+    z += 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    d = doy - (153 * mp + 2) // 5 + 1
+    if mp < 10:
+        m = mp + 3
+    else:
+        m = mp - 9
+
+    return yoe + era * 400 + (m <= 2), m, d
+
+
+def _start_keys(dates):
+    y, m, d, h, mn, sec = [np.maximum(x, 0) for x in dates.T]
+    m = np.maximum(m, 1)
+    d = np.maximum(d, 1)
+
+    return (_days_from_civil(y, m, d) * SECONDS_PER_DAY
+            + h * 3600 + mn * 60 + sec)
+
+
+def _end_keys(dates, steps):
+    precision = (dates >= 0).sum(axis=1)
+    y, m, d, h, mn, sec = dates.T
+    m1 = np.maximum(m, 1)
+
+    # Start of the next year and the next month
+    next_year = _days_from_civil(y + 1, 1, 1) * SECONDS_PER_DAY
+    next_month = _days_from_civil(y + (m1 == 12), m1 % 12 + 1, 1) * SECONDS_PER_DAY
+
+    # Day precision and finer: the end date plus one unit or time step
+    end = _start_keys(dates) + np.where(precision == 3, SECONDS_PER_DAY,
+                                        np.maximum(_PRECISION_UNITS[precision], steps))
+
+    # Extend ends in the last days of a month to the end of the month
+    short_month = np.where(m1 == 2, 28, 30)
+    month_tail = _days_from_civil(y, m1, short_month + 1) * SECONDS_PER_DAY
+    end = np.where(end >= month_tail, next_month, end)
+
+    end = np.where(precision == 2, next_month, end)
+    end = np.where(precision == 1, next_year, end)
+
+    return end
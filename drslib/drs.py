@@ -19,6 +19,8 @@ More sophisticated conversions can be done with the
 import os
 import itertools
 import re
+import glob
+import fnmatch
 from abc import ABCMeta
 from drslib.exceptions import TranslationError
 
@@ -362,6 +364,25 @@ def _int_or_none(x):
     else:
         return int(x)
 
+def _memoize_decoder(drs_cls):
+    """
+    Return a function equivalent to drs_cls._decode_component which
+    caches results.  Component values repeat heavily within a batch of
+    filenames so this avoids most decoding work.  All decoded values
+    are immutable so sharing them between DRS instances is safe.
+
+    """
+    decode = drs_cls._decode_component
+    cache = {}
+    def memo_decode(component, value):
+        key = (component, value)
+        try:
+            return cache[key]
+        except KeyError:
+            ret = cache[key] = decode(component, value)
+            return ret
+
+    return memo_decode
 
 
 
@@ -379,6 +400,10 @@ class DRSFileSystem(object):
     :cvar publish_level: the last component name which is part of the published
         dataset-id.
 
+    :cvar FILENAME_SIGNATURE: A regular expression, without named groups,
+        that cheaply distinguishes filenames of this scheme from those of
+        other schemes.  See :class:`drslib.drs_tree.SchemeClassifier`.
+
     :ivar drs_root: The path to the root directory of a DRS filesystem.
         This path represents the activity level of the DRS.
 
@@ -388,11 +413,32 @@ class DRSFileSystem(object):
     VERSIONING_FILES_DIR = 'files'
     VERSIONING_LATEST_DIR = 'latest'
     IGNORE_FILES_REGEXP = r'^\..*'
+    FILENAME_SIGNATURE = None
 
     drs_cls = NotImplemented
 
     def __init__(self, drs_root):
         self.drs_root = drs_root
+        self._compile_layout()
+
+    def _compile_layout(self):
+        """
+        Compile the publication-level directory layout into a path template
+        and parser.  Paths are cached per dataset so that repeated
+        conversions in per-file loops are a dictionary lookup.
+
+        """
+        attrs = list(self.drs_cls._iter_components(with_version=False, to_publish_level=True))
+        #!TODO: resolve activity ambiguity!  This will not work for CORDEX
+        self._activity_attr = attrs[0]
+        self._pub_attrs = attrs[1:]
+
+        root = self.drs_root.replace('%', '%%')
+        self._pub_template = os.path.join(root, *(['%s'] * len(self._pub_attrs)))
+        self._pub_prefix = self.drs_root.rstrip('/') + '/'
+
+        self._pub_path_cache = {}
+        self._pub_drs_cache = {}
 
     def filename_to_drs(self, filename):
         """
@@ -401,6 +447,23 @@ class DRSFileSystem(object):
         """
         raise NotImplementedError
 
+    def filenames_to_drs(self, filenames):
+        """
+        Translate many filenames into DRS instances.
+
+        Schemes may override this to share work between filenames.
+
+        :param filenames: An iterable of filenames.
+        :return: An iterator of (filename, drs) in the order of filenames
+            where drs is None if the filename is not a DRS filename.
+
+        """
+        for filename in filenames:
+            try:
+                yield filename, self.filename_to_drs(filename)
+            except TranslationError:
+                yield filename, None
+
     def filepath_to_drs(self, filepath):
         """
         Return a DRS instance deduced from a full path.
@@ -422,15 +485,19 @@ class DRSFileSystem(object):
 
         """
 
-        nroot = self.drs_root.rstrip('/') + '/'
-        relpath = os.path.normpath(path[len(nroot):])
+        relpath = os.path.normpath(path[len(self._pub_prefix):])
 
-        p = [activity] + relpath.split('/')
-        drs = self.drs_cls()
-        for val, attr in itertools.izip(p, drs._iter_components(with_version=False, to_publish_level=True)):
-            drs[attr] = drs._decode_component(attr, val)
+        try:
+            components = self._pub_drs_cache[relpath]
+        except KeyError:
+            components = {}
+            for val, attr in itertools.izip(relpath.split('/'), self._pub_attrs):
+                components[attr] = self.drs_cls._decode_component(attr, val)
+            self._pub_drs_cache[relpath] = components
 
-        log.debug('%s => %s' % (repr(path), drs))
+        drs = self.drs_cls(**components)
+        if activity is not None:
+            drs[self._activity_attr] = drs._decode_component(self._activity_attr, activity)
 
         return drs
     
@@ -440,34 +507,153 @@ class DRSFileSystem(object):
         """
         Returns a directory path from a :class:`DRS` object.  Any DRS component
         that is set to None will result in a wildcard '*' element in the path.
+        A ValueError is raised if a component cannot be encoded.
 
         This function does not take into account of MIP tables of filenames.
 
         :param drs: The :class:`DRS` object from which to generate the path
 
         """
-        #!TODO: resolve activity ambiguity!  This will not work for CORDEX
-        attrs = list(drs._iter_components(with_version=False, to_publish_level=True))
-        attrs = attrs[1:]
+        values = [drs[attr] for attr in self._pub_attrs]
+        key = tuple(values)
+        try:
+            return self._pub_path_cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable component values are not cached
+            key = None
 
-        path = [self.drs_root]
-        for attr in attrs:
-            val = drs._encode_component(attr, drs[attr])
+        vals = []
+        for attr, value in zip(self._pub_attrs, values):
+            val = drs._encode_component(attr, value)
             if val == '%':
                 val = '*'
             if val is None:
-                break
-            path.append(val)
+                raise ValueError('Cannot encode DRS component %s=%r' % (attr, value))
+            vals.append(val)
 
+        path = self._pub_template % tuple(vals)
+        if key is not None:
+            self._pub_path_cache[key] = path
 
-        #!DEBUG
-        assert len(path) == len(attrs)+1
-
-        path = os.path.join(*path)
         log.debug('%s => %s' % (drs, repr(path)))
         return path
 
 
+    def find_publication_paths(self, drs, exclude=None, vocabularies=None, jobs=1,
+                               listings=None):
+        """
+        Find the publication-level directories matching a :class:`DRS`
+        object, as found by globbing the result of
+        :meth:`DRSFileSystem.drs_to_publication_path`, by descending the
+        directory structure one level at a time.
+
+        Levels with a known component are entered without listing their
+        parent.  Other levels are listed once.  Hidden directories are
+        ignored.
+
+        :param exclude: A path or filesystem wildcard.  Matching
+            directories are not entered.
+        :param vocabularies: A dictionary mapping DRS components to sets
+            of valid values.  Only directories named by a valid value are
+            entered at wildcard levels of these components.  See
+            :meth:`DRSFileSystem.discovery_vocabularies`.
+        :param jobs: If greater than 1 subtrees are scanned by this many
+            threads.
+        :param listings: A :class:`drslib.listing.ListingCache` through
+            which directories are listed.
+        :return: A sorted list of paths.
+
+        """
+        if vocabularies is None:
+            vocabularies = {}
+        if listings is None:
+            listdir = os.listdir
+        else:
+            listdir = listings.listdir
+
+        levels = []
+        for attr in self._pub_attrs:
+            value = drs[attr]
+            if value is None:
+                val = '*'
+            else:
+                val = drs._encode_component(attr, value)
+                if val == '%':
+                    val = '*'
+            levels.append((val, vocabularies.get(attr)))
+
+        def excluded(path):
+            if exclude is None:
+                return False
+            if os.path.normpath(path) == os.path.normpath(exclude) or fnmatch.fnmatch(path, exclude):
+                log.info('Not scanning %s for PublisherTrees' % path)
+                return True
+            return False
+
+        def expand(path, i):
+            val, vocab = levels[i]
+            if not glob.has_magic(val):
+                names = [val]
+            else:
+                try:
+                    names = listdir(path)
+                except OSError:
+                    return []
+                names = [x for x in names if x[0] != '.' and fnmatch.fnmatch(x, val)]
+                if vocab:
+                    names = [x for x in names if x in vocab]
+
+            return [os.path.join(path, x) for x in names 
+                    if not excluded(os.path.join(path, x))]
+
+        def descend(item):
+            path, i = item
+            if i == len(levels):
+                if os.path.isdir(path):
+                    return [path]
+                return []
+
+            ret = []
+            for subpath in expand(path, i):
+                ret += descend((subpath, i + 1))
+            return ret
+
+        if excluded(self.drs_root):
+            return []
+
+        # Expand the top levels until there are subtrees to share out
+        frontier, i = [self.drs_root], 0
+        if jobs > 1:
+            while i < len(levels) and len(frontier) < jobs:
+                frontier = [x for path in frontier for x in expand(path, i)]
+                i += 1
+
+        work = [(path, i) for path in frontier]
+        if jobs > 1 and len(work) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(jobs, len(work)))
+            try:
+                results = pool.map(descend, work, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [descend(x) for x in work]
+
+        return sorted(path for paths in results for path in paths)
+
+    def discovery_vocabularies(self):
+        """
+        Return a dictionary mapping publication-level DRS components to
+        sets of valid values for use with
+        :meth:`DRSFileSystem.find_publication_paths`.  Schemes without
+        controlled vocabularies return an empty dictionary.
+
+        """
+        return {}
+
     def drs_to_storage(self, drs):
         """
         Return the subpath within the files directory for this 
@@ -503,7 +689,8 @@ class DRSFileSystem(object):
         raise NotImplementedError
 
 
-    def iter_files_with_links(self, pub_dir, version=None, into_version=None):
+    def iter_files_with_links(self, pub_dir, version=None, into_version=None,
+                              listings=None):
         """
         Iterate over files of a particular version also returning it's respective link
         into the latest version.
@@ -511,13 +698,21 @@ class DRSFileSystem(object):
         :param version: iterate over a specific version or all versions if None
         :param into_version: the version into which symbolic links will be made, if None
             same as version, if both are None same as self.latest
+        :param listings: A :class:`drslib.listing.ListingCache` through
+            which directories are listed.
         :yield: filepath, linkpath
 
         """
+        if listings is None:
+            listdir = os.listdir
+        else:
+            listdir = listings.listdir
 
         #!TODO: needs revisiting for CORDEX
         path = os.path.join(pub_dir, self.VERSIONING_FILES_DIR)
-        if not os.path.exists(path):
+        try:
+            filedirs = listdir(path)
+        except OSError:
             return
 
         if into_version is None:
@@ -526,7 +721,8 @@ class DRSFileSystem(object):
             else:
                 into_version = version
 
-        for filedir in [f for f in os.listdir(path) if not self._is_ignored(f)]:
+        pub_drs = self.publication_path_to_drs(pub_dir)
+        for filedir in [f for f in filedirs if not self._is_ignored(f)]:
             subdrs = self.storage_to_drs(os.path.join(self.VERSIONING_FILES_DIR, filedir))
             
             if version is not None and version != subdrs.version:
@@ -534,11 +730,13 @@ class DRSFileSystem(object):
 
             filepath = os.path.join(path, filedir)
 
-            for filename in [f for f in os.listdir(filepath) if not self._is_ignored(f)]:
-                drs = self.publication_path_to_drs(path)
-                drs.update(subdrs)
+            # All files in a storage directory share the same link directory
+            drs = self.drs_cls(pub_drs)
+            drs.update(subdrs)
+            linkpath = self.drs_to_linkpath(drs, into_version)
 
-                yield os.path.join(filepath, filename), self.drs_to_linkpath(drs, into_version)
+            for filename in [f for f in listdir(filepath) if not self._is_ignored(f)]:
+                yield os.path.join(filepath, filename), linkpath
         
 
     def _is_ignored(self, filename):
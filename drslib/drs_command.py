@@ -17,6 +17,7 @@ from ConfigParser import NoSectionError, NoOptionError
 import json
 
 from drslib.drs_tree import DRSTree
+from drslib.publisher_tree import PublisherTree
 from drslib import config
 from drslib.drs import CmipDRS
 
@@ -40,6 +41,10 @@ command:
   init            initialise CMIP5 data for product detection
   diff            list differences between versions or between a version and the todo list
   repair          Fix problems that are shown by the list command
+  resume          complete upgrades that were interrupted
+  merge           combine reports written with --report, e.g. from several shards
+  coverage        report gaps and overlaps in the temporal coverage of the latest
+                  version and the todo list
 
 drs-pattern:
   A dataset identifier in '.'-separated notation using '%' for wildcards
@@ -96,12 +101,48 @@ def make_parser():
     op.add_option('-M', '--move-cmd', action='store',
                   help='Set the command used to move files into the DRS structure')
 
+    op.add_option('--ingest-checksum', action='store_true',
+                  help='Calculate MD5 checksums of files copied into the DRS structure, '
+                  'by a cp move command or mv across filesystems, for use by the mapfile command')
+
     op.add_option('-j', '--json-drs', action='store',
                   help='Obtain DRS information from the json file FILE instead of deducing it from file paths')
 
+    op.add_option('--shard', action='store', metavar='I/N',
+                  help='Only process shard I of N disjoint subsets of the selected datasets.  '
+                  'Shards are numbered from 0')
+    op.add_option('--report', action='store', metavar='FILE',
+                  help='Write a machine-readable report of the list, upgrade or coverage commands to FILE.  '
+                  'Reports can be combined with the merge command')
+    op.add_option('--check-jobs', action='store', type='int', metavar='N', default=1,
+                  help='Scan and check up to N datasets concurrently during discovery (default 1)')
+    op.add_option('--prune-vocab', action='store_true',
+                  help='Only scan directories named in the DRS vocabularies, e.g. of the MIP tables, '
+                  'when discovering datasets')
+    op.add_option('--detect-jobs', action='store', type='int', metavar='N',
+                  help='Discover incoming files through a staged pipeline deducing products '
+                  'with p_cmip5 in N concurrent jobs')
+    op.add_option('--check-cache', action='store_true',
+                  help='Record which checks each dataset passed in a .drslib_checks file in its '
+                  'publication directory and skip them while the dataset is unchanged')
+    op.add_option('--recheck', action='store_true',
+                  help='With --check-cache, check every dataset even if it passed the checks '
+                  'when last run and is unchanged since')
+    op.add_option('--all', action='store_true',
+                  help='Make the diff command compare every selected dataset and '
+                  'print a JSON record for each difference')
+    op.add_option('--on-locked', action='store', metavar='ACTION',
+                  type='choice', choices=['wait', 'skip'],
+                  help='What to do with datasets locked by another drs_tool process.  '
+                  'ACTION is "wait" or "skip".  The default is "skip" for the '
+                  'read-only list, diff and history commands and "wait" otherwise')
+
     return op
 
 class Command(object):
+    # Read-only commands skip locked datasets rather than wait for them
+    read_only = False
+
     def __init__(self, op, opts, args):
         self.op = op
         self.opts = opts
@@ -110,6 +151,7 @@ class Command(object):
         self.p_cmip5_config = None
         self.drs_root = None
         self.drs_tree = None
+        self.shard = None
 
         self.make_drs_tree()
 
@@ -142,12 +184,15 @@ class Command(object):
             except (NoSectionError, NoOptionError):
                 raise Exception("p_cmip5 configuration file not specified.  Please use --p-cmip5-config or set via metaconfig")
 
-        self.drs_tree.set_p_cmip5(p_cmip5.product.cmip5_product(
+        def make_p_cmip5():
+            return p_cmip5.product.cmip5_product(
                 mip_table_shelve=shelves['stdo_mip'],
                 template=shelves['template'],
                 stdo=shelves['stdo'],
                 config=self.p_cmip5_config,
-                not_ok_excpt=True))
+                not_ok_excpt=True)
+
+        self.drs_tree.set_p_cmip5(make_p_cmip5(), factory=make_p_cmip5)
 
 
     def make_drs_tree(self):
@@ -189,7 +234,28 @@ class Command(object):
 
         if self.opts.move_cmd:
             self.drs_tree.set_move_cmd(self.opts.move_cmd)
+        if self.opts.ingest_checksum:
+            self.drs_tree.set_ingest_checksum('MD5')
 
+        if self.opts.shard:
+            try:
+                index, count = [int(x) for x in self.opts.shard.split('/')]
+                self.drs_tree.set_shard(index, count)
+            except ValueError:
+                self.op.error('Shard must be I/N where 0 <= I < N, not %s' % self.opts.shard)
+            self.shard = (index, count)
+
+        on_locked = self.opts.on_locked
+        if on_locked is None:
+            on_locked = self.read_only and 'skip' or 'wait'
+        self.drs_tree.set_on_locked(on_locked)
+        self.drs_tree.set_check_jobs(self.opts.check_jobs)
+        if self.opts.prune_vocab:
+            self.drs_tree.set_prune_vocabularies()
+        if self.opts.check_cache:
+            self.drs_tree.set_check_cache(True, recheck=self.opts.recheck)
+        if self.opts.detect_jobs:
+            self.drs_tree.set_pipeline({'detect': {'jobs': self.opts.detect_jobs}})
 
         # This code is specifically for the deprecated DRS setting options
         # Generic DRS component setting is handled below
@@ -265,6 +331,19 @@ class Command(object):
 
     def do(self):
         raise NotImplementedError("Unimplemented command")
+
+    def write_report(self, command, **kwargs):
+        """
+        Write a json report of this command's results if --report is set.
+
+        """
+        if not self.opts.report:
+            return
+
+        report = dict(kwargs, command=command, shard=self.shard)
+        fh = open(self.opts.report, 'w')
+        json.dump(report, fh, indent=1, sort_keys=True)
+        fh.close()
     
 
     def print_header(self):
@@ -287,36 +366,70 @@ DRS Tree at %s
 
 
 class ListCommand(Command):
+    read_only = True
+
     def do(self):
+        records = []
+        for k in sorted(self.drs_tree.pub_trees):
+            pt = self.drs_tree.pub_trees[k]
+            records.append(self.dataset_record(pt))
+        incomplete = sorted(self.drs_tree.incomplete_dataset_ids())
+        locked = sorted(self.drs_tree.locked)
+
         self.print_header()
+        self.print_datasets(records, incomplete, locked)
+        self.print_footer()
+
+        self.write_report('list', datasets=records, incomplete=incomplete,
+                          locked=locked)
 
+    def dataset_record(self, pt):
+        """
+        Return a dictionary summarising the state of a PublisherTree.
+
+        """
+        return dict(dataset_id=pt.drs.to_dataset_id(),
+                    version_id=pt.version_drs().to_dataset_id(with_version=True),
+                    count=pt.count(), size=pt.size(),
+                    todo=pt.count_todo(), todo_size=pt.todo_size(),
+                    state=pt.state,
+                    interrupted=pt.has_journal(),
+                    failures=list(pt.list_failures()))
+
+    def print_datasets(self, records, incomplete, locked=()):
         to_upgrade = 0
         broken = 0
-        for k in sorted(self.drs_tree.pub_trees):
-            pt = self.drs_tree.pub_trees[k]
-            todo = pt.count_todo()
-            if todo:
-                state_msg = '%d:%d %d:%d' % (pt.count(), pt.size(), todo, pt.todo_size())
+        interrupted = 0
+        for rec in records:
+            if rec['interrupted']:
+                interrupted += 1
+            if rec['todo']:
+                state_msg = '%d:%d %d:%d' % (rec['count'], rec['size'], 
+                                             rec['todo'], rec['todo_size'])
             else:
-                state_msg = '%d:%d' % (pt.count(), pt.size())
-            if pt.state == pt.STATE_BROKEN:
+                state_msg = '%d:%d' % (rec['count'], rec['size'])
+            if rec['state'] == PublisherTree.STATE_BROKEN:
                 broken += 1
-            elif pt.state != pt.STATE_VERSIONED:
+            elif rec['state'] != PublisherTree.STATE_VERSIONED:
                 to_upgrade += 1
             #!TODO: print update summary
-            print '%-70s  %s' % (pt.version_drs().to_dataset_id(with_version=True), state_msg)
+            print '%-70s  %s' % (rec['version_id'], state_msg)
     
-        if self.drs_tree.incomplete:
+        if incomplete:
             self.print_sep()
             print 'Incompletely specified incoming datasets'
             self.print_sep()
-            for dataset_id in sorted(self.drs_tree.incomplete_dataset_ids()):
+            for dataset_id in incomplete:
                 print '%-70s' % dataset_id
 
-        if to_upgrade or broken:
+        if to_upgrade or broken or interrupted or locked:
             self.print_sep()
             if to_upgrade:
                 print '%d datasets awaiting upgrade' % to_upgrade
+            if locked:
+                print '%d datasets skipped because they are locked' % len(locked)
+            if interrupted:
+                print '%d datasets have interrupted upgrades' % interrupted
             if broken:
                 if config.check_latest:
                     print '%d datasets have broken latest versions' % broken
@@ -324,14 +437,12 @@ class ListCommand(Command):
                     print '%d datasets are broken' % broken
 
         self.print_sep()
-        for pt in self.drs_tree.pub_trees.values():
-            if pt.has_failures():
-                print 'FAIL %-70s' % pt.drs.to_dataset_id()
-                for line in pt.list_failures():
+        for rec in records:
+            if rec['failures']:
+                print 'FAIL %-70s' % rec['dataset_id']
+                for line in rec['failures']:
                     print '  ', line
 
-        self.print_footer()
-
 class TodoCommand(Command):
     def do(self):
         self.print_header()
@@ -366,6 +477,7 @@ class UpgradeCommand(Command):
 
         self.print_header()
 
+        records = []
         for k in sorted(self.drs_tree.pub_trees):
             pt = self.drs_tree.pub_trees[k]
             if self.opts.version:
@@ -375,14 +487,18 @@ class UpgradeCommand(Command):
 
             if pt.state == pt.STATE_VERSIONED:
                 print 'Publisher Tree %s has no pending upgrades' % pt.drs.to_dataset_id()
+                records.append(dict(dataset_id=k, version=None, count=0))
             else:
                 print ('Upgrading %s to version %d ...' % (pt.drs.to_dataset_id(), next_version)),
                 to_process = pt.count_todo()
                 pt.do_version(next_version)
                 print 'done %d' % to_process
+                records.append(dict(dataset_id=k, version=next_version, count=to_process))
 
         self.print_footer()
 
+        self.write_report('upgrade', datasets=records)
+
 class MapfileCommand(Command):
     def do(self):
         """
@@ -391,6 +507,11 @@ class MapfileCommand(Command):
 
         """
 
+        # The selected dataset may belong to another shard
+        if self.shard and not self.drs_tree.pub_trees:
+            log.info('No datasets selected in shard %d/%d' % self.shard)
+            return
+
         if len(self.drs_tree.pub_trees) != 1:
             raise Exception("You must select 1 dataset to create a mapfile.  %d selected" %
                             len(self.drs_tree.pub_trees))
@@ -410,9 +531,12 @@ class MapfileCommand(Command):
             log.warning("PublisherTree %s has no version %d, skipping" % (pt.drs.to_dataset_id(), version))
         else:
             #!TODO: Alternative to stdout?
-            pt.version_to_mapfile(version, checksum_func=config.checksum_func)
+            pt.version_to_mapfile(version, checksum_func=config.checksum_func,
+                                  checksum_type=config.checksum_type)
 
 class HistoryCommand(Command):
+    read_only = True
+
     def do(self):
         """
         List all versions of a selected dataset.
@@ -456,6 +580,165 @@ class RepairCommand(Command):
                     print '  ', line
 
 
+class ResumeCommand(Command):
+    def do(self):
+        self.print_header()
+
+        for k in sorted(self.drs_tree.pub_trees):
+            pt = self.drs_tree.pub_trees[k]
+            if not pt.has_journal():
+                continue
+
+            print ('Resuming upgrade of %s ...' % pt.drs.to_dataset_id()),
+            count = pt.resume()
+            print 'done %d' % count
+
+        self.print_footer()
+
+
+class CoverageCommand(Command):
+    """
+    Report the temporal coverage of the latest version and the todo list
+    of each selected dataset, listing gaps and overlaps between files.
+
+    """
+    def do(self):
+        try:
+            from drslib.coverage import analyse_coverage
+        except ImportError, e:
+            self.op.error(str(e))
+
+        def iter_drspaths():
+            for k in sorted(self.drs_tree.pub_trees):
+                pt = self.drs_tree.pub_trees[k]
+                if pt.latest and pt.versions.get(pt.latest):
+                    for filepath, drs in pt.versions[pt.latest]:
+                        yield filepath, self.drs_fs.drs_cls(drs, version=pt.latest)
+                for filepath, drs in pt._todo:
+                    yield filepath, self.drs_fs.drs_cls(drs, version=None)
+
+        records = analyse_coverage(iter_drspaths())
+
+        self.print_header()
+        self.print_coverage(records)
+        self.print_footer()
+
+        self.write_report('coverage', coverage=records)
+
+    def print_coverage(self, records):
+        gaps = overlaps = 0
+        for rec in records:
+            if rec['version'] is None:
+                version_msg = 'todo'
+            else:
+                version_msg = 'v%d' % rec['version']
+            print '%-60s %-10s %-5s %s %s %d %.1f%%' % (
+                rec['dataset_id'], rec['variable'], version_msg,
+                rec['start'][:10], rec['end'][:10], rec['files'],
+                100.0 * rec['covered_days'] / rec['span_days'])
+            for gap in rec['gaps']:
+                print '  GAP     %s to %s (%g days)' % (gap['start'], gap['end'], gap['days'])
+            for overlap in rec['overlaps']:
+                print '  OVERLAP %s to %s (%g days) %s' % (
+                    overlap['start'], overlap['end'], overlap['days'],
+                    ', '.join(os.path.basename(x) for x in overlap['files']))
+            gaps += len(rec['gaps'])
+            overlaps += len(rec['overlaps'])
+
+        self.print_sep()
+        print '%d time series, %d gaps, %d overlaps' % (len(records), gaps, overlaps)
+
+
+class MergeCommand(ListCommand, CoverageCommand):
+    """
+    Combine reports written by the list, upgrade or coverage commands
+    with --report.  Each argument is a report file.  This is typically
+    used to summarise the results of running drs_tool on several shards.
+    Merging coverage reports does not need NumPy.
+
+    """
+    def make_drs_tree(self):
+        """No need to initialise the drs tree for this command.
+        """
+        pass
+
+    def do(self):
+        if not self.args:
+            self.op.error('merge requires one or more report files')
+
+        reports = []
+        for path in self.args:
+            fh = open(path)
+            reports.append(json.load(fh))
+            fh.close()
+
+        commands = set(r['command'] for r in reports)
+        if len(commands) != 1:
+            raise Exception('Cannot merge reports of different commands: %s' %
+                            ', '.join(sorted(commands)))
+        (command, ) = commands
+
+        self._check_shards(reports)
+
+        datasets = {}
+        for report in reports:
+            for rec in report.get('datasets', []):
+                if rec['dataset_id'] in datasets:
+                    log.warning('Dataset %s present in more than one report' % rec['dataset_id'])
+                datasets[rec['dataset_id']] = rec
+        records = [datasets[k] for k in sorted(datasets)]
+
+        self.print_header()
+        if command == 'list':
+            incomplete = set()
+            locked = set()
+            for report in reports:
+                incomplete.update(report['incomplete'])
+                locked.update(report.get('locked', []))
+            self.print_datasets(records, sorted(incomplete), sorted(locked))
+            print '%d datasets, %d files, %d bytes, %d files awaiting upgrade' % (
+                len(records), sum(r['count'] for r in records),
+                sum(r['size'] for r in records), sum(r['todo'] for r in records))
+        elif command == 'upgrade':
+            upgraded = [r for r in records if r['version'] is not None]
+            for rec in upgraded:
+                print 'Upgraded %s to version %d: %d files' % (rec['dataset_id'], 
+                                                             rec['version'], rec['count'])
+            self.print_sep()
+            print '%d datasets upgraded, %d files, %d datasets had no pending upgrades' % (
+                len(upgraded), sum(r['count'] for r in upgraded), len(records) - len(upgraded))
+        elif command == 'coverage':
+            coverage = []
+            for report in reports:
+                coverage += report['coverage']
+            coverage.sort(key=lambda r: (r['dataset_id'], r['variable'], r['version']))
+            self.print_coverage(coverage)
+        else:
+            raise Exception('Unrecognised report command %s' % command)
+        self.print_footer()
+
+    def print_header(self):
+        print """\
+==============================================================================
+Merged report of %d files
+------------------------------------------------------------------------------\
+""" % len(self.args)
+
+    def _check_shards(self, reports):
+        shards = [r['shard'] for r in reports if r['shard']]
+        if not shards:
+            return
+
+        counts = set(count for index, count in shards)
+        if len(counts) != 1 or len(shards) != len(reports):
+            raise Exception('Reports are from inconsistent shardings')
+        (count, ) = counts
+        missing = set(range(count)) - set(index for index, count in shards)
+        if missing:
+            log.warning('Reports missing for shards %s of %d' % 
+                        (', '.join(str(x) for x in sorted(missing)), count))
+
+
 class DiffCommand(Command):
     """
     Accepts 0-2 arguments.  If no arguments given lists the diff between
@@ -463,21 +746,17 @@ class DiffCommand(Command):
     between that version and the todo list.  If 2 given lists the diff
     between these versions.
 
-    """
-    def do(self):
-        if len(self.drs_tree.pub_trees) != 1:
-            raise Exception("You must select 1 dataset to view differences. %d selected" %
-                            len(self.drs_tree.pub_trees))
-
-        if len(self.drs_tree.pub_trees) == 0:
-            raise Exception("No datasets selected")
+    With --all every selected dataset is compared and a JSON record is
+    printed for each difference as it is found.
 
-        pt =self.drs_tree.pub_trees.values()[0]
+    """
+    read_only = True
 
+    def do(self):
         #!TODO: better argument handling
-        args = self.args[:]
+        args = self.args[1:]
         if not args:
-            v1 = pt.latest
+            v1 = None
             v2 = None
         else:
             v1 = int(args.pop(0))
@@ -485,6 +764,20 @@ class DiffCommand(Command):
                 v2 = int(args.pop(0))
             else:
                 v2 = None
+
+        if self.opts.all:
+            return self.do_all(v1, v2)
+
+        if len(self.drs_tree.pub_trees) != 1:
+            raise Exception("You must select 1 dataset to view differences. %d selected" %
+                            len(self.drs_tree.pub_trees))
+
+        if len(self.drs_tree.pub_trees) == 0:
+            raise Exception("No datasets selected")
+
+        pt =self.drs_tree.pub_trees.values()[0]
+        if v1 is None:
+            v1 = pt.latest
         
         # Yields DIFF_STATE, file1, file2
 
@@ -499,24 +792,103 @@ class DiffCommand(Command):
         #!FIXME: Just compare file sizes at the moment!
         for diff_type, f1, f2 in pt.diff_version(v1, v2):
             filename = os.path.basename(f1 or f2)
-            if diff_type == pt.DIFF_NONE:
+            label = diff_label(diff_type, v2)
+            if label is None:
                 continue
-            # Don't compare by path if using the todo list
-            elif (v2 is not None) and (diff_type & pt.DIFF_PATH == pt.DIFF_PATH):
-                print 'PATH\t\t%s' % filename
-            elif diff_type & pt.DIFF_SIZE == pt.DIFF_SIZE:
-                print 'SIZE\t\t%s' % filename
-            elif diff_type & pt.DIFF_TRACKING_ID == pt.DIFF_TRACKING_ID:
-                print 'TRACKING_ID\t%s' % filename
-            elif diff_type & pt.DIFF_V1_ONLY == pt.DIFF_V1_ONLY:
+            elif label == 'V1_ONLY':
                 print '%s\t\t%s' % (v1, filename)
-            elif diff_type & pt.DIFF_V2_ONLY == pt.DIFF_V2_ONLY:
+            elif label == 'V2_ONLY':
                 print '%s\t\t%s' % (v2_msg, filename)
+            elif label == 'TRACKING_ID':
+                print 'TRACKING_ID\t%s' % filename
             else:
-                assert False
+                print '%s\t\t%s' % (label, filename)
                 
         self.print_footer()
 
+    def do_all(self, v1, v2):
+        """
+        Compare every selected dataset, printing one JSON record per line
+        for each difference.  Datasets are compared concurrently but
+        records are printed in dataset order.
+
+        """
+        from multiprocessing.pool import ThreadPool
+
+        def diff(pt):
+            return list(diff_records(pt, v1, v2))
+
+        pub_trees = [self.drs_tree.pub_trees[k] for k in sorted(self.drs_tree.pub_trees)]
+        pool = ThreadPool(max(1, min(self.opts.check_jobs, len(pub_trees))))
+        try:
+            for records in pool.imap(diff, pub_trees):
+                for rec in records:
+                    print json.dumps(rec, sort_keys=True)
+                sys.stdout.flush()
+        finally:
+            pool.close()
+            pool.join()
+
+
+def diff_label(diff_type, v2=None):
+    """
+    Return the label of the most significant difference in diff_type,
+    as yielded by :meth:`PublisherTree.diff_version`, or None if the files
+    are the same.  Paths are not compared with the todo list.
+
+    """
+    pt = PublisherTree
+    if diff_type == pt.DIFF_NONE:
+        return None
+    elif (v2 is not None) and (diff_type & pt.DIFF_PATH == pt.DIFF_PATH):
+        return 'PATH'
+    elif diff_type & pt.DIFF_SIZE == pt.DIFF_SIZE:
+        return 'SIZE'
+    elif diff_type & pt.DIFF_TRACKING_ID == pt.DIFF_TRACKING_ID:
+        return 'TRACKING_ID'
+    elif diff_type & pt.DIFF_V1_ONLY == pt.DIFF_V1_ONLY:
+        return 'V1_ONLY'
+    elif diff_type & pt.DIFF_V2_ONLY == pt.DIFF_V2_ONLY:
+        return 'V2_ONLY'
+    else:
+        return None
+
+
+def diff_records(pt, v1=None, v2=None):
+    """
+    Yield a dictionary for each difference between versions of a
+    PublisherTree as reported by ``drs_tool diff --all``.
+
+    :param v1: The first version, defaulting to the latest.  A dataset
+        without versions is compared as if v1 is empty.
+    :param v2: The second version or None for the todo list.  A dataset
+        with nothing to do has no pending version and is skipped.
+
+    """
+    dataset_id = pt.drs.to_dataset_id()
+    if v2 is None and pt.count_todo() == 0:
+        log.debug("PublisherTree %s has an empty todo list, skipping" % dataset_id)
+        return
+    if v1 is None:
+        v1 = pt.latest
+    for v in (v1, v2):
+        if v and v not in pt.versions:
+            log.warning("PublisherTree %s has no version %d, skipping" % (dataset_id, v))
+            return
+
+    if v1 == 0:
+        diffs = [(pt.DIFF_V2_ONLY, None, filepath) for filepath, drs in pt._todo]
+    else:
+        diffs = pt.diff_version(v1, v2)
+
+    for diff_type, f1, f2 in diffs:
+        label = diff_label(diff_type, v2)
+        if label is None:
+            continue
+        yield dict(dataset_id=dataset_id, v1=v1, v2=v2, diff=label,
+                   filename=os.path.basename(f1 or f2), path1=f1, path2=f2)
+
+
 def run(op, command, opts, args):
     commands = []
 
@@ -537,6 +909,12 @@ def run(op, command, opts, args):
     elif command == 'repair':
         commands.append(RepairCommand)
         commands.append(ListCommand)
+    elif command == 'resume':
+        commands.append(ResumeCommand)
+    elif command == 'merge':
+        commands.append(MergeCommand)
+    elif command == 'coverage':
+        commands.append(CoverageCommand)
     else:
         op.error("Unrecognised command %s" % command)
 
@@ -25,16 +25,22 @@ Detailed diagnostics can be logged by setting handlers for the logger
 """
 
 import os, sys
-from glob import glob
 import stat
 import datetime
 import re
+import hashlib
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 from drslib.cmip5 import CMIP5FileSystem
 from drslib.translate import TranslationError
 from drslib import config, mapfile
 from drslib.p_cmip5 import ProductException
 from drslib.publisher_tree import PublisherTree
+from drslib.locking import PubDirLock
+from drslib.listing import ListingCache
+from drslib.pipeline import Stage, Pipeline
 
 import logging
 log = logging.getLogger(__name__)
@@ -42,6 +48,17 @@ log = logging.getLogger(__name__)
 # We also want to log to p_cmip5 so that product detection can be filtered sensibly
 p_cmip5_log = logging.getLogger('drslib.p_cmip5')
 
+#: Names of the stages of :meth:`DRSTree.discover_incoming_pipeline` in order
+PIPELINE_STAGES = ['translate', 'detect', 'group', 'action']
+
+#: Default :class:`drslib.pipeline.Stage` keyword arguments of each stage
+PIPELINE_DEFAULTS = {
+    'translate': dict(batch_size=500),
+    'detect': dict(batch_size=50),
+    'group': dict(batch_size=500),
+    'action': dict(batch_size=1),
+    }
+
 
 class DRSTree(object):
     """
@@ -56,6 +73,10 @@ class DRSTree(object):
                     DRSTree on next upgrade.
     :ivar incomplete: :class:`DRSList` of (filepath, DRS) of all files rejected because
                       of incomplete DRS attributes.
+    :ivar locked: List of publication directories skipped because another
+                  process held their lock.  See :meth:`DRSTree.set_on_locked`.
+    :ivar listings: :class:`drslib.listing.ListingCache` of the directories
+                    listed while discovering and checking PublisherTrees.
 
     """
 
@@ -74,8 +95,19 @@ class DRSTree(object):
 
         #!TODO: generalise output specification callback
         self._p_cmip5 = None
+        self._p_cmip5_factory = None
+        self._pipeline = None
 
         self._move_cmd = config.move_cmd
+        self._shard = None
+        self._on_locked = None
+        self.locked = []
+        self.listings = ListingCache()
+        self._check_jobs = 1
+        self._check_cache = False
+        self._prune_vocabularies = False
+        self._ingest_checksum = None
+        self._recheck = False
 
 
         if not os.path.isdir(self.drs_fs.drs_root):
@@ -99,33 +131,53 @@ class DRSTree(object):
             files are detected
 
         """
+        self.discover_publisher_trees(incoming_dir, **components)
 
+        # Scan for incoming DRS files
+        if incoming_dir:
+            self.discover_incoming(incoming_dir, **components)
+
+    def discover_publisher_trees(self, incoming_dir=None, **components):
+        """
+        Scan the directory structure for existing PublisherTrees without
+        scanning for incoming files.  Arguments are as :meth:`DRSTree.discover`
+        except that `incoming_dir` is only used to ignore PublisherTrees
+        inside it.
+
+        """
         drs_t = self.drs_fs.drs_cls(**components)
 
-        # NOTE: None components are converted to wildcards
-        pt_glob = self.drs_fs.drs_to_publication_path(drs_t)
-        pub_trees = glob(pt_glob)
+        # Discovery starts from a fresh view of the filesystem
+        self.listings.clear()
 
-        for pt_path in pub_trees:
-            # Detect whether pt_path is inside incoming.  If so ignore.
-            if incoming_dir and (os.path.commonprefix((pt_path+'/', incoming_dir+'/')) == incoming_dir+'/'):
-                log.warning("PublisherTree path %s is inside incoming, ignoring" % pt_path)
-                continue
+        # NOTE: None components are wildcards.  PublisherTrees inside
+        # incoming are ignored.
+        if self._prune_vocabularies:
+            vocabularies = self.drs_fs.discovery_vocabularies()
+        else:
+            vocabularies = None
+        pub_trees = self.drs_fs.find_publication_paths(drs_t, exclude=incoming_dir,
+                                                       vocabularies=vocabularies,
+                                                       jobs=self._check_jobs,
+                                                       listings=self.listings)
 
+        for pt_path in pub_trees:
             drs = self.drs_fs.publication_path_to_drs(pt_path, activity=drs_t.activity)
             drs_id = drs.to_dataset_id()
+            if not self.in_shard(drs_id):
+                log.debug('PublisherTree %s is outside shard, ignoring' % drs_id)
+                continue
             if drs_id in self.pub_trees:
                 raise Exception("Duplicate PublisherTree %s" % drs_id)
 
-            log.info('Discovered PublisherTree at %s' % pt_path)
-            self.pub_trees[drs_id] = PublisherTree(drs, self)
+            if not self._admit_locked(pt_path):
+                continue
 
-        # Scan for incoming DRS files
-        if incoming_dir:
-            self.discover_incoming(incoming_dir, **components)
+            log.info('Discovered PublisherTree at %s' % pt_path)
+            self.pub_trees[drs_id] = PublisherTree(drs, self, defer_checks=True)
 
+        self._check_pub_trees()
 
-        
     def discover_incoming(self, incoming_dir, **components):
         """
         Scan the filesystem for incoming DRS files.
@@ -136,48 +188,177 @@ class DRSTree(object):
         :incoming_dir: A directory to recursively scan for files.
 
         """
+        if self._pipeline is not None:
+            self.discover_incoming_pipeline(incoming_dir, self._pipeline, **components)
+            return
 
-        def _iter_incoming():
-            for dirpath, dirnames, filenames in os.walk(incoming_dir):
-                for filename in filenames:
-                    yield (filename, dirpath)
+        self.discover_incoming_fromfiles(_iter_incoming(incoming_dir), **components)
 
-        self.discover_incoming_fromfiles(_iter_incoming(), **components)
+    def discover_incoming_pipeline(self, incoming_dir, stage_options=None, action=None,
+                                   **components):
+        """
+        Scan the filesystem for incoming DRS files through a
+        :class:`drslib.pipeline.Pipeline`.  Files walked from
+        `incoming_dir` pass through the stages:
+
+        translate
+          Translate batches of filenames into DRS objects, applying
+          `components` as :meth:`DRSTree.discover_incoming_fromfiles`.
+        detect
+          Deduce the product if p_cmip5 is configured.  See
+          :meth:`DRSTree.set_p_cmip5`.
+        group
+          Group files by publication-level dataset once the walk is
+          complete.  Datasets outside the shard are dropped.
+        action
+          Call `action` for each dataset.
+
+        Each stage can be scaled independently.  The walk runs in a
+        single thread and is held back when the queues are full.  The
+        group stage keeps every file it receives until the walk is
+        complete, since a dataset's files may be anywhere under
+        `incoming_dir`, so memory use grows with the number of incoming
+        files as it does for :meth:`DRSTree.discover_incoming`.
+
+        :param stage_options: A dictionary mapping stage names to
+            dictionaries of :class:`drslib.pipeline.Stage` keyword
+            arguments *jobs*, *batch_size* and *queue_size* overriding
+            :data:`PIPELINE_DEFAULTS`.
+        :param action: A callable receiving (drs_id, files) where files is
+            a list of (filename, dirpath, drs) and drs_id is None for files
+            with incomplete DRS attributes.  If None files are added to the
+            incoming list as by :meth:`DRSTree.discover_incoming_fromdrspaths`.
+
+        """
+        if stage_options is None:
+            stage_options = {}
+        for name in stage_options:
+            if name not in PIPELINE_STAGES:
+                raise ValueError('Unknown pipeline stage %s' % name)
+
+        def translate(batch):
+            dirpaths = [dirpath for filename, dirpath in batch]
+            results = self.drs_fs.filenames_to_drs(filename for filename, dirpath in batch)
+            for dirpath, (filename, drs) in zip(dirpaths, results):
+                if self._filter_drs(filename, drs, components):
+                    yield (filename, dirpath, drs)
+
+        # p_cmip5 instances are not thread safe.  Each job makes its own
+        # if a factory is set, otherwise detection is serialised.
+        detect_lock = threading.Lock()
+        detect_local = threading.local()
+        def detect(batch):
+            if not self._p_cmip5:
+                return batch
+            for filename, dirpath, drs in batch:
+                if self._p_cmip5_factory is None:
+                    with detect_lock:
+                        self._detect_product(dirpath, drs)
+                else:
+                    pci = getattr(detect_local, 'pci', None)
+                    if pci is None:
+                        pci = detect_local.pci = self._p_cmip5_factory()
+                    self._detect_product(dirpath, drs, pci)
+            return batch
+
+        groups = {}
+        group_lock = threading.Lock()
+        def group(batch):
+            for filename, dirpath, drs in batch:
+                if drs.is_publish_level():
+                    drs_id = drs.to_dataset_id()
+                    if not self.in_shard(drs_id):
+                        log.debug('File %s is outside shard, ignoring' % filename)
+                        continue
+                else:
+                    drs_id = None
+                with group_lock:
+                    groups.setdefault(drs_id, []).append((filename, dirpath, drs))
+            return []
+
+        def finish_group():
+            for drs_id in sorted(groups):
+                yield drs_id, groups.pop(drs_id)
+
+        changed = set()
+        def add_incoming(drs_id, files):
+            for filename, dirpath, drs in files:
+                if self._add_incoming(filename, dirpath, drs):
+                    changed.add(drs_id)
+
+        def act(batch):
+            for drs_id, files in batch:
+                (action or add_incoming)(drs_id, files)
+            return []
+
+        funcs = {'translate': (translate, None), 'detect': (detect, None),
+                 'group': (group, finish_group), 'action': (act, None)}
+        stages = []
+        for name in PIPELINE_STAGES:
+            kwargs = dict(PIPELINE_DEFAULTS[name])
+            kwargs.update(stage_options.get(name, {}))
+            func, finish = funcs[name]
+            stages.append(Stage(name, func, finish=finish, **kwargs))
+
+        log.info('Discovering %s through pipeline %s' % (incoming_dir, stages))
+        for item in Pipeline(stages).run(_iter_incoming(incoming_dir)):
+            pass
+
+        if action is None:
+            self._update_incoming_trees(changed)
 
 
     def iter_drspaths_fromfiles(self, files_iter, **components):
-        for filename, dirpath in files_iter:
-            log.debug('Processing %s' % filename)
-            try:
-                drs = self.drs_fs.filename_to_drs(filename)
-            except TranslationError:
-                # File doesn't match
-                log.warn('File %s is not a DRS file' % filename)
+        # Translate filenames as a batch, pairing each result with its dirpath
+        dirpaths = deque()
+        def iter_filenames():
+            for filename, dirpath in files_iter:
+                dirpaths.append(dirpath)
+                yield filename
+
+        for filename, drs in self.drs_fs.filenames_to_drs(iter_filenames()):
+            dirpath = dirpaths.popleft()
+            if not self._filter_drs(filename, drs, components):
                 continue
 
-            log.debug('File %s => %s' % (repr(filename), drs))
-            for k, v in components.items():
-                if v is None:
-                    continue
-                # If component is present in drs act as a filter
-                drs_v = drs.get(k, None)
-                if drs_v is not None:
-                    if drs_v != v:
-                        log.warn('FILTERED OUT: %s.  %s != %s' %
-                                  (drs, repr(drs_v), repr(v)))
-                        break
-                else:
-                    # Otherwise set as default
-                    log.debug('Set %s=%s' % (k, repr(v)))
-                    setattr(drs, k, v)
-            else:
-                # Only if break not called
+            # Detect product if enabled
+            if self._p_cmip5:
+                self._detect_product(dirpath, drs)
+
+            yield (filename, dirpath, drs)
+
+    def _filter_drs(self, filename, drs, components):
+        """
+        Apply `components` to the DRS translated from `filename`.
+        Components present in drs act as a filter, others are set as
+        defaults.
+
+        :return: False if the file is not a DRS file or is filtered out.
 
-                # Detect product if enabled
-                if self._p_cmip5:
-                    self._detect_product(dirpath, drs)
+        """
+        log.debug('Processing %s' % filename)
+        if drs is None:
+            # File doesn't match
+            log.warn('File %s is not a DRS file' % filename)
+            return False
+
+        log.debug('File %s => %s' % (repr(filename), drs))
+        for k, v in components.items():
+            if v is None:
+                continue
+            # If component is present in drs act as a filter
+            drs_v = drs.get(k, None)
+            if drs_v is not None:
+                if drs_v != v:
+                    log.warn('FILTERED OUT: %s.  %s != %s' %
+                              (drs, repr(drs_v), repr(v)))
+                    return False
+            else:
+                # Otherwise set as default
+                log.debug('Set %s=%s' % (k, repr(v)))
+                setattr(drs, k, v)
 
-                yield (filename, dirpath, drs)
+        return True
 
 
     def discover_incoming_fromdrspaths(self, drspaths_iter):
@@ -187,22 +368,60 @@ class DRSTree(object):
 
         """
 
+        # Dataset ids receiving new incoming files
+        changed = set()
+
         for (filename, dirpath, drs) in drspaths_iter:
-            if drs.is_publish_level():
-                log.debug('Discovered %s as %s' % (filename, drs))
-                self.incoming.append((os.path.join(dirpath, filename), drs))
-            else:
-                log.debug('Rejected %s as incomplete %s' % (filename, drs))
-                self.incomplete.append((os.path.join(dirpath, filename), drs))
+            if self._add_incoming(filename, dirpath, drs):
+                changed.add(drs.to_dataset_id())
+
+        self._update_incoming_trees(changed)
+
+    def _add_incoming(self, filename, dirpath, drs):
+        """
+        Add a file to the incoming list or, if its DRS is incomplete, to
+        the incomplete list.
+
+        :return: True if the file was added to the incoming list.
+
+        """
+        if drs.is_publish_level():
+            drs_id = drs.to_dataset_id()
+            if not self.in_shard(drs_id):
+                log.debug('File %s is outside shard, ignoring' % filename)
+                return False
+            log.debug('Discovered %s as %s' % (filename, drs))
+            self.incoming.append((os.path.join(dirpath, filename), drs))
+            return True
+        else:
+            log.debug('Rejected %s as incomplete %s' % (filename, drs))
+            self.incomplete.append((os.path.join(dirpath, filename), drs))
+            return False
+
+    def _update_incoming_trees(self, changed):
+        """
+        Bring the PublisherTrees up to date with new incoming files of
+        the datasets `changed`.
+
+        """
+        # Existing PublisherTrees only need their todo lists refiltered
+        for drs_id in changed:
+            if drs_id in self.pub_trees:
+                self.pub_trees[drs_id].invalidate(todo=True)
 
-        # Instantiate a PublisherTree for each unique publication-level dataset
+        # Instantiate a PublisherTree for each unique publication-level
+        # dataset.  New PublisherTrees deduce their state on creation.
         for path, drs in self.incoming:
             drs_id = drs.to_dataset_id()
             if drs_id not in self.pub_trees:
-                self.pub_trees[drs_id] = PublisherTree(drs, self)
+                pub_dir = self.drs_fs.drs_to_publication_path(drs)
+                if pub_dir in self.locked or not self._admit_locked(pub_dir):
+                    continue
+                self.pub_trees[drs_id] = PublisherTree(drs, self, defer_checks=True)
 
         for pt in self.pub_trees.values():
-            pt.deduce_state()
+            pt._update_state(with_checks=False)
+        self._check_pub_trees()
 
     def discover_incoming_fromfiles(self, files_iter, **components):
         """
@@ -258,7 +477,7 @@ class DRSTree(object):
             yield (filename, dirpath, drs)
             
 
-    def remove_incoming(self, path):
+    def remove_incoming(self, path, missing_ok=False):
         # Remove path from incoming
         #!TODO: This isn't efficient.  Refactoring of incoming or _todo required.
         for npath, drs in self.incoming:
@@ -267,25 +486,79 @@ class DRSTree(object):
                 break
         else:
             # not found
-            raise Exception("File %s not found in incoming" % path)
+            if not missing_ok:
+                raise Exception("File %s not found in incoming" % path)
+
+    def set_on_locked(self, action):
+        """
+        Set how discovery treats datasets locked by another process,
+        usually because they are being upgraded.
+
+        :param action: One of ``'wait'`` to wait for the lock to be
+            released, ``'skip'`` to ignore the dataset, recording it in
+            :attr:`DRSTree.locked`, or None to ignore locks.  Operations
+            which modify a dataset always wait for its lock.
 
-    def set_p_cmip5(self, p_cmip5):
+        """
+        if action not in (None, 'wait', 'skip'):
+            raise ValueError('Unknown locked dataset action %s' % action)
+        self._on_locked = action
+
+    def _admit_locked(self, pub_dir):
+        # Apply the locked dataset policy.  Return False to skip pub_dir.
+        if self._on_locked is None:
+            return True
+        lock = PubDirLock(pub_dir)
+        if not lock.is_locked():
+            return True
+        if self._on_locked == 'skip':
+            log.warning('PublisherTree %s is locked by %s, skipping' % 
+                        (pub_dir, lock.holder()))
+            self.locked.append(pub_dir)
+            return False
+
+        log.info('PublisherTree %s is locked by %s, waiting' % 
+                 (pub_dir, lock.holder()))
+        lock.wait()
+        return True
+
+    def set_p_cmip5(self, p_cmip5, factory=None):
         """
         Set the :class:`p_cmip5.product.cmip5_product` instance used to deduce
         the DRS product component.
 
+        :param factory: A callable returning a new cmip5_product instance.
+            If set each job of the detect stage of
+            :meth:`DRSTree.discover_incoming_pipeline` uses its own instance
+            so that product detection runs concurrently.
+
         """
         self._p_cmip5 = p_cmip5
+        self._p_cmip5_factory = factory
 
-    def _detect_product(self, path, drs):
+    def set_pipeline(self, stage_options=None):
+        """
+        Discover incoming files through
+        :meth:`DRSTree.discover_incoming_pipeline` with `stage_options`.
+
+        :param stage_options: As for discover_incoming_pipeline or None
+            to discover incoming files in a single thread.
+
+        """
+        self._pipeline = stage_options
+
+    def _detect_product(self, path, drs, pci=None):
         """
         Use the p_cmip5 module to deduce the product of this DRS object.
         p_cmip5 must be configured by calling :meth:`DRSTree.set_p_cmip5`.
 
+        :param pci: The cmip5_product instance to use if not the one set.
+
         """
         p_cmip5_log.info('Deducing product for %s' % drs)
 
-        pci = self._p_cmip5
+        if pci is None:
+            pci = self._p_cmip5
         if drs.subset is None or drs.subset[0] == None:
             startyear = None
         else:
@@ -309,6 +582,102 @@ class DRSTree(object):
     def set_move_cmd(self, cmd):
         self._move_cmd = cmd
 
+    def set_ingest_checksum(self, checksum_type):
+        """
+        Calculate checksums of type `checksum_type` while files are
+        copied into the DRS structure, either because the move command
+        is ``cp`` or because ``mv`` crosses filesystems.  Move commands
+        with options are run unchanged without a checksum.  Checksums are
+        recorded in each dataset's :class:`drslib.checksums.ChecksumStore`
+        for use by mapfile generation.
+
+        :param checksum_type: A :mod:`hashlib` algorithm name or None to
+            disable.
+
+        """
+        self._ingest_checksum = checksum_type
+
+    def set_check_jobs(self, jobs):
+        """
+        Scan up to `jobs` subtrees for PublisherTrees and run the checks
+        of up to `jobs` PublisherTrees concurrently during discovery.
+        Both are dominated by filesystem access so threads are used.
+
+        """
+        if jobs < 1:
+            raise ValueError('Check jobs must be at least 1, not %d' % jobs)
+        self._check_jobs = jobs
+
+    def set_prune_vocabularies(self, prune=True):
+        """
+        Only scan directories named by values in the DRS vocabularies of
+        the scheme when discovering PublisherTrees.  See
+        :meth:`DRSFileSystem.discovery_vocabularies`.  PublisherTrees
+        with components outside the vocabularies will not be found.
+
+        """
+        self._prune_vocabularies = prune
+
+    def set_check_cache(self, enabled=True, recheck=False):
+        """
+        Skip checks that passed when a PublisherTree was last checked if
+        its directories are unchanged since.  See
+        :mod:`drslib.check_cache`.
+
+        :param recheck: If True run every check but still record the
+            verdicts for later runs.
+
+        """
+        self._check_cache = enabled
+        self._recheck = recheck
+
+    def _check_pub_trees(self):
+        """
+        Complete the state of each PublisherTree, running any checks that
+        are out of date.  Failures are recorded in each PublisherTree as
+        if the checks had run serially.
+
+        """
+        pub_trees = [self.pub_trees[k] for k in sorted(self.pub_trees)]
+        if self._check_jobs == 1 or len(pub_trees) < 2:
+            for pt in pub_trees:
+                pt._deduce_state()
+            return
+
+        pool = ThreadPool(min(self._check_jobs, len(pub_trees)))
+        try:
+            pool.map(_deduce_state, pub_trees, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def set_shard(self, index, count):
+        """
+        Restrict this DRSTree to one of `count` disjoint shards of the
+        publication-level datasets.  Datasets are assigned to shards by a
+        stable hash of their dataset id so that separate processes, possibly
+        on separate nodes, can each take one shard of the same archive.
+
+        :param index: The shard to select, from 0 to count-1.
+        :param count: The total number of shards.
+
+        """
+        if not 0 <= index < count:
+            raise ValueError('Shard index %d is not in the range 0-%d' % (index, count-1))
+        self._shard = (index, count)
+
+    def in_shard(self, dataset_id):
+        """
+        Return True if the publication-level dataset `dataset_id` is
+        selected by the shard set with :meth:`DRSTree.set_shard`.
+
+        """
+        if self._shard is None:
+            return True
+
+        index, count = self._shard
+        return shard_of(dataset_id, count) == index
+
     def incomplete_dataset_ids(self):
         """
         Return a set of dataset ids for each publication-level dataset that detect_incoming()
@@ -320,6 +689,138 @@ class DRSTree(object):
         else:
             return set(drs.to_dataset_id() for fp, drs in self.incomplete)
 
+    def to_inventory(self, with_incoming=False, with_stat=True):
+        """
+        Export the files of all versions of every PublisherTree as a
+        :class:`drslib.inventory.DRSInventory`.  Requires NumPy, see
+        :mod:`drslib.inventory`.
+
+        :param with_incoming: If True include incoming files with version 0.
+        :param with_stat: If True record the size and mtime of each file.
+
+        """
+        from drslib.inventory import DRSInventory
+
+        def iter_drspaths():
+            for drs_id in sorted(self.pub_trees):
+                pt = self.pub_trees[drs_id]
+                for version in sorted(pt.versions):
+                    vlist = pt.versions[version]
+                    if vlist is None:
+                        continue
+                    for filepath, drs in vlist:
+                        if drs.version is None:
+                            drs = self.drs_fs.drs_cls(drs, version=version)
+                        yield filepath, drs
+            if with_incoming:
+                for filepath, drs in self.incoming:
+                    yield filepath, drs
+
+        return DRSInventory.from_drspaths(iter_drspaths(), self.drs_fs.drs_cls,
+                                          with_stat=with_stat)
+
+class SchemeClassifier(object):
+    """
+    Send filenames to one of several DRS schemes with a single regular
+    expression match per filename.
+
+    The :attr:`DRSFileSystem.FILENAME_SIGNATURE` of each scheme is
+    combined into one alternation which is tried in the order the schemes
+    are given, so more specific schemes should be listed first.
+
+    """
+
+    def __init__(self, schemes):
+        """
+        :param schemes: A sequence of (key, fs_cls) where fs_cls is a
+            :class:`DRSFileSystem` subclass or instance.
+
+        """
+        self.keys = []
+        alternatives = []
+        for i, (key, fs_cls) in enumerate(schemes):
+            if fs_cls.FILENAME_SIGNATURE is None:
+                raise ValueError('DRS scheme %s has no filename signature' % key)
+            self.keys.append(key)
+            alternatives.append('(?P<s%d>%s)' % (i, fs_cls.FILENAME_SIGNATURE))
+
+        self._re = re.compile('(?:%s)$' % '|'.join(alternatives))
+
+    def classify(self, filename):
+        """
+        Return the key of the scheme of `filename` or None if no scheme
+        matches.
+
+        """
+        mo = self._re.match(filename)
+        if mo is None:
+            return None
+        return self.keys[int(mo.lastgroup[1:])]
+
+
+def discover_multi(drs_trees, incoming_dir, components=None, classifier=None):
+    """
+    Discover a mixed-scheme incoming directory into one DRSTree per scheme
+    in a single walk.
+
+    Each filename is classified with a :class:`SchemeClassifier` and only
+    parsed by the DRSFileSystem of its scheme.  Existing PublisherTrees of
+    each DRSTree are discovered as with :meth:`DRSTree.discover`.
+
+    :param drs_trees: A sequence of (key, drs_tree) in classification order.
+    :param incoming_dir: A directory to recursively scan for files.
+    :param components: A dictionary mapping each key to a dictionary of DRS
+        components for that scheme's discovery.
+    :param classifier: Override the SchemeClassifier built from drs_trees.
+    :return: A list of (filename, dirpath) of files matching no scheme.
+
+    """
+    if components is None:
+        components = {}
+    if classifier is None:
+        classifier = SchemeClassifier([(key, dt.drs_fs) for key, dt in drs_trees])
+
+    files = dict((key, []) for key, dt in drs_trees)
+    unmatched = []
+    for dirpath, dirnames, filenames in os.walk(incoming_dir):
+        for filename in filenames:
+            key = classifier.classify(filename)
+            if key is None:
+                log.warn('File %s is not a DRS file of any scheme' % filename)
+                unmatched.append((filename, dirpath))
+            else:
+                files[key].append((filename, dirpath))
+
+    for key, drs_tree in drs_trees:
+        log.info('Discovered %d %s files' % (len(files[key]), key))
+        scheme_components = components.get(key, {})
+        drs_tree.discover_publisher_trees(incoming_dir, **scheme_components)
+        drs_tree.discover_incoming_fromfiles(files[key], **scheme_components)
+
+    return unmatched
+
+
+def _deduce_state(pt):
+    # Pool task of DRSTree._check_pub_trees()
+    pt._deduce_state()
+
+
+def _iter_incoming(incoming_dir):
+    for dirpath, dirnames, filenames in os.walk(incoming_dir):
+        for filename in filenames:
+            yield (filename, dirpath)
+
+
+def shard_of(dataset_id, count):
+    """
+    Return the shard, from 0 to count-1, that the publication-level
+    dataset `dataset_id` belongs to.  The result is the same on every
+    platform and Python process.
+
+    """
+    digest = hashlib.md5(dataset_id).hexdigest()
+    return int(digest[:8], 16) % count
+
 class DRSList(list):
     """
     A list of tuples (filepath, DRS) objects offering a simple query interface.
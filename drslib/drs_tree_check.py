@@ -104,7 +104,8 @@ class TreeChecker(object):
         raise NotImplementedError
 
     def _fs_versions(self, pt):
-        return set(int(x[1:]) for x in os.listdir(pt.pub_dir) if x[0] == 'v')
+        return set(int(x[1:]) for x in pt.drs_tree.listings.listdir(pt.pub_dir)
+                   if x[0] == 'v')
 
     def _all_versions(self, pt):
         return self._fs_versions(pt).union(pt.versions.keys())
@@ -112,7 +113,7 @@ class TreeChecker(object):
     def _latest_version(self, pt):
         versions = self._all_versions(pt)
         if versions:
-            return max(self._all_versions(pt))
+            return max(versions)
         else:
             raise ValueError('No latest version')
 
@@ -183,6 +184,7 @@ class CheckLatest(TreeChecker):
         if self._fix_to:
             latest_link = op.join(pt.pub_dir, 'v%d' % self._fix_to)
             os.symlink(latest_link, latest_dir)
+            pt.drs_tree.listings.added(latest_dir)
         else:
             pt._deduce_versions()
             pt._do_latest()
@@ -191,12 +193,18 @@ class CheckVersionLinks(TreeChecker):
     """
     Check all links in version directories point to real files.
 
+    Missing directories and missing or wrong links are fixable.  Repair
+    only makes the directories and links found to be wrong.
+
     """
     def __init__(self):
         super(self.__class__, self).__init__()
         self._fix_versions = set()
+        self._fixes = []
 
     def _check_hook(self, pt):
+        self._fixes = []
+
         fdir = op.join(pt.pub_dir, VERSIONING_FILES_DIR)
         if not op.isdir(fdir):
             self._state_unfixable('Files directory %s does not exist' % fdir)
@@ -213,56 +221,90 @@ class CheckVersionLinks(TreeChecker):
             versions = set(self._all_versions(pt))
         
         for version in versions:
-            for stat, message in self._scan_version(pt, version):
-                self._state_unfixable(stat, message)
+            for stat, message, fix in self._scan_version(pt, version):
+                if fix is None:
+                    self._state_unfixable(stat, message)
+                else:
+                    self._state_fixable(stat, message)
+                    self._fixes.append(fix)
                 self._fix_versions.add(version)
 
+    def _repair_hook(self, pt):
+        _apply_link_fixes(pt, self._fixes)
 
     def _scan_version(self, pt, version):
         """
-        :return: stat, message
+        Compare the links of a version with the links expected from
+        :meth:`PublisherTree._link_commands`.  The version directory is
+        listed and every link read once.  Sources are checked against the
+        directory listings cached by the DRSTree.
+
+        :return: stat, message, fix where fix is the (CMD, SRC, DEST)
+            command that repairs the failure or None if it is unfixable.
         """
-        done = []
+        drs_fs = pt.drs_tree.drs_fs
+        version_dir = op.abspath(op.join(pt.pub_dir, 'v%d' % version))
+
+        listings = pt.drs_tree.listings
+
+        # Read the target of every link in the version
+        listing = []
+        targets = {}
+        for dirpath, dirnames, filenames in listings.walk(version_dir):
+            for filename in filenames:
+                path = op.join(dirpath, filename)
+                listing.append(filename)
+                try:
+                    targets[path] = op.normpath(op.join(dirpath, os.readlink(path)))
+                except OSError:
+                    # Not a link
+                    targets[path] = None
+
+        # Reuse the DRS objects of the version's file list if it is loaded
+        drs_by_name = {}
+        if (version in pt.versions and pt.versions.is_loaded(version)
+            and pt.versions[version] is not None):
+            drs_by_name.update((op.basename(filepath), drs) 
+                               for filepath, drs in pt.versions[version])
+        drs_by_name.update(drs_fs.filenames_to_drs(x for x in listing 
+                                                   if x not in drs_by_name))
+
+        done = {}
         for cmd, src, dest in pt._link_commands(version):
             if cmd == pt.CMD_MKDIR:
                 if not op.isdir(dest):
-                    yield ('Directory missing', '%s does not exist' % dest)
+                    yield ('Directory missing', '%s does not exist' % dest, 
+                           (cmd, src, dest))
             elif cmd == pt.CMD_LINK:
-                if not op.isabs(src):
-                    realsrc = op.abspath(op.join(op.dirname(dest), src))
-                else:
-                    realsrc = src
+                realsrc = op.abspath(op.join(op.dirname(dest), src))
+                target = targets.get(op.abspath(dest))
 
-                if not op.exists(realsrc):
+                if not listings.exists(realsrc):
                     self._state_unfixable('File %s source of link %s does not exist' % (realsrc, dest))
-                elif not op.exists(dest):
-                    yield ('Missing links', 'Link %s does not exist' % dest)
+                elif target is None:
+                    yield ('Missing links', 'Link %s does not exist' % dest,
+                           (cmd, src, dest))
                 else:
-                    realdest = os.readlink(dest)
-                    if not op.isabs(realdest):
-                        realdest = op.abspath(op.join(op.dirname(dest), realdest))
-
-                    if realsrc != realdest:
-                        yield ('Links to wrong file', 'Link %s does not point to the correct file %s' % (dest, src))
-
-                    drs = pt.drs_tree.drs_fs.filename_to_drs(op.basename(realsrc))
-                    done.append(drs)
-
-        # Now scan filesystem for overlapping files
-        version_dir = op.join(pt.pub_dir, 'v%d' % version)
-        for dirpath, dirnames, filenames in os.walk(version_dir):
-            for filename in filenames:
-                try:
-                    drs = pt.drs_tree.drs_fs.filename_to_drs(filename)
-                except TranslationError:
-                    continue
-                for done_drs in done:
-                    if done_drs.variable == drs.variable and drs_dates_overlap(drs, done_drs):
-                        if drs == done_drs:
-                            continue
-                        log.debug('%s overlaps %s' % (drs, done_drs))
-                        yield ('Overlapping files in version', 
-                                '%s, %s' % (done_drs, drs))
+                    if realsrc != target:
+                        yield ('Links to wrong file', 'Link %s does not point to the correct file %s' % (dest, src),
+                               (cmd, src, dest))
+
+                    drs = drs_by_name.get(op.basename(dest))
+                    if drs is not None:
+                        done.setdefault(drs.variable, []).append(drs)
+
+        # Now check the version for overlapping files
+        for filename in listing:
+            drs = drs_by_name.get(filename)
+            if drs is None:
+                continue
+            for done_drs in done.get(drs.variable, []):
+                if drs_dates_overlap(drs, done_drs):
+                    if drs == done_drs:
+                        continue
+                    log.debug('%s overlaps %s' % (drs, done_drs))
+                    yield ('Overlapping files in version', 
+                            '%s, %s' % (done_drs, drs), None)
 
 
 
@@ -291,33 +333,44 @@ class CheckFilesLinks(TreeChecker):
 
 def repair_version(pt, version):
     """
-    An 'all in one' repair function that removes the version directory
-    and reconstructs from scratch.
+    Repair the links of a version directory in place.
 
-    This function is guaranteed not to delete anything if real files
-    are detected in the version directory.
+    Only missing directories and missing or wrong links are changed.
+    Links are replaced atomically so that readers of the version
+    never see a link disappear.  Nothing that is not a symbolic link
+    is ever removed.
 
     """
 
-    log.info('Reconstructing version %d' % version)
-
-    version_dir = op.join(pt.pub_dir, 'v%d' % version)
-    if op.isdir(version_dir):
-        # First verify no real files exist in the version directory
-        for dirpath, dirnames, filenames in os.walk(version_dir):
-            for filename in filenames:
-                # ignore files matching this regexp
-                if re.match(IGNORE_FILES_REGEXP, filename):
-                    continue
-
-                if not op.islink(op.join(dirpath, filename)):
-                    raise UnfixableInconsistency("Version directory %s contains real files" % version_dir)
-
-        # Remove the verison directory
-        shutil.rmtree(version_dir)
-
-    # Do all commands to reconstruct the version
-    pt._do_commands(pt._link_commands(version))
+    log.info('Repairing version %d' % version)
+
+    checker = CheckVersionLinks()
+    fixes = [fix for stat, message, fix in checker._scan_version(pt, version)
+             if fix is not None]
+    _apply_link_fixes(pt, fixes)
+
+
+def _apply_link_fixes(pt, fixes):
+    for cmd, src, dest in fixes:
+        if cmd == pt.CMD_MKDIR:
+            if not op.isdir(dest):
+                log.info('Creating %s' % dest)
+                os.makedirs(dest)
+                pt.drs_tree.listings.added(dest)
+        elif cmd == pt.CMD_LINK:
+            if op.lexists(dest) and not op.islink(dest):
+                raise UnfixableInconsistency("%s is a real file" % dest)
+
+            # Replace any existing link by renaming a new link over it
+            tmp = op.join(op.dirname(dest), '.%s.drslib_tmp' % op.basename(dest))
+            if op.lexists(tmp):
+                os.remove(tmp)
+            log.info('Linking %s %s' % (src, dest))
+            os.symlink(src, tmp)
+            os.rename(tmp, dest)
+            pt.drs_tree.listings.added(dest)
+        else:
+            raise Exception('Internal error: Unrecognised command type %s' % cmd)
 
         
 #!NOTE: order is important
@@ -0,0 +1,349 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Columnar inventories of the files in a DRS tree.
+
+A :class:`DRSInventory` holds one row per file.  Each DRS component is
+stored as an array of integer codes into a table of category labels and
+file size, modification time and version are stored as plain arrays.
+Selections, grouping and aggregation are vectorised with NumPy so that
+archive-wide summaries do not iterate over (filepath, drs) tuples in
+Python.
+
+Inventories are usually exported from a tree with
+:meth:`drslib.drs_tree.DRSTree.to_inventory` and can be saved to and
+loaded from ``.npz`` files::
+
+  inv = drs_tree.to_inventory()
+  inv.save('archive.npz')
+
+  inv = DRSInventory.load('archive.npz')
+  by_model = inv.aggregate(['model', 'experiment'], 'size', 'sum')
+  cmip5 = inv.select(product='output1', variable=['tas', 'pr'])
+
+Component values are held as they appear in dataset ids, e.g. the
+ensemble ``r1i1p1`` rather than ``(1, 1, 1)``.  This module requires
+NumPy, which is installed with the ``drslib[inventory]`` extra.
+
+"""
+
+import os
+import stat
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError('drslib.inventory requires NumPy.  '
+                      'Install it with "pip install drslib[inventory]"')
+
+import logging
+log = logging.getLogger(__name__)
+
+# Columns other than DRS components
+VALUE_FIELDS = ['size', 'mtime', 'version']
+
+AGGREGATES = ['sum', 'count', 'min', 'max', 'nunique']
+
+
+class DRSInventory(object):
+    """
+    A columnar table of files in a DRS tree.
+
+    :ivar components: Sequence of DRS component names held as columns.
+    :ivar codes: Mapping of component name to an integer code array.
+    :ivar categories: Mapping of component name to an array of labels
+        indexed by code.  A label of '' means the component was not set.
+    :ivar path: Array of file paths.
+    :ivar size: Array of file sizes in bytes or -1 if unknown.
+    :ivar mtime: Array of file modification times or -1 if unknown.
+    :ivar version: Array of dataset versions.  Files not yet in a
+        version have version 0.
+
+    """
+
+    def __init__(self, components, codes, categories, path, size, mtime, version):
+        self.components = list(components)
+        self.codes = codes
+        self.categories = categories
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.version = version
+
+    def __len__(self):
+        return len(self.path)
+
+    def __repr__(self):
+        return '<DRSInventory of %d files>' % len(self)
+
+    @classmethod
+    def from_drspaths(klass, drspaths, drs_cls, with_stat=True):
+        """
+        Build an inventory from an iterable of (filepath, drs) tuples.
+
+        :param drs_cls: The DRS class used to encode component values.
+        :param with_stat: If True stat each file for its size and mtime.
+
+        """
+        components = [x for x in drs_cls.DRS_ATTRS if x != 'subset']
+        labels = dict((c, {'': 0}) for c in components)
+        codes = dict((c, array('l')) for c in components)
+        paths = []
+        sizes = array('d')
+        mtimes = array('d')
+        versions = array('l')
+
+        for filepath, drs in drspaths:
+            for component in components:
+                value = drs.get(component)
+                if value is None:
+                    value = ''
+                else:
+                    value = drs_cls._encode_component(component, value)
+                component_labels = labels[component]
+                code = component_labels.get(value)
+                if code is None:
+                    code = component_labels[value] = len(component_labels)
+                codes[component].append(code)
+
+            paths.append(filepath)
+            versions.append(drs.version or 0)
+            if with_stat:
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    log.warning('Cannot stat %s' % filepath)
+                    sizes.append(-1)
+                    mtimes.append(-1)
+                else:
+                    sizes.append(st[stat.ST_SIZE])
+                    mtimes.append(st[stat.ST_MTIME])
+            else:
+                sizes.append(-1)
+                mtimes.append(-1)
+
+        categories = {}
+        for component, component_labels in labels.items():
+            cat = [None] * len(component_labels)
+            for value, code in component_labels.items():
+                cat[code] = value
+            categories[component] = np.array(cat, dtype=str)
+
+        return klass(components,
+                     dict((c, np.array(codes[c], dtype=np.int32)) for c in components),
+                     categories,
+                     np.array(paths, dtype=str),
+                     np.array(sizes, dtype=np.int64),
+                     np.array(mtimes, dtype=np.int64),
+                     np.array(versions, dtype=np.int64))
+
+    #-------------------------------------------------------------------------
+    # Persistence
+
+    def save(self, filename):
+        """
+        Save the inventory to a NumPy ``.npz`` file.
+
+        """
+        arrays = {
+            'components': np.array(self.components, dtype=str),
+            'path': self.path,
+            'size': self.size,
+            'mtime': self.mtime,
+            'version': self.version,
+            }
+        for component in self.components:
+            arrays['codes_%s' % component] = self.codes[component]
+            arrays['categories_%s' % component] = self.categories[component]
+
+        fh = open(filename, 'wb')
+        try:
+            np.savez_compressed(fh, **arrays)
+        finally:
+            fh.close()
+
+    @classmethod
+    def load(klass, filename):
+        """
+        Load an inventory saved with :meth:`DRSInventory.save`.
+
+        """
+        data = np.load(filename)
+        try:
+            components = list(data['components'])
+            return klass(components,
+                         dict((c, data['codes_%s' % c]) for c in components),
+                         dict((c, data['categories_%s' % c]) for c in components),
+                         data['path'], data['size'], data['mtime'], data['version'])
+        finally:
+            data.close()
+
+    #-------------------------------------------------------------------------
+    # Queries
+
+    def column(self, name):
+        """
+        Return the values of a column.  Component columns are returned
+        as arrays of labels.
+
+        """
+        if name in self.codes:
+            return self.categories[name][self.codes[name]]
+        elif name in VALUE_FIELDS or name == 'path':
+            return getattr(self, name)
+        else:
+            raise ValueError('Unknown inventory column %s' % repr(name))
+
+    def mask(self, **kw):
+        """
+        Return a boolean array selecting rows with the given column values.
+
+        As with :meth:`drslib.drs_tree.DRSList.select` if a value is a
+        list rows with any value in the list are selected, otherwise rows
+        equal to the value are selected.
+
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for k, v in kw.items():
+            if type(v) != list:
+                v = [v]
+
+            if k in self.codes:
+                # Compare codes rather than labels
+                wanted = np.flatnonzero(np.in1d(self.categories[k], [str(x) for x in v]))
+                mask &= np.in1d(self.codes[k], wanted)
+            elif k in VALUE_FIELDS:
+                mask &= np.in1d(getattr(self, k), v)
+            else:
+                raise ValueError('Unknown inventory column %s' % repr(k))
+
+        return mask
+
+    def select(self, mask=None, **kw):
+        """
+        Return a new inventory of the selected rows.
+
+        :param mask: A boolean array of rows to select.  Combined with
+            any component selection given as keywords (see :meth:`mask`).
+
+        """
+        if kw:
+            if mask is None:
+                mask = self.mask(**kw)
+            else:
+                mask = mask & self.mask(**kw)
+        if mask is None:
+            return self
+
+        return DRSInventory(self.components,
+                            dict((c, self.codes[c][mask]) for c in self.components),
+                            self.categories,
+                            self.path[mask], self.size[mask],
+                            self.mtime[mask], self.version[mask])
+
+    def group_by(self, by):
+        """
+        Group rows by the values of one or more columns.
+
+        :param by: A column name or sequence of column names.
+        :return: (keys, group) where keys is a list of tuples of column
+            values, one per group, and group is an array
+            giving the index into keys of each row.
+
+        """
+        if isinstance(by, basestring):
+            by = [by]
+
+        key_codes = []
+        key_labels = []
+        for name in by:
+            if name in self.codes:
+                key_codes.append(self.codes[name])
+                key_labels.append(self.categories[name])
+            elif name in VALUE_FIELDS:
+                labels, codes = np.unique(getattr(self, name), return_inverse=True)
+                key_codes.append(codes)
+                key_labels.append(labels)
+            else:
+                raise ValueError('Unknown inventory column %s' % repr(name))
+
+        if len(self) == 0:
+            return [], np.zeros(0, dtype=np.intp)
+
+        dims = [len(x) for x in key_labels]
+        try:
+            combined = np.ravel_multi_index(key_codes, dims)
+        except ValueError:
+            # Too many combinations to pack into one integer
+            rows = np.column_stack(key_codes)
+            uniq, group = np.unique(rows, axis=0, return_inverse=True)
+            uniq_codes = uniq.T
+        else:
+            uniq, group = _factorize(combined, np.prod(dims, dtype=np.int64))
+            uniq_codes = np.unravel_index(uniq, dims)
+
+        columns = [labels[codes].tolist() for labels, codes in zip(key_labels, uniq_codes)]
+        keys = zip(*columns)
+
+        return keys, group
+
+    def aggregate(self, by, field='size', func='sum'):
+        """
+        Aggregate a value column over groups of rows.
+
+        :param by: A column name or sequence of column names to group by.
+        :param field: The column to aggregate, one of size, mtime or version.
+        :param func: One of sum, count, min, max or nunique.
+        :return: A dictionary mapping each group key, a tuple of column
+            values, to the aggregate.
+
+        """
+        if func not in AGGREGATES:
+            raise ValueError('Unknown aggregate %s' % repr(func))
+
+        keys, group = self.group_by(by)
+        if not keys:
+            return {}
+
+        values = self.column(field)
+        n = len(keys)
+        if func == 'count':
+            result = np.bincount(group, minlength=n)
+        elif func == 'sum':
+            # Float sums are exact to 2**53, beyond any archive size
+            result = np.bincount(group, weights=values, minlength=n).astype(values.dtype)
+        elif func in ('min', 'max'):
+            # Every group is non-empty so reduce over contiguous runs
+            order = np.argsort(group)
+            starts = np.concatenate([[0], np.cumsum(np.bincount(group, minlength=n))[:-1]])
+            ufunc = np.minimum if func == 'min' else np.maximum
+            result = ufunc.reduceat(values[order], starts)
+        elif func == 'nunique':
+            value_labels, value_codes = np.unique(values, return_inverse=True)
+            pairs, _ = _factorize(group * len(value_labels) + value_codes,
+                                  n * len(value_labels))
+            result = np.bincount(pairs // len(value_labels), minlength=n)
+
+        return dict(zip(keys, result.tolist()))
+
+
+def _factorize(values, size):
+    """
+    Return (uniq, inverse) as np.unique(values, return_inverse=True)
+    for non-negative integers less than size.  Where size is not much
+    larger than values a counting pass replaces the sort.
+
+    """
+    if size > max(4 * len(values), 1 << 20):
+        return np.unique(values, return_inverse=True)
+
+    present = np.bincount(values, minlength=size) > 0
+    uniq = np.flatnonzero(present)
+    lookup = np.cumsum(present) - 1
+    return uniq, lookup[values]
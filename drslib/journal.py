@@ -0,0 +1,155 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Append-only journal of PublisherTree upgrade operations.
+
+Before :meth:`PublisherTree.do_version` touches the filesystem the
+complete list of commands for the upgrade is written to a journal file
+in the publication directory.  Each command is then recorded as it
+completes.  If the upgrade is interrupted the journal allows
+:meth:`PublisherTree.resume` to replay only the outstanding commands
+without rescanning or rebuilding the tree.
+
+The journal is a series of JSON records, one per line.  The first
+record holds the target version, followed by one record per planned
+command and then one record per completed command.  A truncated final
+line, as left by a crash, is ignored.
+
+"""
+
+import os
+import json
+
+import logging
+log = logging.getLogger(__name__)
+
+JOURNAL_FILE = '.drslib_journal'
+
+
+class JournalError(Exception):
+    pass
+
+
+class UpgradeJournal(object):
+    """
+    The upgrade journal of a single publication-level dataset.
+
+    :ivar path: Path of the journal file.
+
+    """
+
+    def __init__(self, pub_dir):
+        self.path = os.path.join(pub_dir, JOURNAL_FILE)
+        self._fh = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def begin(self, version, commands):
+        """
+        Start a new journal recording the planned commands.
+
+        The plan is synced to disk before returning so that it survives
+        a node failure.
+
+        :param version: The version being created.
+        :param commands: A sequence of (CMD, SRC, DEST) tuples as yielded
+            by :meth:`PublisherTree.todo_commands`.
+
+        """
+        if self.exists():
+            raise JournalError('Journal %s already exists' % self.path)
+
+        fh = open(self.path, 'w')
+        fh.write(json.dumps({'version': version}) + '\n')
+        for i, (cmd, src, dest) in enumerate(commands):
+            fh.write(json.dumps({'op': i, 'cmd': cmd,
+                                 'src': src, 'dest': dest}) + '\n')
+        fh.flush()
+        os.fsync(fh.fileno())
+        self._fh = fh
+
+        log.debug('Journal %s started with %d commands' % (self.path, len(commands)))
+
+    def reopen(self):
+        """
+        Reopen an existing journal to record further completed commands.
+
+        """
+        self._fh = open(self.path, 'a')
+
+    def mark_done(self, op):
+        """
+        Record command number `op` as complete.
+
+        Completion records are flushed but not synced.  Replaying a
+        completed command is harmless so a lost record only costs time.
+
+        """
+        self._fh.write(json.dumps({'done': op}) + '\n')
+        self._fh.flush()
+
+    def read(self):
+        """
+        Read the journal.
+
+        :return: (version, commands, done) where commands is a list of
+            (CMD, SRC, DEST) tuples and done is the set of indexes of
+            completed commands.
+
+        """
+        version = None
+        commands = []
+        done = set()
+
+        fh = open(self.path)
+        try:
+            for line in fh:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    log.warning('Ignoring corrupt journal record in %s: %s' %
+                                (self.path, repr(line)))
+                    continue
+
+                if 'version' in rec:
+                    version = rec['version']
+                elif 'op' in rec:
+                    if rec['op'] != len(commands):
+                        raise JournalError('Journal %s is out of sequence' % self.path)
+                    commands.append((rec['cmd'], _str(rec['src']), _str(rec['dest'])))
+                elif 'done' in rec:
+                    done.add(rec['done'])
+        finally:
+            fh.close()
+
+        if version is None:
+            raise JournalError('Journal %s has no version record' % self.path)
+
+        return version, commands, done
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def remove(self):
+        """
+        Remove the journal once the upgrade is complete.
+
+        """
+        self.close()
+        os.remove(self.path)
+        log.debug('Journal %s removed' % self.path)
+
+
+def _str(s):
+    # json returns unicode.  Paths are used as byte strings elsewhere.
+    if s is None:
+        return None
+    return str(s)
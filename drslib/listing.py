@@ -0,0 +1,156 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Run-scoped cache of directory listings.
+
+Deducing the state of a PublisherTree lists the same directories many
+times: the publication directory while deducing versions and again in
+each checker, the files directory for every version iterated.  A
+:class:`ListingCache` is owned by each :class:`drslib.drs_tree.DRSTree`
+so each directory is listed once per run.
+
+Changes made by drslib are applied to the cached listings in place
+with :meth:`ListingCache.added` and :meth:`ListingCache.removed`.
+Changes made behind drslib's back are only seen after the listings are
+invalidated, as :meth:`drslib.publisher_tree.PublisherTree.deduce_state`
+does for its publication directory.
+
+"""
+
+import os
+import stat
+import threading
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class ListingCache(object):
+    """
+    Cache of the names in directories keyed by normalised path.
+    Missing directories are not cached.
+
+    """
+
+    def __init__(self):
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def listdir(self, path):
+        """
+        As :func:`os.listdir` but the result is sorted and cached.
+
+        :raises OSError: if `path` cannot be listed.
+
+        """
+        return sorted(self._names(path))
+
+    def exists(self, path):
+        """
+        Return True if `path` is listed in its parent directory.  Like
+        :func:`os.path.lexists` broken symbolic links exist.
+
+        """
+        parent, name = os.path.split(os.path.normpath(path))
+        try:
+            return name in self._names(parent)
+        except OSError:
+            return False
+
+    def walk(self, top):
+        """
+        As :func:`os.walk` from the top down but listing directories
+        through the cache.  Symbolic links, including links to
+        directories, are yielded with the files.  Directories that cannot
+        be listed are skipped.
+
+        """
+        try:
+            names = self.listdir(top)
+        except OSError:
+            return
+
+        dirnames, filenames = [], []
+        for name in names:
+            try:
+                mode = os.lstat(os.path.join(top, name)).st_mode
+            except OSError:
+                continue
+            if stat.S_ISDIR(mode):
+                dirnames.append(name)
+            else:
+                filenames.append(name)
+
+        yield top, dirnames, filenames
+        for name in dirnames:
+            for entry in self.walk(os.path.join(top, name)):
+                yield entry
+
+    def added(self, path):
+        """
+        Record that `path` has been created.  Any parent directories
+        created with it are also recorded.
+
+        """
+        path = os.path.normpath(path)
+        with self._lock:
+            while True:
+                parent, name = os.path.split(path)
+                if not name:
+                    break
+                names = self._listings.get(parent)
+                if names is not None:
+                    if name in names:
+                        break
+                    names.add(name)
+                path = parent
+
+    def removed(self, path):
+        """
+        Record that `path` has been removed.  The listing of `path`
+        itself is forgotten but not those of directories below it.
+
+        """
+        path = os.path.normpath(path)
+        parent, name = os.path.split(path)
+        with self._lock:
+            names = self._listings.get(parent)
+            if names is not None:
+                names.discard(name)
+            self._listings.pop(path, None)
+
+    def invalidate(self, path, recursive=False):
+        """
+        Forget the listing of `path` so that it is listed again when next
+        used.
+
+        :param recursive: If True also forget the listings of every
+            directory below `path`.
+
+        """
+        key = os.path.normpath(path)
+        with self._lock:
+            self._listings.pop(key, None)
+            if recursive:
+                prefix = os.path.join(key, '')
+                for k in [k for k in self._listings if k.startswith(prefix)]:
+                    del self._listings[k]
+
+    def _names(self, path):
+        key = os.path.normpath(path)
+        with self._lock:
+            names = self._listings.get(key)
+        if names is None:
+            names = set(os.listdir(path))
+            with self._lock:
+                names = self._listings.setdefault(key, names)
+        return names
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
@@ -0,0 +1,209 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Advisory locks on publication-level datasets.
+
+Locks are files in the publication directory created with the
+``link()`` protocol: a uniquely named file is written and then hard
+linked to the lock file name.  The lock is held if the unique file then
+has a link count of 2.  Unlike ``O_EXCL`` or ``flock()`` this is safe on
+NFS and Lustre, including when the reply to ``link()`` is lost.
+
+Locks held by a process that has died on the same host are broken
+automatically.  Locks from other hosts are never broken automatically.
+
+"""
+
+import os
+import socket
+import time
+import errno
+import itertools
+
+import logging
+log = logging.getLogger(__name__)
+
+LOCK_FILE = '.drslib_lock'
+
+# Seconds between attempts to acquire a lock
+POLL_INTERVAL = 1.0
+
+_counter = itertools.count()
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class PubDirLock(object):
+    """
+    An advisory lock on a publication directory.
+
+    :ivar path: Path of the lock file.
+    :ivar contended: True if the last acquire() had to wait for another holder.
+
+    """
+
+    def __init__(self, pub_dir):
+        self.pub_dir = pub_dir
+        self.path = os.path.join(pub_dir, LOCK_FILE)
+        self.contended = False
+        self._held = False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+
+    def is_locked(self):
+        return os.path.exists(self.path)
+
+    def acquire(self, timeout=None):
+        """
+        Acquire the lock, waiting for any other holder to release it.
+
+        The publication directory must exist.
+
+        :param timeout: Maximum seconds to wait or None to wait forever.
+        :raises LockTimeout: if the lock cannot be acquired in time.
+
+        """
+        self.contended = False
+        start = time.time()
+        while not self._try_acquire():
+            if not self.contended:
+                log.info('Waiting for lock %s held by %s' % (self.path, self.holder()))
+            self.contended = True
+            if timeout is not None and time.time() - start > timeout:
+                raise LockTimeout('Timed out waiting for lock %s' % self.path)
+            time.sleep(POLL_INTERVAL)
+
+        self._held = True
+        log.debug('Acquired lock %s' % self.path)
+
+    def release(self):
+        if not self._held:
+            return
+        self._held = False
+        try:
+            os.remove(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            log.warning('Lock %s was removed while held' % self.path)
+        log.debug('Released lock %s' % self.path)
+
+    def wait(self, timeout=None):
+        """
+        Wait until the lock is not held without acquiring it.
+
+        :return: True if the lock is free, False if timeout expired.
+
+        """
+        start = time.time()
+        while self.is_locked():
+            if self._break_stale():
+                break
+            if timeout is not None and time.time() - start > timeout:
+                return False
+            time.sleep(POLL_INTERVAL)
+
+        return True
+
+    def holder(self):
+        """
+        Return (hostname, pid) of the current holder or None.
+
+        """
+        return _read_holder(self.path)
+
+    #-------------------------------------------------------------------------
+
+    def _try_acquire(self):
+        hostname = socket.gethostname()
+        unique = '%s.%s.%d.%d' % (self.path, hostname, os.getpid(), _counter.next())
+
+        fh = open(unique, 'w')
+        fh.write('%s %d\n' % (hostname, os.getpid()))
+        fh.close()
+
+        try:
+            try:
+                os.link(unique, self.path)
+            except OSError:
+                # The link may have succeeded even if link() reports failure
+                pass
+            if os.stat(unique).st_nlink == 2:
+                return True
+
+            self._break_stale()
+            return False
+        finally:
+            os.remove(unique)
+
+    def _break_stale(self):
+        """
+        Remove the lock if its holder is a dead process on this host.
+
+        Another process may break the same lock and acquire it between
+        reading the holder and removing the lock.  The lock file is
+        therefore first renamed to a unique name and the holder read
+        again from the renamed file.  If it has changed the live lock is
+        linked back into place.
+
+        """
+        holder = self.holder()
+        if holder is None:
+            return False
+
+        hostname, pid = holder
+        if hostname != socket.gethostname():
+            return False
+
+        try:
+            os.kill(pid, 0)
+            return False
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                return False
+
+        stale = '%s.stale.%s.%d.%d' % (self.path, hostname, os.getpid(), _counter.next())
+        try:
+            os.rename(self.path, stale)
+        except OSError:
+            # Already broken by another process
+            return False
+
+        try:
+            if _read_holder(stale) != holder:
+                log.info('Lock %s changed holder while breaking it, restoring' % self.path)
+                try:
+                    os.link(stale, self.path)
+                except OSError:
+                    log.error('Cannot restore lock %s taken over by another process' %
+                              self.path)
+                return False
+        finally:
+            os.remove(stale)
+
+        log.warning('Broke stale lock %s held by dead process %d' % (self.path, pid))
+        return True
+
+
+def _read_holder(path):
+    try:
+        fh = open(path)
+        try:
+            hostname, pid = fh.read().split()
+        finally:
+            fh.close()
+        return hostname, int(pid)
+    except (IOError, ValueError):
+        return None
@@ -13,35 +13,193 @@ Generate mapfiles from streams of DRS objects
 #!TODO: check againsts similar code in datanode_admin and merge
 
 CHECKSUM_BLOCKSIZE = 2**20
+MAPFILE_INDEX_FILE = '.drslib_mapfile_index'
 
 import stat, os
+import shutil
+import json
 
+import logging
+log = logging.getLogger(__name__)
 
-def write_mapfile(stream, fh, checksum_func=None):
+
+def write_mapfile(stream, fh, checksum_func=None, checksum_store=None, previous=None,
+                  checksum_type=None):
     """
     Write an esgpublish mapfile from a stream of tuples (filepath, drs).
 
     :param checksum_func: A callable of one argument (path) which returns (checksum_type, checksum) or None
+    :param checksum_store: A :class:`drslib.checksums.ChecksumStore`.  Checksums
+        of checksum_type found in the store are used instead of calling
+        checksum_func and checksums calculated by checksum_func are added to it.
+    :param previous: A dictionary of entries of an earlier mapfile as returned
+        by this function.  Checksums of checksum_type of files with the same
+        real path, size and modification time are reused instead of calling
+        checksum_func.
+    :param checksum_type: The type of checksum returned by checksum_func.  If
+        None it is taken from the first result of checksum_func and no stored
+        checksum is used before then.
+    :return: If previous is given a dictionary mapping the real path of each
+        file written to (size, mod_time, checksum_type, checksum), otherwise None.
 
     """
+    if previous is None:
+        entries = None
+    else:
+        entries = {}
 
     for path, drs in stream:
         file_stat = os.stat(path)
         size = file_stat[stat.ST_SIZE]
         mtime = file_stat[stat.ST_MTIME]
+        mod_time = "%f" % float(mtime)
+
+        params = [drs.to_dataset_id(with_version=False), path, str(size), "mod_time=%s" % mod_time]
 
-        params = [drs.to_dataset_id(with_version=False), path, str(size), "mod_time=%f"%float(mtime)]
+        ret = None
+        if entries is not None:
+            realpath = _real_path(path)
+            prev = previous.get(realpath)
+            if (prev is not None and prev[:2] == (size, mod_time) and
+                _same_type(prev[2], checksum_type)):
+                ret = prev[2:]
 
         if checksum_func:
-            ret = checksum_func(path)
+            if ret is None and checksum_store is not None and checksum_type is not None:
+                ret = checksum_store.get(path, checksum_type)
+            if ret is None:
+                ret = checksum_func(path)
+                if ret is not None:
+                    if checksum_type is None:
+                        checksum_type = ret[0]
+                    if checksum_store is not None:
+                        checksum_store.add(path, *ret)
             if ret is not None:
-                checksum_type, checksum = ret
-                params.append('checksum_type=%s' % checksum_type)
-                params.append('checksum=%s' % checksum)
+                params.append('checksum_type=%s' % ret[0])
+                params.append('checksum=%s' % ret[1])
+
+        if entries is not None:
+            if checksum_func and ret is not None:
+                entries[realpath] = (size, mod_time) + tuple(ret)
+            else:
+                entries[realpath] = (size, mod_time, None, None)
 
         print >>fh, ' | '.join(params)
+
+    return entries
         
 
+def _same_type(checksum_type, expected):
+    # Recorded checksums are only reused once the expected type is known
+    return (checksum_type is not None and expected is not None and
+            checksum_type.upper() == expected.upper())
+
+
+def _real_path(path):
+    # Version directories hold links to the files directory
+    if os.path.islink(path):
+        return os.path.normpath(os.path.join(os.path.dirname(path), os.readlink(path)))
+    else:
+        return os.path.normpath(path)
+
+
+class MapfileIndex(object):
+    """
+    The entries of the last mapfile generated for a publication-level
+    dataset, stored in the publication directory so that the mapfile
+    of the next version only checksums new or changed files.
+
+    The index is a file holding one JSON record per line.  The first
+    record holds the version, followed by one record per file of
+    [realpath, size, mod_time, checksum_type, checksum].
+
+    """
+
+    def __init__(self, pub_dir):
+        self.path = os.path.join(pub_dir, MAPFILE_INDEX_FILE)
+
+    def load(self):
+        """
+        :return: (version, entries) where entries is as returned by
+            :func:`write_mapfile`.  If there is no index version is None.
+
+        """
+        if not os.path.exists(self.path):
+            return None, {}
+
+        entries = {}
+        fh = open(self.path)
+        try:
+            try:
+                version = json.loads(fh.readline())['version']
+                for line in fh:
+                    realpath, size, mod_time, checksum_type, checksum = json.loads(line)
+                    entries[str(realpath)] = (size, str(mod_time), 
+                                              _str(checksum_type), _str(checksum))
+            except (ValueError, KeyError):
+                log.warning('Ignoring corrupt mapfile index %s' % self.path)
+                return None, {}
+        finally:
+            fh.close()
+
+        return version, entries
+
+    def save(self, version, entries):
+        """
+        Replace the index with the entries of `version`.  The archive
+        may be read-only to the mapfile generator so failing to write the
+        index is logged and otherwise ignored.
+
+        :return: True if the index was written.
+
+        """
+        tmp_path = '%s.%d' % (self.path, os.getpid())
+        try:
+            fh = open(tmp_path, 'w')
+            try:
+                fh.write(json.dumps({'version': version}) + '\n')
+                for realpath in sorted(entries):
+                    fh.write(json.dumps([realpath] + list(entries[realpath])) + '\n')
+            finally:
+                fh.close()
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError), e:
+            log.warning('Cannot save mapfile index %s: %s' % (self.path, e))
+            if os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return False
+
+        return True
+
+
+def _str(s):
+    if s is None:
+        return None
+    return str(s)
+
+
+def read_mapfile(fh):
+    """
+    Read an esgpublish mapfile as written by :func:`write_mapfile`.
+
+    :return: An iterator of tuples (dataset_id, path, size, params) where params
+        is a dictionary of the optional ``key=value`` fields.
+
+    """
+    for line in fh:
+        line = line.strip()
+        if not line or line[0] == '#':
+            continue
+        fields = [x.strip() for x in line.split('|')]
+        dataset_id, path, size = fields[:3]
+        params = dict(x.split('=', 1) for x in fields[3:])
+
+        yield dataset_id, path, int(size), params
+
+
 
 def calc_md5(path):
     """
@@ -65,3 +223,35 @@ def calc_md5(path):
     fh.close()
 
     return 'MD5', md5.hexdigest()
+
+
+def copy_with_checksum(src, dest, checksum_type='MD5'):
+    """
+    Copy a file calculating its checksum from the data as it is copied
+    so that the file is only read once.  The permissions and
+    modification time of src are copied to dest.
+
+    :param checksum_type: The name of a :mod:`hashlib` algorithm.
+    :return: (checksum_type, checksum) as returned by :func:`calc_md5`.
+
+    """
+    import hashlib
+
+    digest = hashlib.new(checksum_type.lower())
+    fsrc = open(src, 'rb')
+    try:
+        fdest = open(dest, 'wb')
+        try:
+            while True:
+                data = fsrc.read(CHECKSUM_BLOCKSIZE)
+                if not data:
+                    break
+                digest.update(data)
+                fdest.write(data)
+        finally:
+            fdest.close()
+    finally:
+        fsrc.close()
+    shutil.copystat(src, dest)
+
+    return checksum_type.upper(), digest.hexdigest()
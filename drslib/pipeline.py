@@ -0,0 +1,209 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Staged processing pipelines with bounded queues.
+
+A :class:`Pipeline` passes the items of a source iterable through a
+sequence of :class:`Stage` objects.  Each stage runs in its own threads
+and is connected to the next by a bounded queue of batches so that a
+slow stage holds back the stages before it.  At most
+``queue_size * batch_size`` items wait on the input of each stage.
+This bounds only the items in flight between stages.  A stage may keep
+any number of items itself, as grouping does until its `finish` is
+called, so a pipeline is not memory-bounded as a whole.
+
+Stages are dominated by filesystem access or by libraries that release
+the GIL so threads are used as in the rest of drslib.  Items leave a
+stage in the order they entered it only if the stage has a single job.
+
+:meth:`drslib.drs_tree.DRSTree.discover_incoming_pipeline` builds the
+pipeline used to discover incoming files.
+
+"""
+
+import sys
+import threading
+from Queue import Queue
+
+import logging
+log = logging.getLogger(__name__)
+
+# Marks the end of the stream on a queue
+_END = None
+
+
+class Stage(object):
+    """
+    A step of a :class:`Pipeline`.
+
+    :ivar name: Name of the stage used in diagnostics.
+    :ivar func: A callable receiving a list of up to `batch_size` items
+        and returning an iterable of output items.
+    :ivar jobs: Number of threads calling `func` concurrently.
+    :ivar batch_size: Maximum number of items passed to each call of `func`.
+    :ivar queue_size: Maximum number of batches waiting for the stage.
+    :ivar finish: None or a callable returning an iterable of output
+        items.  It is called once after every item has been processed,
+        allowing stages such as grouping to emit what they have collected.
+        Anything held for `finish` is not limited by `queue_size`.
+
+    """
+
+    def __init__(self, name, func, jobs=1, batch_size=1, queue_size=None,
+                 finish=None):
+        if jobs < 1:
+            raise ValueError('Stage %s jobs must be at least 1, not %d' % (name, jobs))
+        if batch_size < 1:
+            raise ValueError('Stage %s batch size must be at least 1, not %d' %
+                             (name, batch_size))
+        if queue_size is None:
+            queue_size = 2 * jobs
+
+        self.name = name
+        self.func = func
+        self.jobs = jobs
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.finish = finish
+
+    def __repr__(self):
+        return '<Stage %s jobs=%d batch_size=%d queue_size=%d>' % (
+            self.name, self.jobs, self.batch_size, self.queue_size)
+
+
+class Pipeline(object):
+    """
+    A sequence of :class:`Stage` objects.
+
+    If a stage raises an exception the remaining items are drained
+    without processing and the exception is raised again by
+    :meth:`Pipeline.run` once every thread has finished.
+
+    """
+
+    def __init__(self, stages):
+        if not stages:
+            raise ValueError('A pipeline needs at least one stage')
+        self.stages = list(stages)
+
+    def run(self, source):
+        """
+        Pass the items of `source` through the stages.  `source` is
+        iterated in a thread of its own.
+
+        :return: An iterator of the items output by the last stage.
+
+        """
+        self._error = None
+        self._error_lock = threading.Lock()
+
+        queues = [Queue(stage.queue_size) for stage in self.stages]
+        queues.append(Queue(self.stages[-1].queue_size))
+
+        threads = [_start(self._feed, source, queues[0], self.stages[0].batch_size)]
+        for i, stage in enumerate(self.stages):
+            if i + 1 < len(self.stages):
+                out_size = self.stages[i + 1].batch_size
+            else:
+                out_size = stage.batch_size
+            remaining = [stage.jobs]
+            for j in range(stage.jobs):
+                threads.append(_start(self._work, stage, queues[i], queues[i + 1],
+                                      out_size, remaining))
+
+        # Keep draining after an error so that no thread blocks on a full queue
+        outq = queues[-1]
+        while True:
+            batch = outq.get()
+            if batch is _END:
+                break
+            if self._error is None:
+                for item in batch:
+                    yield item
+
+        for thread in threads:
+            thread.join()
+
+        if self._error is not None:
+            stage, exc_info = self._error
+            log.error('Pipeline stage %s failed' % stage)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _feed(self, source, outq, batch_size):
+        batcher = _Batcher(outq, batch_size)
+        try:
+            for item in source:
+                if self._error is not None:
+                    break
+                batcher.add(item)
+        except:
+            self._set_error('source', sys.exc_info())
+        batcher.flush()
+        outq.put(_END)
+
+    def _work(self, stage, inq, outq, batch_size, remaining):
+        batcher = _Batcher(outq, batch_size)
+        while True:
+            batch = inq.get()
+            if batch is _END:
+                # Pass the end on to the other workers of this stage
+                inq.put(_END)
+                break
+            if self._error is not None:
+                continue
+            try:
+                for item in stage.func(batch):
+                    batcher.add(item)
+            except:
+                self._set_error(stage.name, sys.exc_info())
+
+        # Output must be queued before the last worker ends the stream
+        batcher.flush()
+        with self._error_lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+
+        if last:
+            if stage.finish is not None and self._error is None:
+                try:
+                    for item in stage.finish():
+                        batcher.add(item)
+                except:
+                    self._set_error(stage.name, sys.exc_info())
+                batcher.flush()
+            outq.put(_END)
+
+    def _set_error(self, stage_name, exc_info):
+        with self._error_lock:
+            if self._error is None:
+                self._error = (stage_name, exc_info)
+
+
+class _Batcher(object):
+    # Collects items into batches put on a queue
+    def __init__(self, queue, batch_size):
+        self.queue = queue
+        self.batch_size = batch_size
+        self.batch = []
+
+    def add(self, item):
+        self.batch.append(item)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.queue.put(self.batch)
+            self.batch = []
+
+
+def _start(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -7,13 +7,20 @@
 
 import os, sys
 import stat
+import errno
 import datetime
 import re
 import itertools
+from contextlib import contextmanager
+from collections import MutableMapping
 
 from drslib.cmip5 import make_translator
 from drslib.translate import TranslationError, drs_dates_overlap
 from drslib import config, mapfile
+from drslib.journal import UpgradeJournal
+from drslib.check_cache import CheckCache
+from drslib.checksums import ChecksumStore
+from drslib.locking import PubDirLock
 
 import logging
 log = logging.getLogger(__name__)
@@ -33,6 +40,10 @@ class PublisherTree(object):
 
     :param latest: Integer version number of latest version or 0
 
+    :ivar versions: A :class:`VersionDict` mapping version numbers to lists
+        of (filepath, drs) for each file in the version or None if the
+        version directory is missing.
+
     """
     #!TODO: At some point we want to check incoming files to see if they are
     #       duplicates of already versioned files.
@@ -53,14 +64,29 @@ class PublisherTree(object):
     DIFF_V2_ONLY = 8
     DIFF_PATH = 16
 
-    def __init__(self, drs, drs_tree):
+    def __init__(self, drs, drs_tree, defer_checks=False):
+        """
+        :param defer_checks: If True do not run the tree checks until the
+            state is next deduced.  :class:`DRSTree` uses this to run the
+            checks of many PublisherTrees concurrently.
 
+        """
         self.drs_tree = drs_tree
         self.drs = drs
         self.state = None
         self._todo = []
-        self.versions = {}
+        self.versions = VersionDict(self._load_version)
         self.latest = 0
+        self._link_maps = {}
+        self._lock = None
+        self._lock_depth = 0
+        self._checksum_store = None
+
+        # Parts of the deduced state that are out of date
+        self._dirty_versions = True
+        self._dirty_todo = True
+        self._dirty_checks = True
+        self._checks_ok = True
 
         from drslib.drs_tree_check import default_checkers
         self._checkers = default_checkers[:]
@@ -69,7 +95,7 @@ class PublisherTree(object):
         drs_fs = self.drs_tree.drs_fs
         self.pub_dir = drs_fs.drs_to_publication_path(self.drs)
 
-        self.deduce_state()
+        self._update_state(with_checks=not defer_checks)
 
     def deduce_state(self):
         """
@@ -77,21 +103,51 @@ class PublisherTree(object):
         tree is in.
 
         """
+        self.drs_tree.listings.invalidate(self.pub_dir, recursive=True)
+        self.invalidate(versions=True, todo=True)
+        self._update_state()
 
-        self._deduce_versions()
-        self._deduce_todo()
+    def invalidate(self, versions=False, todo=False, checks=False):
+        """
+        Mark parts of the deduced state as out of date so that they are
+        deduced again on the next update.  Changing the versions also
+        invalidates the tree checks.
 
-        self._deduce_state()
+        """
+        if versions:
+            self._dirty_versions = True
+            self._dirty_checks = True
+        if todo:
+            self._dirty_todo = True
+        if checks:
+            self._dirty_checks = True
+
+    def _update_state(self, with_checks=True):
+        """
+        Deduce only the parts of the state marked out of date by
+        :meth:`PublisherTree.invalidate`.
+
+        """
+        if self._dirty_versions:
+            self._deduce_versions()
+            self._dirty_versions = False
+            self._dirty_checks = True
+        if self._dirty_todo:
+            self._deduce_todo()
+            self._dirty_todo = False
+
+        self._deduce_state(with_checks)
 
     def _deduce_state(self, with_checks=True):
         """
         Internal API to state deduction assumes versions and TODO are
-        already correct.
+        already correct.  Checks are only run again if the tree has been
+        invalidated since they last ran.
         """
         if not self.versions:
             #!FIXME: this is a hack.  there must be a better way
             # If the files directory is present assume broken rather than initial
-            if os.path.exists(os.path.join(self.pub_dir, self.drs_tree.drs_fs.VERSIONING_FILES_DIR)):
+            if self.drs_tree.listings.exists(os.path.join(self.pub_dir, self.drs_tree.drs_fs.VERSIONING_FILES_DIR)):
                 self.state = self.STATE_BROKEN
             else:                                  
                 self.state = self.STATE_INITIAL
@@ -101,7 +157,10 @@ class PublisherTree(object):
             self.state = self.STATE_VERSIONED
 
         if with_checks and self.state != self.STATE_INITIAL:
-            if not self._check_tree():
+            if self._dirty_checks:
+                self._checks_ok = self._check_tree()
+                self._dirty_checks = False
+            if not self._checks_ok:
                 self.state = self.STATE_BROKEN
 
     def do_version(self, next_version=None):
@@ -109,16 +168,119 @@ class PublisherTree(object):
         Move incoming files into the next version
 
         """
+        # The lock lives in the publication directory
+        self._make_pub_dir()
+        with self.locked():
+            if self._lock.contended and not self._todo:
+                log.info('PublisherTree %s was upgraded by another process' % self.pub_dir)
+                return
 
-        self._setup_versioning()
+            journal = self._journal()
+            if journal.exists():
+                raise Exception('PublisherTree %s has an interrupted upgrade.  '
+                                'Resume it before upgrading again' % self.pub_dir)
 
-        if next_version is None:
-            next_version = self._next_version()
+            self._setup_versioning()
+
+            if next_version is None:
+                next_version = self._next_version()
+
+            log.info('Transfering %s to version %d' % (self.pub_dir, next_version))
+            commands = _plan_commands(self.todo_commands(next_version))
+            journal.begin(next_version, commands)
+            self._do_commands(commands, journal)
+            self._finish_version(journal)
+
+    def resume(self):
+        """
+        Complete an interrupted upgrade by replaying the outstanding
+        commands recorded in the upgrade journal.
+
+        :return: The number of commands replayed.
+
+        """
+        with self.locked():
+            journal = self._journal()
+            if not journal.exists():
+                raise Exception('PublisherTree %s has no interrupted upgrade' % self.pub_dir)
+
+            version, commands, done = journal.read()
+            log.info('Resuming transfer of %s to version %d, %d of %d commands done' %
+                     (self.pub_dir, version, len(done), len(commands)))
+
+            journal.reopen()
+            count = self._do_commands(commands, journal, skip=done)
+            self._finish_version(journal)
+
+        return count
+
+    def has_journal(self):
+        """
+        Return True if an upgrade of this PublisherTree was interrupted.
+
+        """
+        return self._journal().exists()
+
+    @contextmanager
+    def locked(self):
+        """
+        Context manager holding the lock on this PublisherTree's
+        publication directory.  Other processes modifying the same
+        dataset wait until it is released.  The lock is reentrant
+        within a PublisherTree instance.
+
+        If another process held the lock the tree is rescanned after
+        acquiring it, dropping incoming files which that process has
+        already moved.
+
+        """
+        if self._lock_depth == 0:
+            self._lock = PubDirLock(self.pub_dir)
+            self._lock.acquire()
+        self._lock_depth += 1
+        try:
+            if self._lock_depth == 1 and self._lock.contended:
+                self._refresh_after_wait()
+            yield self
+        finally:
+            self._lock_depth -= 1
+            if self._lock_depth == 0:
+                self._lock.release()
+                self._lock = None
+
+    def is_locked(self):
+        """
+        Return True if another process holds the lock on this
+        PublisherTree.
+
+        """
+        return self._lock_depth == 0 and PubDirLock(self.pub_dir).is_locked()
+
+    def wait_unlocked(self, timeout=None):
+        """
+        Wait until no process holds the lock on this PublisherTree then
+        rescan it.
 
-        log.info('Transfering %s to version %d' % (self.pub_dir, next_version))
-        self._do_commands(self.todo_commands(next_version))
+        :return: False if the timeout expired while the lock was held.
+
+        """
+        if not PubDirLock(self.pub_dir).wait(timeout):
+            return False
+        self._refresh_after_wait()
+        return True
+
+    def _refresh_after_wait(self):
+        for path, drs in list(self._todo):
+            if not os.path.exists(path):
+                self.drs_tree.remove_incoming(path, missing_ok=True)
         self.deduce_state()
+
+    def _finish_version(self, journal):
+        # Checks are deferred until the latest link is in place
+        self.invalidate(versions=True, todo=True)
+        self._update_state(with_checks=False)
         self._do_latest()
+        journal.remove()
         self._deduce_state()
 
     def list_todo(self, next_version=None):
@@ -191,40 +353,86 @@ class PublisherTree(object):
         """
         Deduce the difference between two versions or between a version
         and the todo list.
+
+        Real paths of linked files are taken from the link set of each
+        version and each file is only stat()ed once.
+
+        :yield: (DIFF_STATE, file1, file2) in filename order.
         """
-        
-        files1 = {}
-        for filepath, drs in self.versions[v1]:
-            files1[os.path.basename(filepath)] = filepath
+        files1 = self._diff_files(v1)
+        files2 = self._diff_files(v2)
+
+        for filename in sorted(set(files1) | set(files2)):
+            if filename in files1 and filename in files2:
+                path1, real1, size1 = files1[filename]
+                path2, real2, size2 = files2[filename]
+
+                diff_state = self.DIFF_NONE
+                if real1 != real2:
+                    diff_state |= self.DIFF_PATH
+                if size1 != size2:
+                    diff_state |= self.DIFF_SIZE
+                if by_tracking_id and real1[-3:] == real2[-3:] == '.nc':
+                    if _get_tracking_id(real1) != _get_tracking_id(real2):
+                        diff_state |= self.DIFF_TRACKING_ID
+
+                yield diff_state, path1, path2
+            elif filename in files1:
+                yield (self.DIFF_V1_ONLY, files1[filename][0], None)
+            else:
+                yield (self.DIFF_V2_ONLY, None, files2[filename][0])
 
-        if v2 is None:
-            fl = self._todo
+    def _diff_files(self, version=None):
+        """
+        Return a dictionary mapping filename to (filepath, realpath, size)
+        for each file of a version or of the todo list if version is None.
+
+        """
+        if version is None:
+            files = [(filepath, os.path.abspath(filepath)) for filepath, drs in self._todo]
         else:
-            fl = self.versions[v2]
-
-        files2 = {}
-        for filepath, drs in fl:
-            files2[os.path.basename(filepath)] = filepath
-
-        for file in set(files1.keys() + files2.keys()):
-            if file in  files1 and file in files2:
-                yield (self._diff_file(files1[file], files2[file], 
-                                       by_tracking_id),
-                       files1[file], files2[file])
-            elif file in files1:
-                yield (self.DIFF_V1_ONLY, files1[file], None)
-            else:
-                yield (self.DIFF_V2_ONLY, None, files2[file])
+            if version not in self.versions:
+                raise Exception("Version %d not present in PublisherTree %s" % (version, self.pub_dir))
+            version_dir = os.path.join(self.pub_dir, 'v%d' % version)
+            files = [(os.path.normpath(os.path.join(version_dir, link_subdir, filename)), realpath)
+                     for filename, (realpath, link_subdir) in self._link_map(version).items()]
+
+        ret = {}
+        for filepath, realpath in files:
+            try:
+                size = _get_size(realpath)
+            except OSError:
+                size = None
+            ret[os.path.basename(filepath)] = (filepath, realpath, size)
+
+        return ret
 
+    def version_to_mapfile(self, version, fh=None, checksum_func=None, checksum_type=None):
+        """
+        Write the mapfile of a version.  Checksums of files that are
+        unchanged since the last mapfile of this dataset was written,
+        usually that of the previous version, are not calculated again.
+
+        :param checksum_type: The type of checksum returned by
+            checksum_func.  See :func:`drslib.mapfile.write_mapfile`.
 
-    def version_to_mapfile(self, version, fh=None, checksum_func=None):
+        """
         if fh is None:
             fh = sys.stdout
 
         if version not in self.versions:
             raise Exception("Version %d not present in PublisherTree %s" % (version, self.pub_dir))
 
-        mapfile.write_mapfile(self.versions[version], fh, checksum_func)
+        if not checksum_func:
+            mapfile.write_mapfile(self.versions[version], fh)
+            return
+
+        # Reuse checksums from the last mapfile of this dataset
+        index = mapfile.MapfileIndex(self.pub_dir)
+        previous = index.load()[1]
+        entries = mapfile.write_mapfile(self.versions[version], fh, checksum_func,
+                                        self.checksum_store(), previous, checksum_type)
+        index.save(version, entries)
 
     def version_drs(self, version=None):
         """
@@ -311,10 +519,12 @@ class PublisherTree(object):
 
     def repair(self):
         if self.has_failures():
-            log.debug('BEGIN repairs')
-            self._repair_tree()
-            log.debug('END repairs')
-            self._deduce_state(with_checks=True)
+            with self.locked():
+                log.debug('BEGIN repairs')
+                self._repair_tree()
+                log.debug('END repairs')
+                self.invalidate(checks=True)
+                self._deduce_state(with_checks=True)
 
     #-------------------------------------------------------------------
     # These methods could be considered protected.  They are designed
@@ -363,13 +573,36 @@ class PublisherTree(object):
         log.info('Setting latest to %s' % latest_dir)
         latest_lnk = os.path.join(self.pub_dir, self.drs_tree.drs_fs.VERSIONING_LATEST_DIR)
 
-        if os.path.exists(latest_lnk):
-            os.remove(latest_lnk)
-        os.symlink(latest_dir, latest_lnk)
+        with self.locked():
+            if os.path.lexists(latest_lnk):
+                os.remove(latest_lnk)
+            os.symlink(latest_dir, latest_lnk)
+            self.drs_tree.listings.added(latest_lnk)
 
     
-    def _do_commands(self, commands):
-        for cmd, src, dest in commands:
+    def _do_commands(self, commands, journal=None, skip=None):
+        """
+        Execute a sequence of commands as yielded by todo_commands().
+
+        :param journal: If given each command is recorded in this
+            :class:`drslib.journal.UpgradeJournal` as it completes.
+        :param skip: A set of command indexes to skip.  If given the commands
+            are being replayed from a journal and any command that has
+            already taken effect is not repeated.
+        :return: The number of commands executed.
+
+        """
+        count = 0
+        for i, (cmd, src, dest) in enumerate(commands):
+            if skip is not None:
+                if i in skip:
+                    continue
+                if self._is_done(cmd, src, dest):
+                    log.debug('Command already done %s %s %s' % (cmd, src, dest))
+                    if journal:
+                        journal.mark_done(i)
+                    continue
+
             if cmd == self.CMD_MOVE:
                 self._do_mv(src, dest)
             elif cmd == self.CMD_LINK:
@@ -379,22 +612,100 @@ class PublisherTree(object):
             else:
                 raise Exception('Internal error: Unrecognised command type %s' % cmd)
 
+            if journal:
+                journal.mark_done(i)
+            count += 1
+
+        return count
+
+    def _is_done(self, cmd, src, dest):
+        """
+        Detect whether a journaled command took effect before the journal
+        recorded it.
+
+        """
+        if cmd == self.CMD_MOVE:
+            if not os.path.exists(src) and os.path.exists(dest):
+                # Make sure the file doesn't linger in incoming
+                self.drs_tree.remove_incoming(src, missing_ok=True)
+                return True
+        elif cmd == self.CMD_LINK:
+            if os.path.islink(dest) and os.readlink(dest) == src:
+                return True
+        elif cmd == self.CMD_MKDIR:
+            if os.path.isdir(dest):
+                return True
+
+        return False
+
+    def _journal(self):
+        return UpgradeJournal(self.pub_dir)
+
     def _do_mv(self, src, dest):
         cmd = '%s %s %s' % (self.drs_tree._move_cmd, src, dest)
-        if os.path.exists(dest):
+        if self.drs_tree.listings.exists(dest):
             log.warn('Overwriting existing file: %s' % cmd)
         else:
             log.info(cmd)
-        #!TODO: Trap output!
-        status = os.system(cmd)
-        if status != 0:
-            log.warn('System call failed: %d' % status)
+
+        if not (self.drs_tree._ingest_checksum and self._do_mv_checksum(src, dest)):
+            #!TODO: Trap output!
+            status = os.system(cmd)
+            if status != 0:
+                # Stop before the move is recorded as done
+                raise Exception('System call failed: %d: %s' % (status, cmd))
+        self.drs_tree.listings.added(dest)
+        # Copying move commands leave src in place
+        if not os.path.lexists(src):
+            self.drs_tree.listings.removed(src)
 
         # Remove src from incoming
         self.drs_tree.remove_incoming(src)
 
+    def _do_mv_checksum(self, src, dest):
+        """
+        Move or copy a file calculating its checksum as it is copied.
+        Files moved within a filesystem are renamed without a checksum.
+        Only move commands of plain ``mv`` or ``cp`` are handled here.
+        Commands with options are run as configured.
+
+        :return: False if the move command should be run instead.
+
+        """
+        args = self.drs_tree._move_cmd.split()
+        if len(args) != 1:
+            return False
+        prog = os.path.basename(args[0])
+        if prog not in ['mv', 'cp']:
+            return False
+
+        if prog == 'mv':
+            try:
+                os.rename(src, dest)
+                return True
+            except OSError, e:
+                if e.errno != errno.EXDEV:
+                    raise
+
+        checksum_type, checksum = mapfile.copy_with_checksum(src, dest, 
+                                                             self.drs_tree._ingest_checksum)
+        self.checksum_store().add(dest, checksum_type, checksum)
+        if prog == 'mv':
+            os.remove(src)
+
+        return True
+
+    def checksum_store(self):
+        """
+        Return the :class:`drslib.checksums.ChecksumStore` of this dataset.
+
+        """
+        if self._checksum_store is None:
+            self._checksum_store = ChecksumStore(self.pub_dir)
+        return self._checksum_store
+
     def _do_link(self, src, dest):
-        if os.path.exists(dest):
+        if self.drs_tree.listings.exists(dest):
             
             log.warning('Moving symlink %s' % dest)
             os.remove(dest)
@@ -402,12 +713,14 @@ class PublisherTree(object):
         log.info('Linking %s %s' % (src, dest))
 
         os.symlink(src, dest)
+        self.drs_tree.listings.added(dest)
 
     def _do_mkdir(self, ddir):
-        if not os.path.exists(ddir):
+        if not self.drs_tree.listings.exists(ddir):
 
             log.info('Creating %s' % ddir)
             os.makedirs(ddir)
+            self.drs_tree.listings.added(ddir)
         else:
             log.warning('Directory already exists %s' % ddir)
 
@@ -428,13 +741,22 @@ class PublisherTree(object):
         if from_seq is None:
             from_seq = []
 
+        # Each link directory is only tested and made once
+        link_dirs = set()
+        def mkdir_commands(link_dir):
+            if link_dir not in link_dirs:
+                link_dirs.add(link_dir)
+                if not self.drs_tree.listings.exists(link_dir):
+                    yield self.CMD_MKDIR, None, link_dir
+
         done = set()
         for filepath, link_dir in itertools.chain(from_seq,
-                                                  self.drs_tree.drs_fs.iter_files_with_links(self.pub_dir, version)):
+                                                  self.drs_tree.drs_fs.iter_files_with_links(self.pub_dir, version,
+                                                                                             listings=self.drs_tree.listings)):
             filename = os.path.basename(filepath)
 
-            if not os.path.exists(link_dir):
-                yield self.CMD_MKDIR, None, link_dir
+            for command in mkdir_commands(link_dir):
+                yield command
 
             # Make relative to dest
             dest = os.path.join(link_dir, filename)
@@ -447,21 +769,98 @@ class PublisherTree(object):
         # Promote all files from the previous version
 
         #!TODO: overlap detection removed.  See tag 0.3.0a6 for old implementation.
-        for prev_version in self.prev_versions(version):
-            for filepath, link_dir in self.drs_tree.drs_fs.iter_files_with_links(self.pub_dir, prev_version, version):
-                filename = os.path.basename(filepath)
+        prev_versions = self.prev_versions(version)
+        if not prev_versions:
+            return
 
-                if filename in done:
-                    continue
+        version_dir = os.path.join(self.pub_dir, 'v%d' % version)
+        link_map = self._link_map(prev_versions[0])
+        for filename in sorted(link_map):
+            if filename in done:
+                continue
 
-                if not os.path.exists(link_dir):
-                    yield self.CMD_MKDIR, None, link_dir
+            filepath, link_subdir = link_map[filename]
+            link_dir = os.path.normpath(os.path.join(version_dir, link_subdir))
+
+            for command in mkdir_commands(link_dir):
+                yield command
+
+            # Make relative to dest
+            dest = os.path.join(link_dir, filename)
+            src = os.path.relpath(filepath, link_dir)
+
+            yield self.CMD_LINK, src, dest
+
+    def _link_map(self, version):
+        """
+        Return the resolved link set of a version as a dictionary mapping
+        filename to (filepath, link_subdir) where filepath is the real file
+        and link_subdir is the directory of the link relative to the version
+        directory.
+
+        The link set is read from the version directory if it exists.  Only
+        if it is missing, or for links whose target does not exist, is the
+        link set derived from the files directory and the link set of the
+        previous version.  Results are cached until versions are next
+        deduced.
+
+        """
+        try:
+            return self._link_maps[version]
+        except KeyError:
+            pass
+
+        drs_fs = self.drs_tree.drs_fs
+        listings = self.drs_tree.listings
+        version_dir = os.path.join(self.pub_dir, 'v%d' % version)
+        if listings.exists(version_dir):
+            link_map = {}
+            broken = []
+            for dirpath, dirnames, filenames in listings.walk(version_dir):
+                link_subdir = os.path.relpath(dirpath, version_dir)
+                for filename in filenames:
+                    if drs_fs._is_ignored(filename):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    if not os.path.islink(path):
+                        continue
+                    filepath = os.path.normpath(os.path.join(dirpath, os.readlink(path)))
+                    link_map[filename] = (filepath, link_subdir)
+                    if not listings.exists(filepath):
+                        broken.append(filename)
+
+            # Don't propagate broken links into later versions
+            if broken:
+                derived = self._derive_link_map(version)
+                for filename in broken:
+                    if filename in derived:
+                        log.warning('Link to %s in %s is broken, using %s' %
+                                    (filename, version_dir, derived[filename][0]))
+                        link_map[filename] = derived[filename]
+        else:
+            link_map = self._derive_link_map(version)
+
+        self._link_maps[version] = link_map
+        return link_map
 
-                # Make relative to dest
-                dest = os.path.join(link_dir, filename)
-                src = os.path.relpath(filepath, link_dir)
+    def _derive_link_map(self, version):
+        """
+        Derive the link set of a version from the files directory and the
+        link set of the previous version.
 
-                yield self.CMD_LINK, src, dest
+        """
+        drs_fs = self.drs_tree.drs_fs
+        version_dir = os.path.join(self.pub_dir, 'v%d' % version)
+        link_map = {}
+        prev_versions = self.prev_versions(version)
+        if prev_versions:
+            link_map.update(self._link_map(prev_versions[0]))
+        for filepath, link_dir in drs_fs.iter_files_with_links(self.pub_dir, version,
+                                                               listings=self.drs_tree.listings):
+            link_map[os.path.basename(filepath)] = (filepath,
+                                                    os.path.relpath(link_dir, version_dir))
+
+        return link_map
 
     #-------------------------------------------------------------------------
     # Versioning internal methods
@@ -471,14 +870,24 @@ class PublisherTree(object):
         Do initial configuration of directory tree to support versioning.
 
         """
-        if not os.path.exists(self.pub_dir):
-            log.info("New PublisherTree being created at %s" % self.pub_dir)
-            os.makedirs(self.pub_dir)
+        self._make_pub_dir()
 
         path = os.path.join(self.pub_dir, self.drs_tree.drs_fs.VERSIONING_FILES_DIR)
         if not os.path.exists(path):
             log.info('Initialising %s for versioning.' % self.pub_dir)
             os.mkdir(path)
+            self.drs_tree.listings.added(path)
+
+    def _make_pub_dir(self):
+        if not os.path.exists(self.pub_dir):
+            log.info("New PublisherTree being created at %s" % self.pub_dir)
+            try:
+                os.makedirs(self.pub_dir)
+            except OSError:
+                # May have been created concurrently
+                if not os.path.isdir(self.pub_dir):
+                    raise
+            self.drs_tree.listings.added(self.pub_dir)
 
     def _next_version(self):
         if config.version_by_date:
@@ -488,6 +897,7 @@ class PublisherTree(object):
             return self.latest+1
 
     def _deduce_versions(self):
+        self._link_maps = {}
         if config.version_by_date:
             return self._deduce_date_versions()
         else:
@@ -495,17 +905,20 @@ class PublisherTree(object):
             
     def _deduce_date_versions(self):
         self.latest = 0
-        self.versions = {}
+        self.versions = VersionDict(self._load_version)
+        listings = self.drs_tree.listings
         # Bail out if pub_dir doesn't exist yet.
         fdir = os.path.join(self.pub_dir, self.drs_tree.drs_fs.VERSIONING_FILES_DIR)
-        if not os.path.exists(fdir):
+        try:
+            filedirs = listings.listdir(fdir)
+        except OSError:
             return
 
         # Version directories may not exist so initially deduce
         # versions from the files directory
         #!TODO: Revise for CORDEX
         versions = set()
-        for d in os.listdir(fdir):
+        for d in filedirs:
             subdrs = self.drs_tree.drs_fs.storage_to_drs(os.path.join(self.drs_tree.drs_fs.VERSIONING_FILES_DIR, d))
             
             assert subdrs.version is not None
@@ -513,13 +926,13 @@ class PublisherTree(object):
             versions.add(subdrs.version)
 
         # Also include versions without files/*_$VERSION
-        versions.update(int(x[1:]) for x in os.listdir(self.pub_dir) if x[0] == 'v')
+        entries = set(listings.listdir(self.pub_dir))
+        versions.update(int(x[1:]) for x in entries if x[0] == 'v')
 
         for version in versions:
-            vpath = os.path.join(self.pub_dir, 'v%d' % version)
-            if os.path.exists(vpath):
+            if 'v%d' % version in entries:
                 self.latest = max(version, self.latest)
-                self.versions[version] = self._make_version_list(vpath)
+                self.versions.add_unloaded(version)
             else:
                 # Mark missing versions as None
                 self.versions[version] = None
@@ -527,21 +940,27 @@ class PublisherTree(object):
 
     def _deduce_old_versions(self):
         i = 1
-        self.versions = {}
+        self.versions = VersionDict(self._load_version)
+        try:
+            entries = set(self.drs_tree.listings.listdir(self.pub_dir))
+        except OSError:
+            return
         while True:
-            vpath = os.path.join(self.pub_dir, 'v%d' % i)
-            if not os.path.exists(vpath):
+            if 'v%d' % i not in entries:
                 return
             else:
                 self.latest = i
 
-            self.versions[i] = self._make_version_list(vpath)
+            self.versions.add_unloaded(i)
             i += 1
+
+    def _load_version(self, version):
+        log.debug('Loading file list of %s version %d' % (self.drs.to_dataset_id(), version))
+        return self._make_version_list(os.path.join(self.pub_dir, 'v%d' % version))
         
     def _make_version_list(self, vpath):
         vlist = []
-        for dirpath, dirnames, filenames in os.walk(vpath,
-                                                    topdown=False):
+        for dirpath, dirnames, filenames in self.drs_tree.listings.walk(vpath):
             for filename in filenames:
                 # Ignore files matching a regexp
                 if re.match(self.drs_tree.drs_fs.IGNORE_FILES_REGEXP, filename):
@@ -583,30 +1002,6 @@ class PublisherTree(object):
                  (len(self._todo), self.drs))
                 
 
-    def _diff_file(self, filepath1, filepath2, by_tracking_id=False):
-        diff_state = self.DIFF_NONE
-
-        fp1 = os.path.realpath(filepath1)
-        fp2 = os.path.realpath(filepath2)
-
-        if fp1 != fp2:
-            diff_state |= self.DIFF_PATH
-
-        # Check files are the same size
-        if _get_size(fp1) != _get_size(fp2):
-            diff_state |= self.DIFF_SIZE
-
-        # Check by tracking_id
-        if by_tracking_id:
-            if fp1[-3:] == fp2[-3:] == '.nc':
-                if _get_tracking_id(fp1) != _get_tracking_id(fp2):
-                    diff_state |= self.DIFF_TRACKING_ID
-
-        #!TODO: what about md5sum?  This would be slow, particularly as
-        #       esgpublish does it anyway.
-
-        return diff_state
-
     #-------------------------------------------------------------------------
     # Tree checking methods
 
@@ -620,8 +1015,23 @@ class PublisherTree(object):
         """
         ret = True
         self._checker_failures = []
+
+        # Cached verdicts are not used when repairing as failing checkers
+        # are needed to make the fixes
+        cache = None
+        passed = set()
+        if self.drs_tree._check_cache and not fix_hook and os.path.isdir(self.pub_dir):
+            cache = CheckCache(self.pub_dir, self.drs_tree.listings)
+            fingerprint = cache.fingerprint(all_versions=not config.check_latest)
+            if not self.drs_tree._recheck:
+                passed = cache.passed(fingerprint)
+
         for Checker in self._checkers:
             checker = Checker()
+            if checker.get_name() in passed:
+                log.debug('SKIP Checking with %s: unchanged since last pass' % checker.get_name())
+                checker._state_pass()
+                continue
             log.debug('BEGIN Checking with %s' % checker.get_name())
             if not checker.check(self):
                 log.warning('Checker %s failed: %s' % (checker.get_name(), 
@@ -630,8 +1040,13 @@ class PublisherTree(object):
                 if fix_hook:
                     fix_hook(checker)
                 ret = False
+            else:
+                passed.add(checker.get_name())
             log.debug('END Checking with %s' % checker.get_name())
 
+        if cache is not None:
+            cache.save(fingerprint, passed)
+
         return ret
 
     def _repair_tree(self):
@@ -656,6 +1071,83 @@ class PublisherTree(object):
 
 
 
+class VersionDict(MutableMapping):
+    """
+    A dictionary of version number to file list where file lists are
+    loaded on first access.  Version numbers are known without walking
+    any version directory so iterating over keys, membership tests and
+    len() never load a file list.  Every other way of reading values,
+    including copy() and dict(), loads them.
+
+    """
+
+    _UNLOADED = object()
+
+    def __init__(self, loader):
+        """
+        :param loader: A callable taking a version number and returning
+            its file list.
+
+        """
+        self._loader = loader
+        self._data = {}
+
+    def add_unloaded(self, version):
+        self._data[version] = self._UNLOADED
+
+    def is_loaded(self, version):
+        return self._data[version] is not self._UNLOADED
+
+    def __getitem__(self, version):
+        value = self._data[version]
+        if value is self._UNLOADED:
+            value = self._data[version] = self._loader(version)
+        return value
+
+    def __setitem__(self, version, value):
+        self._data[version] = value
+
+    def __delitem__(self, version):
+        del self._data[version]
+
+    def __contains__(self, version):
+        return version in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def __repr__(self):
+        return '<VersionDict %s>' % ', '.join(
+            '%s%s' % (v, '' if self.is_loaded(v) else ' (unloaded)')
+            for v in sorted(self))
+
+
+def _plan_commands(commands):
+    """
+    Expand a command generator into a list suitable for journaling.
+
+    The generator only yields CMD_MKDIR commands for directories that
+    do not exist when it is evaluated.  Evaluating it up-front can
+    therefore yield the same directory more than once.
+
+    """
+    plan = []
+    mkdirs = set()
+    for cmd, src, dest in commands:
+        if cmd == PublisherTree.CMD_MKDIR:
+            if dest in mkdirs:
+                continue
+            mkdirs.add(dest)
+        plan.append((cmd, src, dest))
+
+    return plan
+
 def _get_tracking_id(filename):
     import cdms2
     ds = cdms2.open(filename)
@@ -6,9 +6,11 @@ Implement CORDEX specific DRS scheme.
 import re
 import os
 
-from drslib.drs import BaseDRS, DRSFileSystem, _ensemble_to_rip, _rip_to_ensemble
+from drslib.drs import (BaseDRS, DRSFileSystem, _ensemble_to_rip, _rip_to_ensemble,
+                        _memoize_decoder)
 from drslib import config
 from drslib.exceptions import TranslationError
+from drslib.translate import _to_date, _from_date
 
 
 
@@ -24,8 +26,6 @@ class SpecsDRS(BaseDRS):
 
     @classmethod
     def _encode_component(klass, component, value):
-        from drslib.translate import _from_date
-
         if value is None:
             return '%'
         elif component == 'realm':
@@ -49,8 +49,6 @@ class SpecsDRS(BaseDRS):
 
     @classmethod
     def _decode_component(cls, component, value):
-        from drslib.translate import _to_date
-        
         if value == '%':
             ret = None
         elif component == 'ensemble':
@@ -90,35 +88,57 @@ class SpecsDRS(BaseDRS):
         return ret
 
 
+# var_table_model_exptfamily_startdate_ensemble_subset
+# E.g. pr_day_MPI-ESM-LR_decadal_series1_S19610101_r1i1p1_19610101-19701231.nc 
+# The experiment may contain "_" and is delimited by the start date.
+_filename_re = re.compile(r'(?P<variable>[^_]*)_(?P<table>[^_]*)_(?P<model>[^_]*)_'
+                          r'(?P<experiment>.*?)_(?P<start_date>S\d{8})_'
+                          r'(?P<ensemble>[^_]*?)(?:_(?P<subset>.*?))?\.nc$')
+
+
 class SpecsFileSystem(DRSFileSystem):
     drs_cls = SpecsDRS
 
+    # The start date component is unique to SPECS
+    FILENAME_SIGNATURE = r'[^_]+_[^_]+_[^_]+_.+?_S\d{8}_r\d+i\d+p\d+(?:_[^_]+)?\.nc'
+
     def filename_to_drs(self, filename):
         """
         Return a DRS instance deduced from a filename.
 
         """
-        # var_table_model_exptfamily_startdate_ensemble_subset
-        # E.g. pr_day_MPI-ESM-LR_decadal_series1_S19610101_r1i1p1_19610101-19701231.nc 
+        return self._filename_to_drs(filename, self.drs_cls._decode_component)
 
+    def filenames_to_drs(self, filenames):
+        decode = _memoize_decoder(self.drs_cls)
+        for filename in filenames:
+            try:
+                yield filename, self._filename_to_drs(filename, decode)
+            except TranslationError:
+                yield filename, None
+
+    def _filename_to_drs(self, filename, decode):
         if self._is_ignored(filename):
             raise TranslationError()
 
-        m = re.match(r'(?P<variable>.*?)_(?P<table>.*?)_(?P<model>.*?)_(?P<experiment>.*?)_(?P<start_date>S\d{8}?)_(?P<ensemble>.*?)(?:_(?P<subset>.*?))?\.nc', filename)
-        
+        m = _filename_re.match(filename)
         if not m:
             raise TranslationError()
 
-        comp_dict = m.groupdict()
+        (variable, table, model, experiment, start_date, 
+         ensemble, subset) = m.groups()
 
         drs = self.drs_cls(activity='specs')
-        for component in ['variable', 'table', 'model', 'experiment', 'start_date',
-                          'ensemble', 'subset']:
-            comp_val = comp_dict[component]
-            if comp_val is not None:
-                drs[component] = drs._decode_component(component, comp_val)
-            else:
-                drs[component] = None
+        drs['variable'] = decode('variable', variable)
+        drs['table'] = decode('table', table)
+        drs['model'] = decode('model', model)
+        drs['experiment'] = decode('experiment', experiment)
+        drs['start_date'] = decode('start_date', start_date)
+        drs['ensemble'] = decode('ensemble', ensemble)
+        if subset is not None:
+            drs['subset'] = decode('subset', subset)
+        else:
+            drs['subset'] = None
 
         return drs
 
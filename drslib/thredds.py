@@ -11,19 +11,40 @@ Things to check:
 6. tracking_id is present
 7. Check product assignement is right.
 
-Currently implemented: 1-3
+Currently implemented: 1-6.  Product assignment (7) and consistency
+with the files on disk are checked by reconciling all catalogs against a
+DRS tree in bulk with :func:`reconcile`.
+
+Each catalog is parsed once into a :class:`CatalogRecord` holding the
+dataset properties and the access details of each file.  All checks
+run against the record.
+
+Catalogs can be checked concurrently with :func:`check_catalogs`.
+Catalogs are fetched by :class:`CatalogFetcher` which reuses HTTP
+connections and can cache catalogs on disk, revalidating them with
+conditional GET requests.
 
 """
 
 import sys
 import os
 import re
+import json
+import hashlib
+import tempfile
+import threading
+import socket
+import httplib
+import urllib
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
 from lxml import etree as ET
 from drslib.drs import CmipDRS
 from drslib.cmip5 import make_translator
 import urlparse
 from optparse import OptionParser
+from drslib import config, mapfile
 
 import logging
 log = logging.getLogger(__name__)
@@ -31,6 +52,13 @@ log = logging.getLogger(__name__)
 THREDDS_NS = 'http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0'
 XLINK_NS = 'http://www.w3.org/1999/xlink'
 
+_DATASET = '{%s}dataset' % THREDDS_NS
+_PROPERTY = '{%s}property' % THREDDS_NS
+_SERVICE = '{%s}service' % THREDDS_NS
+_SERVICE_NAME = '{%s}serviceName' % THREDDS_NS
+_DATA_SIZE = '{%s}dataSize' % THREDDS_NS
+_CATALOG_REF = '{%s}catalogRef' % THREDDS_NS
+
 usage = """%prog [options] thredds ...
 
 thredds:
@@ -66,6 +94,13 @@ class CheckNotPossible(Exception):
     """
     pass
 
+class CatalogFetchError(Exception):
+    """
+    Raised when a catalog cannot be retrieved.
+
+    """
+    pass
+
 class ThreddsCheck(object):
     """
     Base class of all checks, defining the interface.
@@ -80,53 +115,670 @@ class ThreddsCheck(object):
         self.environ = environ
 
 
-    def check(self, etree):
+    def check(self, record):
         """
-        Check the THREDDS catalogue represented by an ElementTree object.
+        Check the THREDDS catalogue represented by a :class:`CatalogRecord`.
 
         """
         pass
 
 
+class CatalogRecord(object):
+    """
+    The content of a dataset catalog needed by the checks.
+
+    :ivar dataset_count: The number of top-level dataset elements.
+    :ivar dataset_id: The ID attribute of the top-level dataset.
+    :ivar properties: A dictionary of the top-level dataset properties.
+    :ivar files: A list of :class:`CatalogFile` objects for the file-level
+        datasets.
+    :ivar aggregations: A list of :class:`CatalogFile` objects for the
+        aggregation datasets.
+    :ivar services: A dictionary of service names to base URLs.
+
+    """
+
+    def __init__(self):
+        self.dataset_count = 0
+        self.dataset_id = None
+        self.properties = {}
+        self.files = []
+        self.aggregations = []
+        self.services = {}
+
+    @classmethod
+    def parse(cls, source):
+        """
+        Build a record from a catalog file path or file-like object.
+
+        The catalog is read incrementally and elements are discarded
+        once processed so that very large catalogs can be read in
+        bounded memory.
+
+        """
+        record = cls()
+
+        # One entry per open dataset element.  None marks the
+        # top-level dataset, otherwise the entry is a CatalogFile.
+        stack = []
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                if tag == _DATASET:
+                    if stack:
+                        stack.append(CatalogFile(elem.get('ID'), elem.get('name'), 
+                                                 elem.get('urlPath')))
+                    else:
+                        record.dataset_count += 1
+                        if record.dataset_id is None:
+                            record.dataset_id = elem.get('ID')
+                        stack.append(None)
+                elif tag == _SERVICE:
+                    record.services[elem.get('name')] = elem.get('base')
+                continue
+
+            if tag == _DATASET:
+                cfile = stack.pop()
+                if cfile is None:
+                    pass
+                elif 'aggregation_id' in cfile.properties:
+                    record.aggregations.append(cfile)
+                else:
+                    record.files.append(cfile)
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+                continue
+
+            # Only direct children of datasets are of interest
+            if not stack or elem.getparent().tag != _DATASET:
+                continue
+            target = stack[-1]
+            if tag == _PROPERTY:
+                if target is None:
+                    properties = record.properties
+                else:
+                    properties = target.properties
+                # As with find(), the first property of each name wins
+                properties.setdefault(elem.get('name'), elem.get('value'))
+            elif target is not None:
+                if tag == _SERVICE_NAME:
+                    target.service = elem.text
+                elif tag == _DATA_SIZE:
+                    target.data_size = (elem.text, elem.get('units'))
+
+        return record
+
+    @classmethod
+    def from_etree(cls, etree):
+        """
+        Build a record from an already parsed catalog.
+
+        """
+        return cls.parse(StringIO(ET.tostring(etree)))
+
+    def get_property(self, name):
+        """
+        Return the value of property name of the top-level dataset.
+
+        :raises InvalidThreddsException: if the property is missing or
+            there is not exactly one top-level dataset.
+
+        """
+        if self.dataset_count != 1:
+            raise InvalidThreddsException("More than one top-level dataset")
+
+        try:
+            return self.properties[name]
+        except KeyError:
+            raise InvalidThreddsException("Property %s not found in dataset %s" % 
+                                          (name, self.dataset_id))
+
+
+class CatalogFile(object):
+    """
+    A file-level dataset within a :class:`CatalogRecord`.
+
+    """
+
+    def __init__(self, id, name, url_path):
+        self.id = id
+        self.name = name
+        self.url_path = url_path
+        self.service = None
+        self.data_size = None
+        self.properties = {}
+
+    @property
+    def size(self):
+        size = self.properties.get('size')
+        if size is not None:
+            size = int(size)
+        return size
+
+    @property
+    def checksum(self):
+        return self.properties.get('checksum')
+
+    @property
+    def checksum_type(self):
+        return self.properties.get('checksum_type')
+
+    @property
+    def tracking_id(self):
+        return self.properties.get('tracking_id')
+
 
-def run_checks(etree, checks, environ=None):
+
+# Check result states
+CHECK_OK = 'ok'
+CHECK_FAILED = 'failed'
+CHECK_ABORTED = 'aborted'
+
+def run_checks(catalog, checks, environ=None, results=None):
     """
-    Run a sequence of checks on a THREDDS catalogue as an ElementTree.
+    Run a sequence of checks on a THREDDS catalogue as a
+    :class:`CatalogRecord` or an ElementTree.
     InvalidThreddsExceptions are converted to log messages.
+
+    :param results: If given a list to which a tuple (check_name, state,
+        message) is appended for each check.  state is one of CHECK_OK,
+        CHECK_FAILED or CHECK_ABORTED.
  
     """
     if environ is None:
         environ = {}
 
+    if isinstance(catalog, CatalogRecord):
+        record = catalog
+    else:
+        record = CatalogRecord.from_etree(catalog)
+
     for CheckClass in checks:
         check = CheckClass(environ)
+        name = CheckClass.__name__
         try:
-            check.check(etree)
+            check.check(record)
         except InvalidThreddsException, e:
             log.error(e)
+            result = (name, CHECK_FAILED, str(e))
         except CheckNotPossible:
-            log.warn('Check %s aborted' % CheckClass.__name__)
+            log.warn('Check %s aborted' % name)
+            result = (name, CHECK_ABORTED, None)
         else:
-            log.info('Check %s succeeded' % CheckClass.__name__)
+            log.info('Check %s succeeded' % name)
+            result = (name, CHECK_OK, None)
+
+        if results is not None:
+            results.append(result)
 
     return environ
 
+
+def check_catalogs(catalog_urls, checks, fetcher=None, jobs=1):
+    """
+    Run checks on many catalogs using a pool of worker threads.
+
+    :param catalog_urls: An iterable of catalog URLs or file paths.
+    :param fetcher: A :class:`CatalogFetcher`.  By default catalogs are
+        fetched without caching.
+    :param jobs: The number of catalogs to fetch and check concurrently.
+    :return: An iterator of summary dictionaries, one per catalog in the
+        order of catalog_urls.  Each has the keys *catalog*, *status*
+        (CHECK_OK or CHECK_FAILED), *checks* (a list of dictionaries
+        with the keys *check*, *status* and *message*) and *error*
+        (set if the catalog could not be read).
+
+    """
+    if fetcher is None:
+        fetcher = CatalogFetcher()
+
+    def check_one(url):
+        log.info('Checking %s' % url)
+        summary = {'catalog': url, 'status': CHECK_OK, 
+                   'checks': [], 'error': None}
+        try:
+            record = fetcher.record(url)
+        except (CatalogFetchError, EnvironmentError, 
+                httplib.HTTPException, ET.XMLSyntaxError), e:
+            log.error('Cannot read catalog %s: %s' % (url, e))
+            summary['status'] = CHECK_FAILED
+            summary['error'] = str(e)
+            return summary
+
+        results = []
+        run_checks(record, checks, results=results)
+        for name, state, message in results:
+            summary['checks'].append({'check': name, 'status': state,
+                                      'message': message})
+            if state != CHECK_OK:
+                summary['status'] = CHECK_FAILED
+
+        return summary
+
+    if jobs <= 1:
+        for url in catalog_urls:
+            yield check_one(url)
+        return
+
+    pool = ThreadPool(jobs)
+    try:
+        for summary in pool.imap(check_one, catalog_urls):
+            yield summary
+    finally:
+        pool.close()
+        pool.join()
+
+
+def fetch_records(catalog_urls, fetcher=None, jobs=1):
+    """
+    Read many catalogs using a pool of worker threads.
+
+    :return: An iterator of (url, record) in the order of catalog_urls.
+        Catalogs that cannot be read are logged and skipped.
+
+    """
+    if fetcher is None:
+        fetcher = CatalogFetcher()
+
+    def fetch_one(url):
+        try:
+            return url, fetcher.record(url)
+        except (CatalogFetchError, EnvironmentError, 
+                httplib.HTTPException, ET.XMLSyntaxError), e:
+            log.error('Cannot read catalog %s: %s' % (url, e))
+            return url, None
+
+    if jobs <= 1:
+        results = (fetch_one(url) for url in catalog_urls)
+    else:
+        pool = ThreadPool(jobs)
+        results = pool.imap(fetch_one, catalog_urls)
+
+    try:
+        for url, record in results:
+            if record is not None:
+                yield url, record
+    finally:
+        if jobs > 1:
+            pool.close()
+            pool.join()
+
+
+# Reconciliation mismatch kinds
+MISMATCH_NOT_ON_DISK = 'dataset_not_on_disk'
+MISMATCH_NOT_IN_CATALOG = 'dataset_not_in_catalog'
+MISMATCH_PRODUCT = 'product'
+MISMATCH_FILE_NOT_ON_DISK = 'file_not_on_disk'
+MISMATCH_FILE_NOT_IN_CATALOG = 'file_not_in_catalog'
+MISMATCH_PATH = 'path'
+MISMATCH_SIZE = 'size'
+MISMATCH_CHECKSUM = 'checksum'
+
+def reconcile(records, drs_tree, checksum_func=None):
+    """
+    Cross-check catalog records against the versions of all
+    PublisherTrees in a DRSTree.
+
+    Catalogs and on-disk versions are joined on (dataset_id, version)
+    in memory.  Sizes and checksums of files present in both are taken
+    from those recorded in each dataset's checksum store and mapfile
+    index.  The filesystem is only consulted for files with no record.
+
+    :param records: An iterable of :class:`CatalogRecord` objects.
+    :param drs_tree: A :class:`drslib.drs_tree.DRSTree` on which
+        discover() has been called.
+    :param checksum_func: A callable of one argument (path) which returns
+        (checksum_type, checksum) or None, as used for mapfiles.  If None
+        checksums are not compared.
+    :return: A list of mismatch dictionaries sorted by dataset_id, version
+        and filename.  Each has the keys *kind*, *dataset_id*, *version*,
+        *filename*, *catalog* and *disk*.  kind is one of the MISMATCH_*
+        constants.
+
+    """
+    catalog = {}
+    for record in records:
+        try:
+            key = (record.get_property('dataset_id'), 
+                   int(record.get_property('dataset_version')))
+        except (InvalidThreddsException, ValueError), e:
+            log.warning('Cannot reconcile catalog for dataset %s: %s' % 
+                        (record.dataset_id, e))
+            continue
+        if key in catalog:
+            log.warning('Dataset %s version %d is in more than one catalog' % key)
+        catalog[key] = record
+
+    disk = {}
+    for pt in drs_tree.pub_trees.values():
+        dataset_id = pt.drs.to_dataset_id()
+        for version in pt.versions:
+            # Versions deduced from the files directory without a version
+            # directory have no file list and are not on disk
+            if pt.versions.is_loaded(version) and pt.versions[version] is None:
+                continue
+            disk[(dataset_id, version)] = pt
+
+    mismatches = []
+    def mismatch(kind, key, filename=None, catalog_value=None, disk_value=None):
+        dataset_id, version = key
+        mismatches.append({'kind': kind, 'dataset_id': dataset_id, 
+                           'version': version, 'filename': filename,
+                           'catalog': catalog_value, 'disk': disk_value})
+
+    # Datasets on disk indexed without their product component to detect
+    # datasets published under the wrong product.
+    product_index = _product_index(drs_tree)
+    by_product = {}
+    cat_by_product = set()
+    if product_index is not None:
+        for dataset_id, version in disk:
+            by_product.setdefault(_without(dataset_id, product_index, version), 
+                                  []).append(dataset_id)
+        for dataset_id, version in catalog:
+            cat_by_product.add(_without(dataset_id, product_index, version))
+
+    drs_root = drs_tree.drs_fs.drs_root
+    recorded = {}
+    for key in sorted(set(catalog) | set(disk)):
+        if key not in disk:
+            dataset_id, version = key
+            others = []
+            if product_index is not None:
+                others = by_product.get(_without(dataset_id, product_index, version), [])
+            if others:
+                mismatch(MISMATCH_PRODUCT, key, catalog_value=dataset_id, 
+                         disk_value=sorted(others)[0])
+            else:
+                mismatch(MISMATCH_NOT_ON_DISK, key)
+            continue
+        if key not in catalog:
+            # Product mismatches are reported from the catalog side
+            if (product_index is None or 
+                _without(key[0], product_index, key[1]) not in cat_by_product):
+                mismatch(MISMATCH_NOT_IN_CATALOG, key)
+            continue
+
+        record = catalog[key]
+        pt = disk[key]
+        if pt.pub_dir not in recorded:
+            recorded[pt.pub_dir] = _RecordedFiles(pt)
+        cat_files = dict((cfile.name, cfile) for cfile in record.files)
+        disk_files = dict((os.path.basename(path), path) for path, drs in pt.versions[key[1]])
+
+        for filename in sorted(set(cat_files) | set(disk_files)):
+            if filename not in disk_files:
+                mismatch(MISMATCH_FILE_NOT_ON_DISK, key, filename)
+                continue
+            if filename not in cat_files:
+                mismatch(MISMATCH_FILE_NOT_IN_CATALOG, key, filename)
+                continue
+
+            cfile = cat_files[filename]
+            path = disk_files[filename]
+
+            relpath = os.path.relpath(path, drs_root)
+            url_path = cfile.url_path or ''
+            if not (url_path == relpath or url_path.endswith('/' + relpath)):
+                mismatch(MISMATCH_PATH, key, filename, url_path, relpath)
+
+            ret = recorded[pt.pub_dir].get(path)
+            if ret is None:
+                size, checksum_type, checksum = os.stat(path).st_size, None, None
+            else:
+                size, checksum_type, checksum = ret
+            if cfile.size is not None and cfile.size != size:
+                mismatch(MISMATCH_SIZE, key, filename, cfile.size, size)
+
+            if checksum_func and cfile.checksum:
+                cat_type, cat_checksum = _split_checksum(cfile)
+                if checksum is None or checksum_type.upper() != cat_type:
+                    checksum_type, checksum = checksum_func(path) or (None, None)
+                if (checksum is not None and cat_type == checksum_type.upper() and
+                    cat_checksum != checksum.lower()):
+                    mismatch(MISMATCH_CHECKSUM, key, filename,
+                             cfile.checksum, checksum)
+
+    return mismatches
+
+
+class _RecordedFiles(object):
+    # Sizes and checksums of the files of a PublisherTree recorded during
+    # ingest and mapfile generation, looked up without reading the files
+    def __init__(self, pt):
+        self.store = pt.checksum_store()
+        self.index = mapfile.MapfileIndex(pt.pub_dir).load()[1]
+
+    def get(self, path):
+        """
+        :return: (size, checksum_type, checksum) or None.  The checksum
+            is None if only the size is recorded.
+
+        """
+        ret = self.store.lookup(path)
+        if ret is not None:
+            return ret
+        realpath = mapfile._real_path(path)
+        entry = self.index.get(realpath)
+        if entry is not None:
+            size, mod_time, checksum_type, checksum = entry
+            return size, checksum_type, checksum
+        return self.store.lookup(realpath)
+
+
+def _product_index(drs_tree):
+    # Position of the product component in dataset ids, or None
+    drs_cls = drs_tree.drs_fs.drs_cls
+    attrs = drs_cls.DRS_ATTRS
+    attrs = attrs[:attrs.index(drs_cls.PUBLISH_LEVEL)+1]
+    if 'product' not in attrs:
+        return None
+    return attrs.index('product')
+
+def _without(dataset_id, index, version):
+    parts = dataset_id.split('.')
+    del parts[index:index+1]
+    return tuple(parts), version
+
+def _split_checksum(cfile):
+    # Catalog checksums are sometimes given as "TYPE:checksum"
+    checksum = cfile.checksum
+    checksum_type = (cfile.checksum_type or '').upper()
+    if ':' in checksum:
+        prefix, checksum = checksum.split(':', 1)
+        checksum_type = checksum_type or prefix.upper()
+    return checksum_type, checksum.lower()
+
+
+class CatalogFetcher(object):
+    """
+    Retrieve THREDDS catalogs from file paths, file:// or http(s):// URLs.
+
+    HTTP connections are kept open and reused for further requests to
+    the same server.  Each thread has its own connections so one
+    fetcher can be shared by worker threads.
+
+    If cache_dir is given catalogs retrieved over HTTP are stored
+    there.  Cached catalogs are revalidated with a conditional GET
+    using the ETag and Last-Modified headers of the original response,
+    so unchanged catalogs are not transferred again.
+
+    """
+
+    def __init__(self, cache_dir=None, timeout=60):
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self._local = threading.local()
+
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def parse(self, url):
+        """
+        Return the catalog at url as an ElementTree.
+
+        """
+        return ET.parse(StringIO(self.fetch(url)), base_url=url)
+
+    def record(self, url):
+        """
+        Return the catalog at url as a :class:`CatalogRecord`.
+
+        """
+        fh = self.open(url)
+        try:
+            return CatalogRecord.parse(fh)
+        finally:
+            fh.close()
+
+    def fetch(self, url):
+        """
+        Return the content of the catalog at url.
+
+        """
+        fh = self.open(url)
+        try:
+            return fh.read()
+        finally:
+            fh.close()
+
+    def open(self, url):
+        """
+        Return a file-like object reading the catalog at url.  Local
+        files are read as a stream.
+
+        """
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if scheme in ('http', 'https'):
+            return StringIO(self._fetch_http(url))
+        elif scheme == 'file':
+            path = urllib.url2pathname(path)
+        else:
+            path = url
+
+        return open(path, 'rb')
+
+    def _connection(self, scheme, netloc, renew=False):
+        try:
+            connections = self._local.connections
+        except AttributeError:
+            connections = self._local.connections = {}
+
+        key = (scheme, netloc)
+        if renew and key in connections:
+            connections.pop(key).close()
+        if key not in connections:
+            if scheme == 'https':
+                conn_cls = httplib.HTTPSConnection
+            else:
+                conn_cls = httplib.HTTPConnection
+            connections[key] = conn_cls(netloc, timeout=self.timeout)
+
+        return connections[key]
+
+    def _fetch_http(self, url):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if not path:
+            path = '/'
+        if query:
+            path = '%s?%s' % (path, query)
+
+        headers = {}
+        cached = self._cache_read(url)
+        if cached:
+            meta, body = cached
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        # The server may have closed an idle connection so retry once
+        # with a new connection.
+        for renew in (False, True):
+            conn = self._connection(scheme, netloc, renew)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                if renew:
+                    raise
+
+        if response.status == httplib.NOT_MODIFIED and cached:
+            log.debug('Catalog %s not modified' % url)
+            return body
+        if response.status != httplib.OK:
+            raise CatalogFetchError('HTTP error %d %s fetching %s' % 
+                                    (response.status, response.reason, url))
+
+        self._cache_write(url, response, data)
+
+        return data
+
+    def _cache_paths(self, url):
+        key = hashlib.md5(url).hexdigest()
+        return (os.path.join(self.cache_dir, key + '.xml'),
+                os.path.join(self.cache_dir, key + '.json'))
+
+    def _cache_read(self, url):
+        if not self.cache_dir:
+            return None
+
+        body_path, meta_path = self._cache_paths(url)
+        try:
+            fh = open(meta_path)
+            try:
+                meta = json.load(fh)
+            finally:
+                fh.close()
+            fh = open(body_path, 'rb')
+            try:
+                body = fh.read()
+            finally:
+                fh.close()
+        except (IOError, ValueError):
+            return None
+
+        if meta.get('url') != url:
+            return None
+
+        return meta, body
+
+    def _cache_write(self, url, response, data):
+        if not self.cache_dir:
+            return
+
+        meta = {'url': url,
+                'etag': response.getheader('etag'),
+                'last_modified': response.getheader('last-modified')}
+        if not (meta['etag'] or meta['last_modified']):
+            return
+
+        # Write atomically so that concurrent readers never see a partial entry
+        body_path, meta_path = self._cache_paths(url)
+        for path, content in ((body_path, data), (meta_path, json.dumps(meta))):
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+            fh = os.fdopen(fd, 'wb')
+            fh.write(content)
+            fh.close()
+            os.rename(tmp_path, path)
+
 class DRSIdCheck(ThreddsCheck):
     """
     Check drs_id is present and consistent with dataset_id.
 
     """
 
-    def check(self, etree):
-        dataset = get_dataset(etree)
-
-        drs_id = get_property(dataset, 'drs_id')
-        dataset_id = get_property(dataset, 'dataset_id')
+    def check(self, record):
+        drs_id = record.get_property('drs_id')
+        dataset_id = record.get_property('dataset_id')
 
         # Check 2 ids are consistent
         if drs_id != dataset_id:
             raise InvalidThreddsException("dataset_id != drs_id for dataset %s" %
-                                          dataset.get('ID'))
+                                          record.dataset_id)
 
         self.environ['dataset_id'] = dataset_id
         self.environ['drs_id'] = drs_id
@@ -139,12 +791,10 @@ class DRSPropCheck(ThreddsCheck):
     Creates a drs attribute in the environment if successful.
 
     """
-    def check(self, etree):
-        dataset = get_dataset(etree)
-
+    def check(self, record):
         props = {}
         for prop_name in drs_prop_map:
-            prop = get_property(dataset, prop_name)
+            prop = record.get_property(prop_name)
             if prop_name == 'dataset_version':
                 prop = int(prop)
             elif prop_name == 'ensemble':
@@ -164,7 +814,7 @@ class DRSPropCheck(ThreddsCheck):
         if 'drs_id' in self.environ:
             if drs.to_dataset_id() != self.environ['drs_id']:
                 raise InvalidThreddsException("drs properties inconsistent with drs_id for dataset %s" %
-                                              dataset.get('ID'))
+                                              record.dataset_id)
 
         self.environ['drs'] = drs
 
@@ -175,7 +825,7 @@ class ValidDRSCheck(ThreddsCheck):
 
     """
 
-    def check(self, etree):
+    def check(self, record):
         if 'drs' not in self.environ:
             raise CheckNotPossible
 
@@ -192,7 +842,7 @@ class ValidDateCheck(ThreddsCheck):
     Check date versioning.
 
     """
-    def check(self, etree):
+    def check(self, record):
         if not 'drs' in self.environ:
             raise CheckNotPossible
 
@@ -201,6 +851,67 @@ class ValidDateCheck(ThreddsCheck):
             raise InvalidThreddsException("The version of dataset doesn't look like a date: %s" %
                                           drs)
 
+
+class UrlPathCheck(ThreddsCheck):
+    """
+    Check the urlPath of each file follows the DRS directory structure.
+
+    """
+    def check(self, record):
+        if not 'drs' in self.environ:
+            raise CheckNotPossible
+
+        drs = self.environ['drs']
+        dataset_path = '/'.join(drs.to_dataset_id().split('.') + ['v%d' % drs.version])
+
+        bad = []
+        for cfile in record.files:
+            variable = cfile.name.split('_')[0]
+            expected = '%s/%s/%s' % (dataset_path, variable, cfile.name)
+            if not (cfile.url_path == expected or 
+                    (cfile.url_path or '').endswith('/' + expected)):
+                bad.append(cfile.name)
+
+        if bad:
+            raise InvalidThreddsException("urlPath inconsistent with the DRS for %d files "
+                                          "in dataset %s, e.g. %s" % 
+                                          (len(bad), record.dataset_id, bad[0]))
+
+
+class ChecksumCheck(ThreddsCheck):
+    """
+    Check each file has a checksum in the right format.
+
+    """
+    checksum_lengths = {'MD5': 32, 'SHA256': 64}
+
+    def check(self, record):
+        bad = []
+        for cfile in record.files:
+            length = self.checksum_lengths.get((cfile.checksum_type or '').upper())
+            checksum = cfile.checksum or ''
+            if length is None or not re.match(r'[0-9a-fA-F]{%d}$' % length, checksum):
+                bad.append(cfile.name)
+
+        if bad:
+            raise InvalidThreddsException("Missing or malformed checksums for %d files "
+                                          "in dataset %s, e.g. %s" % 
+                                          (len(bad), record.dataset_id, bad[0]))
+
+
+class TrackingIdCheck(ThreddsCheck):
+    """
+    Check each file has a tracking_id.
+
+    """
+    def check(self, record):
+        bad = [cfile.name for cfile in record.files if not cfile.tracking_id]
+
+        if bad:
+            raise InvalidThreddsException("Missing tracking_id for %d files "
+                                          "in dataset %s, e.g. %s" % 
+                                          (len(bad), record.dataset_id, bad[0]))
+
 #
 # Utility functions
 #
@@ -223,46 +934,130 @@ def get_property(dataset, name):
     return prop.get('value')
 
 
-def read_master_catalog(catalog_url):
+def read_master_catalog(catalog_url, fetcher=None):
     """
-    Read master catalogue and generate dataset catalogue ElementTree objects.
+    Read master catalogue and generate the URLs of dataset catalogues.
 
     """
-    cat_etree = ET.parse(catalog_url)
+    if fetcher is None:
+        fetcher = CatalogFetcher()
+
     scheme, netloc, path, query, fragment = urlparse.urlsplit(catalog_url)
     base_url = urlparse.urlunsplit((scheme, netloc, os.path.dirname(path)+'/', None, None))
 
-    for catalog_ref in cat_etree.findall('{%s}catalogRef' % THREDDS_NS):
-        ds_url = catalog_ref.get('{%s}href' % XLINK_NS)
-        abs_ds_url = urlparse.urljoin(base_url, ds_url)
+    fh = fetcher.open(catalog_url)
+    try:
+        for event, catalog_ref in ET.iterparse(fh, tag=_CATALOG_REF):
+            ds_url = catalog_ref.get('{%s}href' % XLINK_NS)
+            abs_ds_url = urlparse.urljoin(base_url, ds_url)
+            catalog_ref.clear()
         
-        yield abs_ds_url
+            yield abs_ds_url
+    finally:
+        fh.close()
 
 
 def main(argv=sys.argv):
     logging.basicConfig(level=logging.ERROR)
 
-    checks = [DRSIdCheck, DRSPropCheck, ValidDRSCheck, ValidDateCheck]
+    checks = [DRSIdCheck, DRSPropCheck, ValidDRSCheck, ValidDateCheck,
+              UrlPathCheck, ChecksumCheck, TrackingIdCheck]
 
     op = OptionParser(usage)
     op.add_option('-c', '--catalog', action='store',
                   help="Scan root THREDDS catalog CATALOG for catalogRef "
                         "elements and check each referenced catalog")
+    op.add_option('-j', '--jobs', action='store', type='int', default=4,
+                  help="Check JOBS catalogs concurrently [default %default]")
+    op.add_option('--cache-dir', action='store', metavar='DIR',
+                  help="Cache catalogs retrieved over HTTP in DIR and only "
+                       "retrieve them again if they have changed")
+    op.add_option('--summary', action='store', metavar='FILE',
+                  help="Write a summary of the checks on each catalog to FILE "
+                       "as one JSON object per line.  Use '-' for stdout")
+    op.add_option('--reconcile', action='store', metavar='ROOT',
+                  help="Instead of checking each catalog, cross-check all catalogs "
+                       "against the DRS tree at ROOT.  Mismatches are written as "
+                       "the summary")
+    op.add_option('-s', '--scheme', action='store',
+                  help="DRS scheme of the tree to reconcile against.  Available "
+                       "schemes are %s" % ', '.join(config.drs_schemes))
+    op.add_option('--mapfile', action='append', metavar='FILE', default=[],
+                  help="Compare catalog checksums with those in mapfile FILE. "
+                       "May be given more than once")
+    op.add_option('--compute-checksums', action='store_true',
+                  help="Compare catalog checksums with checksums calculated from "
+                       "files not in any mapfile")
 
     opts, args = op.parse_args(argv[1:])
 
+    fetcher = CatalogFetcher(opts.cache_dir)
+
     xmls = args
     if opts.catalog:
         log.info('Discovering catalogs from master catalog %s' % opts.catalog)
-        xmls += list(read_master_catalog(opts.catalog))
+        xmls += list(read_master_catalog(opts.catalog, fetcher))
 
     if not xmls:
         op.print_help()
 
-    for xml in xmls:
-        log.info('Checking %s' % xml)
-        etree = ET.parse(xml)
-        run_checks(etree, checks)
+    if opts.summary == '-':
+        summary_fh = sys.stdout
+    elif opts.summary:
+        summary_fh = open(opts.summary, 'w')
+    else:
+        summary_fh = None
+
+    if opts.reconcile:
+        summaries = _reconcile_main(opts, xmls, fetcher)
+    else:
+        summaries = check_catalogs(xmls, checks, fetcher, opts.jobs)
+
+    for summary in summaries:
+        if summary_fh:
+            summary_fh.write(json.dumps(summary, sort_keys=True) + '\n')
+
+    if summary_fh and summary_fh is not sys.stdout:
+        summary_fh.close()
+
+def _reconcile_main(opts, catalog_urls, fetcher):
+    from drslib.drs_tree import DRSTree
+
+    scheme = opts.scheme or config.default_drs_scheme
+    drs_fs = config.get_drs_scheme(scheme)(os.path.abspath(opts.reconcile))
+    drs_tree = DRSTree(drs_fs)
+    drs_tree.discover()
+
+    checksums = {}
+    for path in opts.mapfile:
+        fh = open(path)
+        for dataset_id, filepath, size, params in mapfile.read_mapfile(fh):
+            if 'checksum' in params:
+                checksums[filepath] = (params.get('checksum_type', 'MD5'), 
+                                       params['checksum'])
+        fh.close()
+
+    def checksum_func(path):
+        if path in checksums:
+            return checksums[path]
+        if opts.compute_checksums:
+            return config.checksum_func(path)
+        return None
+
+    if checksums or opts.compute_checksums:
+        func = checksum_func
+    else:
+        func = None
+
+    records = [record for url, record in 
+               fetch_records(catalog_urls, fetcher, opts.jobs)]
+    mismatches = reconcile(records, drs_tree, func)
+
+    log.info('Reconciled %d catalogs with %d datasets: %d mismatches' %
+             (len(records), len(drs_tree.pub_trees), len(mismatches)))
+
+    return mismatches
+
 
 if __name__ == '__main__':
     main()
@@ -8,10 +8,21 @@
 
 """
 Translate a stream of filepaths from CMIP3 to CMIP5 syntax
+
+Leaf directories of the CMIP3 archive are translated independently and
+can be distributed across a pool of worker processes.  Completed
+directories can be recorded in a checkpoint file so that an interrupted
+translation resumes where it stopped.
+
 """
 
 
 import sys, os, re
+import errno
+import shutil
+import time
+import itertools
+import multiprocessing
 
 import logging
 log = logging.getLogger(__name__)
@@ -27,6 +38,14 @@ include = None
 exclude = None
 dry_run = True
 copy_trans = False
+
+# Log progress at most this often (seconds)
+PROGRESS_INTERVAL = 60
+
+# Commands in a translation plan
+CMD_MKDIR = 'mkdir'
+CMD_MOVE = 'mv'
+CMD_COPY = 'cp'
  
 def walk_cmip3(base_path):
     """
@@ -84,70 +103,277 @@ def check_dirnames(dirpath, dirnames):
 def _mkdirs(name, mode=0777):
     log.info('mkdir -p %s' % name)
     if not dry_run:
-        os.makedirs(name, mode)
+        try:
+            os.makedirs(name, mode)
+        except OSError, e:
+            # Another worker may have created it
+            if e.errno != errno.EEXIST:
+                raise
 
 def _copy(old, new):
-    cmd = 'cp %s %s' % (old, new)
-    log.info(cmd)
+    log.info('cp %s %s' % (old, new))
     if not dry_run:
-        os.system(cmd)
+        # Copy to a temporary name so that a partial copy is never
+        # mistaken for a complete one.
+        tmp = new + '.part'
+        shutil.copy2(old, tmp)
+        os.rename(tmp, new)
 
 def _rename(old, new):
-    cmd = 'mv %s %s' % (old, new)
-    log.info(cmd)
+    log.info('mv %s %s' % (old, new))
     if not dry_run:
-        os.system(cmd)
+        try:
+            os.rename(old, new)
+        except OSError, e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Across filesystems
+            tmp = new + '.part'
+            shutil.copy2(old, tmp)
+            os.rename(tmp, new)
+            os.remove(old)
 
              
+# Translators of each worker process.  Set by _init_translators.
+_translators = None
 
-def trans_files(cmip3_path, cmip5_path):
-    cmip3_t = cmip3.make_translator(cmip3_path)
-    cmip5_t = cmip5.make_translator(cmip5_path)
+def _init_translators(cmip3_path, cmip5_path, worker_dry_run=None, 
+                      worker_copy_trans=None):
+    global _translators, dry_run, copy_trans
 
-    log.info('Dry run is %s' % dry_run)
-    log.info('Copying is %s' % copy_trans)
+    _translators = (cmip3.make_translator(cmip3_path),
+                    cmip5.make_translator(cmip5_path))
+    if worker_dry_run is not None:
+        dry_run = worker_dry_run
+    if worker_copy_trans is not None:
+        copy_trans = worker_copy_trans
+
+
+def plan_dir(dirpath, filenames):
+    """
+    Work out how to translate a leaf directory of the CMIP3 archive.
 
-    for dirpath, filenames in walk_cmip3(cmip3_path):
-        log.info('Processing directory %s' % dirpath)
+    :return: A list of commands (CMD, SRC, DEST) where CMD is one of
+        CMD_MKDIR, CMD_MOVE or CMD_COPY, or None if the directory cannot
+        be translated.
 
+    """
+    cmip3_t, cmip5_t = _translators
+
+    try:
+        drs = cmip3_t.path_to_drs(dirpath)
+        path = cmip5_t.drs_to_path(drs)
+    except TranslationError, e:
+        log.error('Failed to translate path %s: %s' % (dirpath, e))
+        return None
+    except:
+        log.exception('Error translating path %s' % dirpath)
+        return None
+
+    log.info('Translating atomic dataset %s' % drs)
+
+    # Components that determine the directory.  Checking files against
+    # these is much cheaper than translating each file's path.
+    path_components = [(k, v) for (k, v) in drs.items() if v is not None]
+
+    commands = []
+    if not os.path.exists(path):
+        commands.append((CMD_MKDIR, None, path))
+
+    if copy_trans:
+        cmd = CMD_COPY
+    else:
+        cmd = CMD_MOVE
+
+    for filename in sorted(filenames):
         try:
-            drs = cmip3_t.path_to_drs(dirpath)
-            path = cmip5_t.drs_to_path(drs)
+            drs2 = cmip3_t.filepath_to_drs(os.path.join(dirpath, filename))
+            filename2 = cmip5_t.drs_to_file(drs2)
         except TranslationError, e:
-            log.error('Failed to translate path %s: %s' % (dirpath, e))
+            log.error('Failed to translate filename %s: %s' % (filename, e))
             continue
-        except:
-            log.exception('Error translating path %s' % dirpath)
+
+        # Sanity check
+        mismatched = [k for (k, v) in path_components if drs2.get(k) != v]
+        if mismatched:
+            log.error('File %s does not belong in directory %s: %s differ' %
+                      (filename, path, ', '.join(mismatched)))
             continue
 
-        log.info('Translating atomic dataset %s' % drs)
+        commands.append((cmd, os.path.join(dirpath, filename),
+                         os.path.join(path, filename2)))
 
-        if not os.path.exists(path):
-            _mkdirs(path)
+    return commands
 
-        for filename in filenames:
 
-            try:
-                drs2 = cmip3_t.filepath_to_drs(os.path.join(dirpath, filename))
-                filename2 = cmip5_t.drs_to_file(drs2)
-            except TranslationError, e:
-                log.error('Failed to translate filename %s: %s' % (filename, e))
-                continue
+def trans_dir(leaf):
+    """
+    Translate a leaf directory of the CMIP3 archive.
+
+    :param leaf: A tuple (dirpath, filenames) as yielded by walk_cmip3.
+    :return: A dictionary with keys *dir*, *commands*, *files*, *bytes*
+        and *ok*.  ok is False if any part of the directory could not be
+        translated.
 
-            # Sanity check
-            path2 = cmip5_t.drs_to_path(drs2)
-            assert path2 == path
+    """
+    dirpath, filenames = leaf
+    log.info('Processing directory %s' % dirpath)
+
+    result = {'dir': dirpath, 'commands': [], 'files': 0, 'bytes': 0, 'ok': True}
+    commands = plan_dir(dirpath, filenames)
+    if commands is None:
+        result['ok'] = False
+        return result
+    result['commands'] = commands
+    if len([c for c in commands if c[0] != CMD_MKDIR]) != len(filenames):
+        result['ok'] = False
+
+    for cmd, src, dest in commands:
+        try:
+            if cmd == CMD_MKDIR:
+                _mkdirs(dest)
+                continue
 
-            if copy_trans:
-                _copy(os.path.join(dirpath, filename),
-                      os.path.join(path, filename2))
+            if not os.path.exists(src):
+                # Already moved by an interrupted run
+                if os.path.exists(dest):
+                    continue
+                raise OSError(errno.ENOENT, 'No such file', src)
+            size = os.stat(src).st_size
+            if cmd == CMD_COPY:
+                if _is_copied(src, dest):
+                    continue
+                _copy(src, dest)
             else:
-                _rename(os.path.join(dirpath, filename),
-                        os.path.join(path, filename2))
+                _rename(src, dest)
+        except EnvironmentError, e:
+            log.error('Failed to %s %s: %s' % (cmd, src or dest, e))
+            result['ok'] = False
+            continue
+
+        result['files'] += 1
+        result['bytes'] += size
 
+    return result
+
+def _is_copied(src, dest):
+    # copy2 preserves mtime so an identical size and mtime marks a complete copy
+    try:
+        st_src = os.stat(src)
+        st_dest = os.stat(dest)
+    except OSError:
+        return False
+    return (st_src.st_size == st_dest.st_size and
+            int(st_src.st_mtime) == int(st_dest.st_mtime))
+
+
+def trans_files(cmip3_path, cmip5_path, jobs=1, checkpoint=None, plan_fh=None):
+    """
+    Translate the CMIP3 archive at cmip3_path into a DRS structure at
+    cmip5_path.
+
+    :param jobs: The number of worker processes translating directories.
+    :param checkpoint: Path of a checkpoint file.  Directories recorded
+        in this file are skipped and each directory is recorded as it is
+        completed.
+    :param plan_fh: If given write the commands of the translation to this
+        file instead of executing them.
+
+    """
+    if plan_fh is not None:
+        global dry_run
+        dry_run = True
+
+    log.info('Dry run is %s' % dry_run)
+    log.info('Copying is %s' % copy_trans)
+
+    done = set()
+    checkpoint_fh = None
+    if checkpoint:
+        done = read_checkpoint(checkpoint)
+        log.info('Skipping %d directories recorded in checkpoint %s' % 
+                 (len(done), checkpoint))
+        if not dry_run:
+            checkpoint_fh = open(checkpoint, 'a')
+
+    leaves = ((dirpath, filenames) for (dirpath, filenames) 
+              in walk_cmip3(cmip3_path) if dirpath not in done)
+
+    initargs = (cmip3_path, cmip5_path, dry_run, copy_trans)
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _init_translators, initargs)
+        results = pool.imap(trans_dir, leaves)
+    else:
+        pool = None
+        _init_translators(*initargs)
+        results = itertools.imap(trans_dir, leaves)
+
+    progress = _Progress()
+    try:
+        for result in results:
+            if plan_fh is not None:
+                for cmd, src, dest in result['commands']:
+                    if cmd == CMD_MKDIR:
+                        print >>plan_fh, 'mkdir -p %s' % dest
+                    else:
+                        print >>plan_fh, '%s %s %s' % (cmd, src, dest)
+
+            if checkpoint_fh and result['ok']:
+                checkpoint_fh.write(result['dir'] + '\n')
+                checkpoint_fh.flush()
+
+            progress.update(result)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if checkpoint_fh:
+            checkpoint_fh.close()
+
+    progress.report()
     log.info('Translation complete')
 
 
+def read_checkpoint(checkpoint):
+    """
+    Return the set of directories recorded in a checkpoint file.
+
+    """
+    done = set()
+    if os.path.exists(checkpoint):
+        fh = open(checkpoint)
+        for line in fh:
+            # A final line without newline may be truncated
+            if line.endswith('\n'):
+                done.add(line[:-1])
+        fh.close()
+    return done
+
+
+class _Progress(object):
+    def __init__(self):
+        self.start = self.last = time.time()
+        self.dirs = self.files = self.bytes = self.failed = 0
+
+    def update(self, result):
+        self.dirs += 1
+        self.files += result['files']
+        self.bytes += result['bytes']
+        if not result['ok']:
+            self.failed += 1
+
+        if time.time() - self.last > PROGRESS_INTERVAL:
+            self.report()
+
+    def report(self):
+        self.last = time.time()
+        elapsed = max(self.last - self.start, 1e-6)
+        log.info('Translated %d directories (%d incomplete), %d files, '
+                 '%.1f GB at %.1f MB/s' % 
+                 (self.dirs, self.failed, self.files, self.bytes / 1e9, 
+                  self.bytes / 1e6 / elapsed))
+
+
 def main(argv=sys.argv):
     from optparse import OptionParser
 
@@ -169,6 +395,20 @@ def main(argv=sys.argv):
                       default=False, 
                       help="Emit log messages but don't translate anything")
 
+    parser.add_option('-p', '--plan', dest='plan', action='store',
+                      metavar='FILE',
+                      help="Don't translate anything but write the commands that "
+                      "would be executed to FILE")
+
+    parser.add_option('-j', '--jobs', dest='jobs', action='store', type='int',
+                      default=1,
+                      help="Translate directories with JOBS worker processes")
+
+    parser.add_option('-C', '--checkpoint', dest='checkpoint', action='store',
+                      metavar='FILE',
+                      help="Record completed directories in FILE and skip "
+                      "directories already recorded there")
+
     parser.add_option('-l', '--loglevel', dest='loglevel', action='store', 
                       default='INFO',
                       help="Set logging level")
@@ -195,7 +435,16 @@ def main(argv=sys.argv):
     dry_run = options.dryrun
     copy_trans = options.copy
 
-    trans_files(cmip3_path, cmip5_path)
+    if options.plan:
+        plan_fh = open(options.plan, 'w')
+    else:
+        plan_fh = None
+
+    trans_files(cmip3_path, cmip5_path, jobs=options.jobs, 
+                checkpoint=options.checkpoint, plan_fh=plan_fh)
+
+    if plan_fh:
+        plan_fh.close()
 
 
 if __name__ == '__main__':
@@ -38,6 +38,11 @@ Syntax [DRS]_.
         # For cmip5_product_identifier
         'xlrd',
       ],
+      extras_require={
+        # For drslib.inventory and drs_tool coverage
+        'inventory': ['numpy'],
+        'coverage': ['numpy'],
+      },
       #tests_require=['NoseXUnit'],
       entry_points= {
         'console_scripts': ['translate_cmip3 = drslib.translate_cmip3:main',
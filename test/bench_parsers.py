@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Benchmark filename parsing of the CORDEX and SPECS DRS schemes.
+
+Usage: bench_parsers.py [N]
+
+Parses N filenames (default 200000) derived from the test listings with
+filename_to_drs() and with the batch API filenames_to_drs().
+
+"""
+
+import sys
+import os
+import time
+import itertools
+
+from drslib.cordex import CordexFileSystem
+from drslib.specs import SpecsFileSystem
+from drslib.exceptions import TranslationError
+
+test_dir = os.path.dirname(__file__)
+
+
+def listing_filenames(listing_file):
+    for line in open(os.path.join(test_dir, listing_file)):
+        line = line.strip()
+        if line and line[0] != '#':
+            yield os.path.basename(line)
+
+
+def make_filenames(listing_files, n):
+    filenames = []
+    for listing_file in listing_files:
+        filenames.extend(listing_filenames(listing_file))
+    return list(itertools.islice(itertools.cycle(filenames), n))
+
+
+def bench(label, func, filenames):
+    start = time.time()
+    func(filenames)
+    elapsed = time.time() - start
+    print '%-40s %8.2fs %10d files/s' % (label, elapsed, len(filenames) / elapsed)
+
+
+def main(argv=sys.argv):
+    if len(argv) > 1:
+        n = int(argv[1])
+    else:
+        n = 200000
+
+    for drs_fs, listing_files in [
+        (CordexFileSystem('/'), ['cordex_test_EUR-44.ls']),
+        (SpecsFileSystem('/'), ['specs_1.ls', 'specs_2.ls']),
+        ]:
+        filenames = make_filenames(listing_files, n)
+        name = type(drs_fs).__name__
+
+        def single(filenames):
+            for filename in filenames:
+                try:
+                    drs_fs.filename_to_drs(filename)
+                except TranslationError:
+                    pass
+
+        def batch(filenames):
+            for filename, drs in drs_fs.filenames_to_drs(filenames):
+                pass
+
+        bench('%s.filename_to_drs' % name, single, filenames)
+        bench('%s.filenames_to_drs' % name, batch, filenames)
+
+
+if __name__ == '__main__':
+    main()
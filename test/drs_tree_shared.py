@@ -19,6 +19,7 @@ import gen_drs
 from drslib.drs_tree import DRSTree
 from drslib import config
 from drslib.cmip5 import CMIP5FileSystem
+from drslib.cordex import CordexFileSystem
 
 test_dir = os.path.dirname(__file__)
 
@@ -62,3 +63,53 @@ class TestListing(TestEg):
         pt.do_version()
         assert pt.state == pt.STATE_VERSIONED
         assert pt.versions.keys() == [self.today]
+
+
+cordex_version_filenames = [
+    'vas_EUR-44_ECMWF-ERAINT_evaluation_r1i1p1_MOHC-HadRM3P_v1_day_19900101-19901231.nc',
+    'vas_EUR-44_ECMWF-ERAINT_evaluation_r1i1p1_MOHC-HadRM3P_v1_day_19910101-19951231.nc',
+    'vas_EUR-44_ECMWF-ERAINT_evaluation_r1i1p1_MOHC-HadRM3P_v1_day_19960101-20001231.nc',
+    'vas_EUR-44_ECMWF-ERAINT_evaluation_r1i1p1_MOHC-HadRM3P_v1_day_20010101-20051231.nc',
+    'vas_EUR-44_ECMWF-ERAINT_evaluation_r1i1p1_MOHC-HadRM3P_v1_day_20060101-20101231.nc',
+    'vas_EUR-44_ECMWF-ERAINT_evaluation_r1i1p1_MOHC-HadRM3P_v1_day_20110101-20111130.nc',
+    ]
+
+class TestCordexVersionsEg(TestEg):
+    """
+    A CORDEX dataset with two versions.  The first holds the first three
+    of cordex_version_filenames and the second all of them.
+
+    """
+    __test__ = False
+
+    filenames = cordex_version_filenames
+    versions = (20100101, 20100102)
+
+    def setUp(self):
+        super(TestCordexVersionsEg, self).setUp()
+
+        drs_root = os.path.join(self.tmpdir, 'cordex')
+        os.mkdir(drs_root)
+        self.drs_fs = CordexFileSystem(drs_root)
+        self.incoming = os.path.join(self.tmpdir, 'incoming')
+
+        v1, v2 = self.versions
+        self._upgrade(self.filenames[:3], v1)
+        self._upgrade(self.filenames[3:], v2)
+
+    def _upgrade(self, seq, version):
+        gen_drs.write_listing_seq(self.incoming, seq)
+
+        self.dt = self._discover()
+        (self.pt, ) = self.dt.pub_trees.values()
+        self.pt.do_version(version)
+
+    def _discover(self):
+        dt = DRSTree(self.drs_fs)
+        dt.discover(self.incoming, activity='cordex',
+                    product='output', variable='vas')
+        return dt
+
+    def _links(self, version):
+        vdir = os.path.join(self.pt.pub_dir, 'v%d' % version)
+        return sorted(os.listdir(vdir))
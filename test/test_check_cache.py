@@ -0,0 +1,99 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test caching of checker verdicts.
+
+"""
+
+import os
+import os.path as op
+import stat
+
+from nose.plugins.skip import SkipTest
+
+from drslib.drs_tree import DRSTree
+from drslib.drs_tree_check import CheckVersionLinks
+from drslib.check_cache import CHECK_CACHE_FILE
+from drslib.drs_command import main as drstool_main
+
+from drs_tree_shared import TestCordexVersionsEg, cordex_version_filenames as filenames
+
+
+class TestCheckCache(TestCordexVersionsEg):
+    __test__ = True
+
+    def setUp(self):
+        super(TestCheckCache, self).setUp()
+
+        self.calls = []
+        check_hook = CheckVersionLinks.__dict__['_check_hook']
+        def counting(checker, pt):
+            self.calls.append(pt.pub_dir)
+            return check_hook(checker, pt)
+        self._check_hook = check_hook
+        CheckVersionLinks._check_hook = counting
+
+    def tearDown(self):
+        CheckVersionLinks._check_hook = self._check_hook
+        super(TestCheckCache, self).tearDown()
+
+    def _discover_cached(self, recheck=False):
+        dt = DRSTree(self.drs_fs)
+        dt.set_check_cache(True, recheck=recheck)
+        dt.discover(self.incoming, activity='cordex',
+                    product='output', variable='vas')
+        (pt, ) = dt.pub_trees.values()
+        return pt
+
+    def test_unchanged_tree_skips_checks(self):
+        self._discover_cached()
+        assert len(self.calls) == 1
+        pt = self._discover_cached()
+        assert len(self.calls) == 1
+        assert pt.state == pt.STATE_VERSIONED and not pt.has_failures()
+
+    def test_recheck_runs_checks(self):
+        self._discover_cached()
+        self._discover_cached(recheck=True)
+        assert len(self.calls) == 2
+
+    def test_broken_link_invalidates_cache(self):
+        pt = self._discover_cached()
+        v1, v2 = self.versions
+        os.remove(op.join(pt.pub_dir, 'v%d' % v2, filenames[-1]))
+        pt = self._discover_cached()
+        assert len(self.calls) == 2
+        assert pt.state == pt.STATE_BROKEN
+
+    def test_read_only_pub_dir(self):
+        # Failing to save the cache does not fail the checks
+        if os.geteuid() == 0:
+            raise SkipTest('Permissions are not enforced for root')
+
+        pt = self._discover_cached()
+        os.remove(op.join(pt.pub_dir, CHECK_CACHE_FILE))
+        mode = os.stat(pt.pub_dir).st_mode
+        os.chmod(pt.pub_dir, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        try:
+            assert pt._check_tree()
+            pt = self._discover_cached()
+            assert pt.state == pt.STATE_VERSIONED
+        finally:
+            os.chmod(pt.pub_dir, mode)
+
+        assert not [x for x in os.listdir(pt.pub_dir) if x.startswith(CHECK_CACHE_FILE)]
+
+    def test_drs_tool_cache_is_opt_in(self):
+        cache = op.join(self.pt.pub_dir, CHECK_CACHE_FILE)
+        args = ['drs_tool', 'list', '--scheme=cordex', '-R', self.drs_fs.drs_root,
+                '-I', self.incoming, 'cordex.output']
+        drstool_main(args)
+        assert not op.exists(cache)
+
+        drstool_main(args + ['--check-cache'])
+        assert op.exists(cache)
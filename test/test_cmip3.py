@@ -52,3 +52,45 @@ def test_var_underscore():
     p2 = convert(p)
 
     assert p2 == 'cmip5/output/IPSL/CM4/1pctto2x/mon/atmos/A5/r1/v1/rlftoaa_co2/rlftoaa_co2_A5_CM4_1pctto2x_r1_1860-1869.nc'
+
+def test_trans_files():
+    """
+    Translate a small CMIP3 archive with a plan, workers and a checkpoint.
+
+    """
+    import tempfile, shutil
+    from StringIO import StringIO
+    from drslib import translate_cmip3
+
+    tmpdir = tempfile.mkdtemp(prefix='drslib-')
+    try:
+        cmip3_root = os.path.join(tmpdir, 'cmip3')
+        cmip5_root = os.path.join(tmpdir, 'cmip5')
+        checkpoint = os.path.join(tmpdir, 'checkpoint')
+
+        paths = ['20c3m/atm/da/rsus/gfdl_cm2_0/run1/rsus_A2.19610101-19651231.nc',
+                 '1pctto2x/atm/mo/rlftoaa_co2/ipsl_cm4/run1/rlftoaa_co2_A5_1860-1869.nc']
+        for path in paths:
+            os.makedirs(os.path.join(cmip3_root, os.path.dirname(path)))
+            open(os.path.join(cmip3_root, path), 'w').close()
+
+        translate_cmip3.include = []
+        translate_cmip3.exclude = []
+        translate_cmip3.copy_trans = False
+
+        plan = StringIO()
+        translate_cmip3.trans_files(cmip3_root, cmip5_root, plan_fh=plan)
+        moves = [line.split() for line in plan.getvalue().splitlines()
+                 if line.startswith('mv ')]
+        assert len(moves) == 2
+        assert not os.path.exists(cmip5_root)
+
+        translate_cmip3.dry_run = False
+        translate_cmip3.trans_files(cmip3_root, cmip5_root, jobs=2, checkpoint=checkpoint)
+        for cmd, src, dest in moves:
+            assert os.path.exists(dest)
+            assert not os.path.exists(src)
+        assert len(translate_cmip3.read_checkpoint(checkpoint)) == 2
+    finally:
+        translate_cmip3.dry_run = True
+        shutil.rmtree(tmpdir)
@@ -3,7 +3,12 @@ Test CORDEX DRS structure.
 
 """
 
+import os
+import json
+
 from drslib.cordex import CordexFileSystem, CordexDRS
+from drslib.drs_tree import DRSTree
+from drslib.drs_command import main as drstool_main
 
 from drs_tree_shared import TestEg, TestListing
 
@@ -118,6 +123,200 @@ class TestCordexListing1(TestListing):
         self._do_version(pt)
 
 
+def test_5():
+    # Publication paths are cached per dataset
+    drs = cordex_fs.drs_cls.from_dataset_id('cordex.output.AFR-44.MOHC.ECMWF-ERAINT.evaluation.r0i0p0.MOHC-HadRM3P.v1.fx.areacella')
+    path = cordex_fs.drs_to_publication_path(drs)
+    assert path == '/cordex/output/AFR-44/MOHC/ECMWF-ERAINT/evaluation/r0i0p0/MOHC-HadRM3P/v1/fx/areacella'
+    assert cordex_fs.drs_to_publication_path(drs) is path
+
+    drs.variable = None
+    assert cordex_fs.drs_to_publication_path(drs) == '/cordex/output/AFR-44/MOHC/ECMWF-ERAINT/evaluation/r0i0p0/MOHC-HadRM3P/v1/fx/*'
+
+def test_6():
+    # Parsed publication paths are not shared between DRS instances
+    path = '/cordex/output/AFR-44/MOHC/ECMWF-ERAINT/evaluation/r0i0p0/MOHC-HadRM3P/v1/fx/areacella'
+    drs1 = cordex_fs.publication_path_to_drs(path, activity='cordex')
+    drs1.version = 1
+    drs2 = cordex_fs.publication_path_to_drs(path)
+
+    assert drs1.activity == 'cordex'
+    assert drs2.activity is None
+    assert drs2.version is None
+    assert drs2.variable == 'areacella'
+    assert drs2.ensemble == (0, 0, 0)
+
+def test_7():
+    # Batch parsing agrees with filename_to_drs
+    filenames = [
+        'areacella_AFR-44_ECMWF-ERAINT_evaluation_r0i0p0_MOHC-HadRM3P_v1_fx.nc',
+        'tas_EUR-44_ICHEC-EC-EARTH_historical_r12i1p1_SMHI-RCA4_v1_day_19710101-19751231.nc',
+        'tas_EUR-44_ICHEC-EC-EARTH_historical_r12i1p1_SMHI-RCA4_v1_day_19760101-19801231.nc',
+        'not_a_drs_file.nc',
+        ]
+    results = list(cordex_fs.filenames_to_drs(filenames))
+
+    assert [filename for (filename, drs) in results] == filenames
+    assert results[-1][1] is None
+    for filename, drs in results[:-1]:
+        assert drs == cordex_fs.filename_to_drs(filename)
+    assert results[1][1].subset[0][:3] == (1971, 1, 1)
+
+class TestCordexShards(TestListing):
+    __test__ = True
+
+    listing_file = 'cordex_test_EUR-44.ls'
+
+    def setUp(self):
+        super(TestCordexShards, self).setUp()
+
+        # incoming is not tmpdir/output.
+        self.incoming = self.tmpdir
+
+    def _init_drs_fs(self):
+        self.drs_fs = CordexFileSystem(self.tmpdir)
+
+    def test_1(self):
+        # Shards are disjoint and cover every dataset
+        shard_ids = []
+        for i in range(3):
+            dt = DRSTree(self.drs_fs)
+            dt.set_shard(i, 3)
+            dt.discover(self.incoming, activity='cordex',
+                        product='output', frequency='day')
+            shard_ids.append(set(dt.pub_trees))
+
+        all_ids = set.union(*shard_ids)
+        assert len(all_ids) == 50
+        assert sum(len(x) for x in shard_ids) == 50
 
+    def test_2(self):
+        # Merge reports from each shard
+        reports = []
+        for i in range(2):
+            report = os.path.join(self.tmpdir, 'report_%d.json' % i)
+            drstool_main(['drs_tool', 'list', '--scheme=cordex', '-R', self.tmpdir,
+                          '-I', self.incoming, '--shard=%d/2' % i, '--report', report,
+                          '-c', 'frequency=day', 'cordex.output'])
+            reports.append(report)
+
+        ids = []
+        for report in reports:
+            ids += [x['dataset_id'] for x in json.load(open(report))['datasets']]
+        assert len(ids) == len(set(ids)) == 50
+
+        drstool_main(['drs_tool', 'merge'] + reports)
+
+class TestCordexCheckJobs(TestListing):
+    __test__ = True
 
-        
+    listing_file = 'cordex_test_EUR-44.ls'
+
+    def setUp(self):
+        super(TestCordexCheckJobs, self).setUp()
+
+        # incoming is not tmpdir/output.
+        self.incoming = self.tmpdir
+
+    def _init_drs_fs(self):
+        self.drs_fs = CordexFileSystem(self.tmpdir)
+
+    def _discover(self, jobs):
+        dt = DRSTree(self.drs_fs)
+        dt.set_check_jobs(jobs)
+        dt.discover(self.incoming, activity='cordex',
+                    product='output', frequency='day')
+        return dt
+
+    def _failures(self, dt):
+        return [(k, list(dt.pub_trees[k].list_failures()))
+                for k in sorted(dt.pub_trees)]
+
+    def test_1(self):
+        # Concurrent checks report the same failures as serial checks
+        dt = self._discover(1)
+        for k in sorted(dt.pub_trees)[::3]:
+            pt = dt.pub_trees[k]
+            pt.do_version(20100101)
+            os.remove(os.path.join(pt.pub_dir, 'latest'))
+
+        failures = self._failures(self._discover(1))
+        assert len([k for k, f in failures if f]) == 17
+        assert self._failures(self._discover(4)) == failures
+
+class TestCordexDescent(TestListing):
+    __test__ = True
+
+    listing_file = 'cordex_test_EUR-44.ls'
+
+    def setUp(self):
+        super(TestCordexDescent, self).setUp()
+
+        self.incoming = self.tmpdir
+        dt = DRSTree(self.drs_fs)
+        dt.discover_incoming(self.incoming, activity='cordex', 
+                             product='output', frequency='day')
+        for drs_id in sorted(dt.pub_trees):
+            dt.pub_trees[drs_id].do_version(20100101)
+
+    def _init_drs_fs(self):
+        self.drs_fs = CordexFileSystem(self.tmpdir)
+
+    def test_1(self):
+        # The descent finds the same paths as glob
+        from glob import glob
+        for components in [dict(), dict(frequency='day'), dict(variable='tas'),
+                           dict(institute='MOHC', variable='clt')]:
+            drs = CordexDRS(activity='cordex', product='output', **components)
+            expected = sorted(glob(self.drs_fs.drs_to_publication_path(drs)))
+            assert len(expected) > 0
+            for jobs in [1, 4]:
+                assert self.drs_fs.find_publication_paths(drs, jobs=jobs) == expected
+
+    def test_2(self):
+        # Pruning and exclusion stop the descent
+        drs = CordexDRS(activity='cordex', product='output')
+        paths = self.drs_fs.find_publication_paths(drs)
+        variables = set(os.path.basename(x) for x in paths)
+        assert len(variables) > 1
+
+        pruned = self.drs_fs.find_publication_paths(drs, vocabularies={'variable': set(['tas'])})
+        assert pruned == [x for x in paths if x.endswith('/tas')]
+
+        exclude = os.path.join(self.tmpdir, 'output', 'EUR-44', '*')
+        assert self.drs_fs.find_publication_paths(drs, exclude=exclude, jobs=4) == []
+        assert self.drs_fs.find_publication_paths(drs, exclude=self.tmpdir) == []
+
+def test_8():
+    # Partial or temporary files are not mistaken for DRS files
+    from drslib.translate import TranslationError
+
+    filename = 'tas_EUR-44_ICHEC-EC-EARTH_historical_r12i1p1_SMHI-RCA4_v1_day_19710101-19751231.nc'
+    assert cordex_fs.filename_to_drs(filename).variable == 'tas'
+    for suffix in ['.part', '.tmp']:
+        try:
+            cordex_fs.filename_to_drs(filename + suffix)
+        except TranslationError:
+            pass
+        else:
+            assert False, 'Accepted %s' % (filename + suffix)
+
+def test_9():
+    # Components that cannot be encoded are not formatted into paths
+    class PartialDRS(CordexDRS):
+        @classmethod
+        def _encode_component(klass, component, value):
+            if component == 'domain':
+                return None
+            return CordexDRS._encode_component(component, value)
+
+    class PartialFileSystem(CordexFileSystem):
+        drs_cls = PartialDRS
+
+    drs = PartialDRS.from_dataset_id('cordex.output.AFR-44.MOHC.ECMWF-ERAINT.evaluation.r0i0p0.MOHC-HadRM3P.v1.fx.areacella')
+    try:
+        PartialFileSystem('/cordex').drs_to_publication_path(drs)
+    except ValueError:
+        pass
+    else:
+        assert False, 'Path made from an incomplete DRS'
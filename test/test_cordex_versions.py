@@ -0,0 +1,27 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test CORDEX datasets with several versions.
+
+Tests of particular features using this dataset live with the feature:
+test_publisher_tree, test_drs_tree_check, test_check_cache and
+test_listing.
+
+"""
+
+from drs_tree_shared import TestCordexVersionsEg, cordex_version_filenames as filenames
+
+
+class TestCordexVersions(TestCordexVersionsEg):
+    __test__ = True
+
+    def test_versions_link_all_files(self):
+        v1, v2 = self.versions
+        assert self.pt.state == self.pt.STATE_VERSIONED
+        assert self._links(v1) == filenames[:3]
+        assert self._links(v2) == filenames
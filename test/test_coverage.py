@@ -0,0 +1,135 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test temporal coverage analysis.
+
+"""
+
+import os
+import os.path as op
+import json
+import sys
+
+from drslib.cordex import CordexFileSystem
+from drslib.coverage import analyse_coverage
+from drslib.drs_command import main as drstool_main
+
+from drs_tree_shared import TestEg
+import gen_drs
+
+cordex_fs = CordexFileSystem('/cordex')
+
+prefix = 'EUR-44_ICHEC-EC-EARTH_historical_r12i1p1_SMHI-RCA4_v1'
+filenames = [
+    # Contiguous, including the end of a 360-day year
+    'tas_%s_day_19710101-19751231.nc' % prefix,
+    'tas_%s_day_19760101-19801230.nc' % prefix,
+    # A year missing
+    'tas_%s_day_19820101-19851231.nc' % prefix,
+    # Overlapping the previous file
+    'tas_%s_day_19850601-19901231.nc' % prefix,
+    # Sub-daily time points on a no-leap calendar
+    'pr_%s_6hr_1972010100-1972022818.nc' % prefix,
+    'pr_%s_6hr_1972030100-1972123118.nc' % prefix,
+    'ts_%s_mon_197101-198012.nc' % prefix,
+    'ts_%s_mon_198102-198112.nc' % prefix,
+    'orog_%s_fx.nc' % prefix,
+    ]
+
+
+def _coverage(names):
+    records = analyse_coverage((x, cordex_fs.filename_to_drs(x)) for x in names)
+    return dict((r['variable'], r) for r in records)
+
+
+def test_1():
+    coverage = _coverage(filenames)
+    assert sorted(coverage) == ['pr', 'tas', 'ts']
+
+    tas = coverage['tas']
+    assert tas['files'] == 4
+    assert tas['start'] == '1971-01-01 00:00:00'
+    assert tas['end'] == '1991-01-01 00:00:00'
+    assert len(tas['gaps']) == 1 and len(tas['overlaps']) == 1
+
+    (gap, ) = tas['gaps']
+    assert (gap['start'], gap['end'], gap['days']) == ('1981-01-01 00:00:00', '1982-01-01 00:00:00', 365)
+    assert gap['after'] == filenames[1] and gap['before'] == filenames[2]
+
+    (overlap, ) = tas['overlaps']
+    assert (overlap['start'], overlap['end']) == ('1985-06-01 00:00:00', '1986-01-01 00:00:00')
+    assert overlap['files'] == filenames[2:4]
+    assert tas['covered_days'] == tas['span_days'] - 365
+
+def test_2():
+    coverage = _coverage(filenames)
+
+    pr = coverage['pr']
+    assert pr['gaps'] == pr['overlaps'] == []
+    assert pr['end'] == '1973-01-01 00:00:00'
+    assert pr['covered_days'] == pr['span_days'] == 366
+
+    ts = coverage['ts']
+    assert [(g['start'], g['end']) for g in ts['gaps']] == [('1981-01-01 00:00:00', '1981-02-01 00:00:00')]
+
+def test_3():
+    # A file contained in another overlaps it but leaves no gap
+    names = ['tas_%s_day_19710101-19801231.nc' % prefix,
+             'tas_%s_day_19750101-19751231.nc' % prefix,
+             'tas_%s_day_19810101-19851231.nc' % prefix]
+    tas = _coverage(names)['tas']
+
+    assert tas['gaps'] == []
+    assert [o['files'] for o in tas['overlaps']] == [names[:2]]
+    assert tas['covered_days'] == tas['span_days']
+
+
+class TestCoverageCommand(TestEg):
+    __test__ = True
+
+    def setUp(self):
+        super(TestCoverageCommand, self).setUp()
+
+        self.drs_root = op.join(self.tmpdir, 'cordex')
+        os.mkdir(self.drs_root)
+        gen_drs.write_listing_seq(self.incoming, filenames)
+
+    def _drs_tool(self, *args):
+        drstool_main(['drs_tool'] + list(args) + ['--scheme=cordex', '-R', self.drs_root,
+                                                  '-I', self.incoming, 'cordex.output'])
+
+    def test_1(self):
+        report = op.join(self.tmpdir, 'coverage.json')
+        self._drs_tool('upgrade', '-c', 'variable=tas')
+        self._drs_tool('coverage', '--report', report)
+
+        records = json.load(open(report))['coverage']
+        assert [(r['variable'], r['version']) for r in records] == [
+            ('pr', None), ('tas', self.today), ('ts', None)]
+        assert len(records[1]['gaps']) == 1
+
+        drstool_main(['drs_tool', 'merge', report])
+
+    def test_2(self):
+        # Without NumPy coverage fails with a usage error but merge works
+        report = op.join(self.tmpdir, 'coverage.json')
+        self._drs_tool('coverage', '--report', report)
+
+        saved = dict((k, sys.modules[k]) for k in ['numpy', 'drslib.coverage'])
+        sys.modules['numpy'] = None
+        del sys.modules['drslib.coverage']
+        try:
+            try:
+                self._drs_tool('coverage')
+            except SystemExit, e:
+                assert e.code == 2
+            else:
+                assert False, 'coverage ran without NumPy'
+            drstool_main(['drs_tool', 'merge', report])
+        finally:
+            sys.modules.update(saved)
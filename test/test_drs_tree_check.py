@@ -0,0 +1,53 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test checking and repair of version links.
+
+"""
+
+import os
+import os.path as op
+
+from drs_tree_shared import TestCordexVersionsEg, cordex_version_filenames as filenames
+
+
+class TestVersionLinks(TestCordexVersionsEg):
+    __test__ = True
+
+    def test_repair_replaces_only_wrong_links(self):
+        v1, v2 = self.versions
+        vdir = op.join(self.pt.pub_dir, 'v%d' % v2)
+        good = op.join(vdir, filenames[0])
+        good_ino = os.lstat(good).st_ino
+
+        os.remove(op.join(vdir, filenames[1]))
+        wrong = op.join(vdir, filenames[2])
+        os.remove(wrong)
+        os.symlink(os.readlink(op.join(vdir, filenames[3])), wrong)
+
+        (pt, ) = self._discover().pub_trees.values()
+        assert pt.state == pt.STATE_BROKEN
+        stats = pt._checker_failures[0].get_stats()
+        assert stats == {'Missing links': 1, 'Links to wrong file': 1}
+
+        pt.repair()
+        assert pt.state == pt.STATE_VERSIONED
+        assert self._links(v2) == filenames
+        assert os.readlink(wrong).endswith(filenames[2])
+        assert os.lstat(good).st_ino == good_ino
+
+    def test_overlapping_files_are_unfixable(self):
+        v1, v2 = self.versions
+        vdir = op.join(self.pt.pub_dir, 'v%d' % v2)
+        extra = filenames[1].replace('19910101-19951231', '19950101-19951231')
+        os.symlink(os.readlink(op.join(vdir, filenames[1])), op.join(vdir, extra))
+
+        (pt, ) = self._discover().pub_trees.values()
+        checker = pt._checker_failures[0]
+        assert checker.get_stats() == {'Overlapping files in version': 1}
+        assert not checker.is_fixable()
@@ -0,0 +1,98 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test columnar inventories of DRS trees.
+
+"""
+
+import os
+import os.path as op
+
+from drslib.cordex import CordexFileSystem
+from drslib.inventory import DRSInventory
+
+from drs_tree_shared import TestListing
+
+
+class TestInventory(TestListing):
+    __test__ = True
+
+    listing_file = 'cordex_test_EUR-44.ls'
+
+    def setUp(self):
+        super(TestInventory, self).setUp()
+
+        # incoming is not tmpdir/output.
+        self.incoming = self.tmpdir
+
+        self.dt.discover(self.incoming, activity='cordex',
+                         product='output', frequency='day')
+        for drs_id in sorted(self.dt.pub_trees)[:10]:
+            self.dt.pub_trees[drs_id].do_version(20120101)
+        self.dt.discover(self.incoming, activity='cordex',
+                         product='output', frequency='day')
+
+    def _init_drs_fs(self):
+        self.drs_fs = CordexFileSystem(self.tmpdir)
+
+    def test_1(self):
+        inv = self.dt.to_inventory()
+        drspaths = [(fp, drs) for pt in self.dt.pub_trees.values()
+                    for fp, drs in pt.versions.get(20120101, [])]
+
+        assert len(inv) == len(drspaths) > 0
+        assert set(inv.path) == set(fp for fp, drs in drspaths)
+        assert set(inv.version) == set([20120101])
+        assert inv.size.sum() == sum(os.stat(fp).st_size for fp, drs in drspaths)
+
+        inv = self.dt.to_inventory(with_incoming=True)
+        assert len(inv) == len(drspaths) + len(self.dt.incoming)
+        assert set(inv.version) == set([0, 20120101])
+
+    def test_2(self):
+        inv = self.dt.to_inventory(with_incoming=True)
+        drs = self.dt.incoming[0][1]
+
+        sel = inv.select(variable=drs.variable, rcm_model=[drs.rcm_model, 'nothing'])
+        expected = self.dt.incoming.select(variable=drs.variable, rcm_model=drs.rcm_model)
+        assert len(sel) == len(expected) > 0
+        assert set(sel.column('variable')) == set([drs.variable])
+        assert set(inv.select(version=0).path) == set(fp for fp, drs in self.dt.incoming)
+        assert len(inv.select(inv.size < 0)) == 0
+
+    def test_3(self):
+        inv = self.dt.to_inventory(with_incoming=True)
+
+        counts = inv.aggregate(['rcm_model', 'variable'], 'size', 'count')
+        sizes = inv.aggregate(['rcm_model', 'variable'], 'size', 'sum')
+        assert sum(counts.values()) == len(inv)
+        assert sum(sizes.values()) == inv.size.sum()
+
+        drs = self.dt.incoming[0][1]
+        key = (drs.rcm_model, drs.variable)
+        sel = inv.select(rcm_model=drs.rcm_model, variable=drs.variable)
+        assert counts[key] == len(sel)
+        assert sizes[key] == sel.size.sum()
+
+        latest = inv.aggregate('variable', 'version', 'max')
+        assert set(latest.values()) <= set([0, 20120101])
+        nversions = inv.aggregate('variable', 'version', 'nunique')
+        assert max(nversions.values()) == 2
+        assert min(inv.aggregate('variable', 'mtime', 'min').values()) > 0
+
+    def test_4(self):
+        inv = self.dt.to_inventory(with_incoming=True)
+        filename = op.join(self.tmpdir, 'inventory.npz')
+        inv.save(filename)
+
+        inv2 = DRSInventory.load(filename)
+        assert inv2.components == inv.components
+        assert list(inv2.path) == list(inv.path)
+        assert (inv2.size == inv.size).all()
+        assert (inv2.column('ensemble') == inv.column('ensemble')).all()
+        assert inv2.aggregate('domain') == inv.aggregate('domain')
@@ -0,0 +1,126 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test resuming interrupted upgrades from the upgrade journal.
+
+"""
+
+import os
+import os.path as op
+
+from drslib.drs_tree import DRSTree
+from drslib.cordex import CordexFileSystem
+from drslib.publisher_tree import PublisherTree, _plan_commands
+
+from drs_tree_shared import TestEg, test_dir
+import gen_drs
+
+
+class TestJournal(TestEg):
+    __test__ = True
+
+    listing_file = 'cordex_test_EUR-44.ls'
+
+    def setUp(self):
+        super(TestJournal, self).setUp()
+
+        # Keep incoming outside the DRS root so that files moved before
+        # an interruption are not rediscovered.
+        self.incoming = op.join(self.tmpdir, 'incoming')
+        gen_drs.write_listing(self.incoming, op.join(test_dir, self.listing_file))
+
+        self._init_drs_fs()
+        self._discover()
+
+    def _init_drs_fs(self):
+        drs_root = op.join(self.tmpdir, 'cordex')
+        os.mkdir(drs_root)
+        self.drs_fs = CordexFileSystem(drs_root)
+
+    def _discover(self):
+        self.dt = DRSTree(self.drs_fs)
+        self.dt.discover(self.incoming, activity='cordex',
+                         product='output',
+                         frequency='day',
+                         variable='vas')
+        (self.pt, ) = self.dt.pub_trees.values()
+
+    def _interrupt(self, n):
+        # Start an upgrade then stop after n commands
+        pt = self.pt
+        pt._setup_versioning()
+        commands = _plan_commands(pt.todo_commands(self.today))
+        journal = pt._journal()
+        journal.begin(self.today, commands)
+        pt._do_commands(commands[:n], journal)
+        journal.close()
+
+        return commands
+
+    def test_1(self):
+        self.pt.do_version()
+
+        assert self.pt.state == self.pt.STATE_VERSIONED
+        assert not self.pt.has_journal()
+
+    def test_2(self):
+        commands = self._interrupt(3)
+
+        self._discover()
+        assert self.pt.has_journal()
+
+        count = self.pt.resume()
+        assert count == len(commands) - 3
+        assert not self.pt.has_journal()
+        assert self.pt.state == self.pt.STATE_VERSIONED
+        assert self.pt.versions.keys() == [self.today]
+
+    def test_3(self):
+        # A command completed but not recorded is not repeated
+        commands = self._interrupt(3)
+        cmd, src, dest = commands[3]
+        assert cmd == self.pt.CMD_MOVE
+        os.rename(src, dest)
+
+        self._discover()
+        count = self.pt.resume()
+        assert count == len(commands) - 4
+        assert self.pt.state == self.pt.STATE_VERSIONED
+
+    def test_4(self):
+        self._interrupt(3)
+
+        self._discover()
+        self.assertRaises(Exception, self.pt.do_version)
+
+    def test_moved_file_missing_from_incoming_fails(self):
+        # Only journal replay tolerates sources missing from incoming.
+        # A second tree for the same dataset still has the moved files
+        # in its todo list.
+        pt2 = PublisherTree(self.pt.drs, self.dt)
+        assert pt2.count_todo() > 0
+        self.pt.do_version()
+        self.assertRaises(Exception, pt2.do_version, self.today + 1)
+
+    def test_failed_move_is_not_done(self):
+        commands = _plan_commands(self.pt.todo_commands(self.today))
+        moves = [i for i, (cmd, src, dest) in enumerate(commands)
+                 if cmd == self.pt.CMD_MOVE]
+        i = moves[1]
+        src = commands[i][1]
+        os.rename(src, src + '.away')
+        self.assertRaises(Exception, self.pt.do_version, self.today)
+
+        version, journaled, done = self.pt._journal().read()
+        assert moves[0] in done and i not in done
+
+        os.rename(src + '.away', src)
+        self._discover()
+        self.pt.resume()
+        assert self.pt.state == self.pt.STATE_VERSIONED
+        assert op.exists(commands[i][2])
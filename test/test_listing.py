@@ -0,0 +1,86 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test the run-scoped directory listing cache.
+
+"""
+
+import os
+import os.path as op
+
+from drs_tree_shared import TestCordexVersionsEg, cordex_version_filenames as filenames
+import gen_drs
+
+
+class TestListingCache(TestCordexVersionsEg):
+    __test__ = True
+
+    def setUp(self):
+        super(TestListingCache, self).setUp()
+
+        self.listed = []
+        self._listdir = os.listdir
+        def counting(path):
+            self.listed.append(op.normpath(path))
+            return self._listdir(path)
+        os.listdir = counting
+
+    def tearDown(self):
+        os.listdir = self._listdir
+        super(TestListingCache, self).tearDown()
+
+    def _upgrade_one(self):
+        v1, v2 = self.versions
+        gen_drs.write_listing_seq(self.incoming,
+                                  [filenames[0].replace('19900101-19901231', '19890101-19891231')])
+        dt = self._discover()
+        (pt, ) = dt.pub_trees.values()
+        pt.do_version(v2 + 1)
+        return dt, pt
+
+    def test_directories_listed_once_per_run(self):
+        dt, pt = self._upgrade_one()
+        assert self.listed.count(op.normpath(pt.pub_dir)) == 1
+        assert self.listed.count(op.join(pt.pub_dir, 'files')) == 1
+
+    def test_version_directories_listed_once_per_run(self):
+        v1, v2 = self.versions
+        dt, pt = self._upgrade_one()
+        pt.list_files(v2)
+        for version in self.versions:
+            pt._link_map(version)
+        for version in [v1, v2, v2 + 1]:
+            assert self.listed.count(op.join(pt.pub_dir, 'v%d' % version)) <= 1
+
+    def test_listings_updated_in_place(self):
+        v1, v2 = self.versions
+        dt, pt = self._upgrade_one()
+        assert pt.state == pt.STATE_VERSIONED
+        assert sorted(pt.versions.keys()) == [v1, v2, v2 + 1]
+        assert dt.listings.exists(op.join(pt.pub_dir, 'v%d' % (v2 + 1), filenames[0]))
+
+    def test_rescan_sees_changes_by_hand(self):
+        dt, pt = self._upgrade_one()
+        os.remove(op.join(pt.pub_dir, 'latest'))
+        assert dt.listings.exists(op.join(pt.pub_dir, 'latest'))
+        pt.deduce_state()
+        assert pt.state == pt.STATE_BROKEN
+
+    def test_copy_keeps_source_listed(self):
+        v1, v2 = self.versions
+        gen_drs.write_listing_seq(self.incoming,
+                                  [filenames[0].replace('19900101-19901231', '19890101-19891231')])
+        dt = self._discover()
+        dt.set_move_cmd('cp')
+        (pt, ) = dt.pub_trees.values()
+        ((src, drs), ) = pt._todo
+        dt.listings.listdir(op.dirname(src))
+
+        pt.do_version(v2 + 1)
+        assert op.exists(src)
+        assert dt.listings.exists(src)
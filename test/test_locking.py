@@ -0,0 +1,202 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test locking of publication-level datasets.
+
+"""
+
+import os
+import os.path as op
+import sys
+import errno
+import socket
+import StringIO
+import subprocess
+import threading
+import time
+
+from drslib.drs_tree import DRSTree
+from drslib.cordex import CordexFileSystem
+from drslib import locking
+from drslib.locking import PubDirLock, LockTimeout, LOCK_FILE
+from drslib.drs_command import main as drstool_main
+
+from drs_tree_shared import TestEg, test_dir
+import gen_drs
+
+
+class TestLocking(TestEg):
+    __test__ = True
+
+    listing_file = 'cordex_test_EUR-44.ls'
+
+    def setUp(self):
+        super(TestLocking, self).setUp()
+
+        self._poll_interval = locking.POLL_INTERVAL
+        locking.POLL_INTERVAL = 0.01
+
+        self.incoming = op.join(self.tmpdir, 'incoming')
+        gen_drs.write_listing(self.incoming, op.join(test_dir, self.listing_file))
+
+        drs_root = op.join(self.tmpdir, 'cordex')
+        os.mkdir(drs_root)
+        self.drs_fs = CordexFileSystem(drs_root)
+
+    def tearDown(self):
+        locking.POLL_INTERVAL = self._poll_interval
+        super(TestLocking, self).tearDown()
+
+    def _discover(self, on_locked=None):
+        dt = DRSTree(self.drs_fs)
+        dt.set_on_locked(on_locked)
+        dt.discover(self.incoming, activity='cordex',
+                    product='output',
+                    frequency='day',
+                    variable='vas')
+        return dt
+
+    def test_1(self):
+        pub_dir = op.join(self.tmpdir, 'pub')
+        lock = PubDirLock(pub_dir)
+
+        # Locking does not create the publication directory
+        self.assertRaises(IOError, lock.acquire)
+        assert not op.exists(pub_dir)
+
+        os.mkdir(pub_dir)
+        lock.acquire()
+        assert lock.is_locked()
+        assert lock.holder() == (socket.gethostname(), os.getpid())
+        assert os.listdir(pub_dir) == [LOCK_FILE]
+
+        # The holder is alive so the lock is not broken
+        lock2 = PubDirLock(pub_dir)
+        self.assertRaises(LockTimeout, lock2.acquire, timeout=0.05)
+
+        lock.release()
+        assert not lock.is_locked()
+        assert os.listdir(pub_dir) == []
+
+    def _write_lock(self, pub_dir, pid):
+        fh = open(op.join(pub_dir, LOCK_FILE), 'w')
+        fh.write('%s %d\n' % (socket.gethostname(), pid))
+        fh.close()
+
+    def _dead_pid(self):
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        return proc.pid
+
+    def test_2(self):
+        # A lock held by a dead process on this host is broken
+        pub_dir = op.join(self.tmpdir, 'pub')
+        os.mkdir(pub_dir)
+        self._write_lock(pub_dir, self._dead_pid())
+
+        lock = PubDirLock(pub_dir)
+        lock.acquire(timeout=1)
+        assert lock.holder() == (socket.gethostname(), os.getpid())
+        lock.release()
+
+    def test_break_stale_keeps_lock_taken_over(self):
+        # Another process breaks the stale lock and acquires it while
+        # this process decides the lock is stale
+        pub_dir = op.join(self.tmpdir, 'pub')
+        os.mkdir(pub_dir)
+        self._write_lock(pub_dir, self._dead_pid())
+
+        kill = os.kill
+        def racing_kill(pid, sig):
+            os.remove(op.join(pub_dir, LOCK_FILE))
+            self._write_lock(pub_dir, os.getpid())
+            raise OSError(errno.ESRCH, 'No such process')
+
+        lock = PubDirLock(pub_dir)
+        os.kill = racing_kill
+        try:
+            assert not lock._break_stale()
+        finally:
+            os.kill = kill
+
+        assert lock.holder() == (socket.gethostname(), os.getpid())
+        assert os.listdir(pub_dir) == [LOCK_FILE]
+
+    def test_3(self):
+        # Locks are reentrant and released after upgrading
+        (pt, ) = self._discover().pub_trees.values()
+        os.makedirs(pt.pub_dir)
+        with pt.locked():
+            pt.do_version()
+            assert pt.state == pt.STATE_VERSIONED
+            assert op.exists(op.join(pt.pub_dir, LOCK_FILE))
+        assert not op.exists(op.join(pt.pub_dir, LOCK_FILE))
+
+    def test_4(self):
+        (pt, ) = self._discover().pub_trees.values()
+        pt.do_version()
+
+        lock = PubDirLock(pt.pub_dir)
+        lock.acquire()
+        try:
+            dt = self._discover(on_locked='skip')
+            assert dt.pub_trees == {}
+            assert dt.locked == [pt.pub_dir]
+
+            dt = self._discover()
+            assert dt.pub_trees.values()[0].is_locked()
+        finally:
+            lock.release()
+
+        dt = self._discover(on_locked='wait')
+        assert len(dt.pub_trees) == 1
+
+    def test_5(self):
+        # An upgrade waiting for the lock rescans the dataset and does
+        # not repeat work done by the lock holder.
+        (pt1, ) = self._discover().pub_trees.values()
+        (pt2, ) = self._discover().pub_trees.values()
+
+        os.makedirs(pt1.pub_dir)
+        lock = PubDirLock(pt1.pub_dir)
+        lock.acquire()
+
+        thread = threading.Thread(target=pt1.do_version)
+        thread.start()
+        # Give the upgrade time to block on the lock
+        time.sleep(0.1)
+
+        # Upgrade pt2 as if it held the lock
+        pt2._lock = lock
+        pt2._lock_depth = 1
+        pt2.do_version()
+        pt2._lock_depth = 0
+        lock.release()
+
+        thread.join()
+        assert pt1.state == pt1.STATE_VERSIONED
+        assert pt1.count_todo() == 0
+        assert pt1.versions.keys() == [self.today]
+
+    def test_list_skips_locked_by_default(self):
+        (pt, ) = self._discover().pub_trees.values()
+        pt.do_version()
+
+        out = StringIO.StringIO()
+        lock = PubDirLock(pt.pub_dir)
+        lock.acquire()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            drstool_main(['drs_tool', 'list', '--scheme=cordex',
+                          '-R', self.drs_fs.drs_root, '-I', self.incoming,
+                          'cordex.output.EUR-44'])
+        finally:
+            sys.stdout = stdout
+            lock.release()
+
+        assert pt.drs.to_dataset_id() not in out.getvalue()
@@ -6,15 +6,21 @@ Test mapfile generation.
 import os
 import os.path as op
 import re
+import stat
+import json
+import hashlib
 import subprocess as S
 
+from nose.plugins.skip import SkipTest
+
 from drslib.drs_tree import DRSTree
 
 from drs_tree_shared import TestEg, test_dir
 import gen_drs
 from drslib.cmip5 import CMIP5FileSystem
+from drslib.cordex import CordexFileSystem
 
-from drslib.mapfile import calc_md5
+from drslib.mapfile import calc_md5, read_mapfile
 import StringIO
 
 class TestMapfile(TestEg):
@@ -47,3 +53,234 @@ class TestMapfile(TestEg):
                 print 'LINE:', line.strip()
                 print 'MD5: ', output.strip()
                 assert False
+
+
+class TestIngestChecksum(TestEg):
+    __test__ = True
+
+    filenames = [
+        'vas_EUR-44_ECMWF-ERAINT_evaluation_r1i1p1_MOHC-HadRM3P_v1_day_19900101-19901231.nc',
+        'vas_EUR-44_ECMWF-ERAINT_evaluation_r1i1p1_MOHC-HadRM3P_v1_day_19910101-19951231.nc',
+        ]
+
+    def setUp(self):
+        super(TestIngestChecksum, self).setUp()
+
+        drs_root = op.join(self.tmpdir, 'cordex')
+        os.mkdir(drs_root)
+        self.incoming = op.join(self.tmpdir, 'incoming')
+        gen_drs.write_listing_seq(self.incoming, self.filenames)
+
+        self.dt = DRSTree(CordexFileSystem(drs_root))
+        self.dt.set_move_cmd('cp')
+        self.dt.set_ingest_checksum('MD5')
+        self.dt.discover(self.incoming, activity='cordex',
+                         product='output', variable='vas')
+        (self.pt, ) = self.dt.pub_trees.values()
+        self.pt.do_version()
+
+    def test_1(self):
+        # Checksums calculated during ingest are used for the mapfile
+        calls = []
+        def checksum_func(path):
+            calls.append(path)
+            return calc_md5(path)
+
+        fh = StringIO.StringIO()
+        self.pt.version_to_mapfile(self.pt.latest, fh, checksum_func=checksum_func,
+                                   checksum_type='MD5')
+        assert calls == []
+
+        fh.seek(0)
+        records = list(read_mapfile(fh))
+        assert len(records) == len(self.filenames)
+        for dataset_id, path, size, params in records:
+            assert params['checksum_type'] == 'MD5'
+            assert params['checksum'] == calc_md5(path)[1]
+
+        # Incoming files were copied
+        for filename in self.filenames:
+            assert op.exists(op.join(self.incoming, filename))
+
+    def test_2(self):
+        # A modified file is checksummed again
+        path = self.pt.versions[self.pt.latest][0][0]
+        with open(path, 'a') as fh:
+            fh.write('modified')
+
+        calls = []
+        def checksum_func(path):
+            calls.append(path)
+            return calc_md5(path)
+
+        self.pt.version_to_mapfile(self.pt.latest, StringIO.StringIO(), checksum_func=checksum_func,
+                                   checksum_type='MD5')
+        assert calls == [path]
+
+    def test_3(self):
+        # Superseded checksums are dropped when the store is rewritten
+        path = self.pt.versions[self.pt.latest][0][0]
+        for i in range(5):
+            with open(path, 'a') as fh:
+                fh.write('modified')
+            self.pt.version_to_mapfile(self.pt.latest, StringIO.StringIO(), checksum_func=calc_md5)
+
+        with open(op.join(self.pt.pub_dir, '.drslib_checksums')) as fh:
+            records = [json.loads(line) for line in fh]
+        assert len(records) == len(self.filenames)
+        assert ([r['checksum'] for r in records if r['path'] == path] ==
+                [calc_md5(path)[1]])
+
+    def test_4(self):
+        # An unwritable store does not prevent ingest
+        if os.geteuid() == 0:
+            raise SkipTest('Permissions are not enforced for root')
+
+        store = op.join(self.pt.pub_dir, '.drslib_checksums')
+        os.chmod(store, stat.S_IRUSR)
+        extra = self.filenames[1].replace('19910101-19951231', '19960101-20001231')
+        gen_drs.write_listing_seq(self.incoming, [extra])
+        self.dt.discover_incoming(self.incoming, activity='cordex',
+                                  product='output', variable='vas')
+        self.pt.do_version(self.pt.latest + 1)
+
+        assert self.pt.state == self.pt.STATE_VERSIONED
+        assert len(self.pt.versions[self.pt.latest]) == len(self.filenames) + 1
+
+    def test_7(self):
+        # Move commands with options are run as configured
+        extra = self.filenames[1].replace('19910101-19951231', '19960101-20001231')
+        gen_drs.write_listing_seq(self.incoming, [extra])
+        self.dt.set_move_cmd('cp -p')
+        self.dt.discover_incoming(self.incoming, activity='cordex',
+                                  product='output', variable='vas')
+        self.pt.do_version(self.pt.latest + 1)
+
+        # cp leaves the files in incoming so all are copied again
+        store = self.pt.checksum_store()
+        assert [store.get(path) for path, drs in self.pt.versions[self.pt.latest]] == [None] * 3
+
+    def _sha256_mapfile(self, checksum_type):
+        def calc_sha256(path):
+            with open(path, 'rb') as fh:
+                return 'SHA256', hashlib.sha256(fh.read()).hexdigest()
+
+        fh = StringIO.StringIO()
+        self.pt.version_to_mapfile(self.pt.latest, fh, checksum_func=calc_sha256,
+                                   checksum_type=checksum_type)
+        fh.seek(0)
+        for dataset_id, path, size, params in read_mapfile(fh):
+            assert (params['checksum_type'], params['checksum']) == calc_sha256(path)
+
+    def test_5(self):
+        # Checksums of another type are not reused
+        self._sha256_mapfile('SHA256')
+
+    def test_6(self):
+        # Nor are they if the type is learnt from the checksum function
+        self._sha256_mapfile(None)
+
+
+class TestIncrementalMapfile(TestEg):
+    __test__ = True
+
+    filenames = TestIngestChecksum.filenames
+
+    def setUp(self):
+        super(TestIncrementalMapfile, self).setUp()
+
+        drs_root = op.join(self.tmpdir, 'cordex')
+        os.mkdir(drs_root)
+        self.drs_fs = CordexFileSystem(drs_root)
+        self.incoming = op.join(self.tmpdir, 'incoming')
+
+    def _discover(self):
+        dt = DRSTree(self.drs_fs)
+        dt.discover(self.incoming, activity='cordex',
+                    product='output', variable='vas')
+        (self.pt, ) = dt.pub_trees.values()
+
+    def _upgrade(self, filenames, version):
+        gen_drs.write_listing_seq(self.incoming, filenames)
+        self._discover()
+        self.pt.do_version(version)
+
+    def _mapfile(self, version, checksum_func=calc_md5, checksum_type='MD5'):
+        calls = []
+        def counting(path):
+            calls.append(path)
+            return checksum_func(path)
+
+        fh = StringIO.StringIO()
+        self.pt.version_to_mapfile(version, fh, checksum_func=counting,
+                                   checksum_type=checksum_type)
+        return fh.getvalue(), len(calls)
+
+    def _remove_caches(self):
+        for filename in ['.drslib_checksums', '.drslib_mapfile_index']:
+            path = op.join(self.pt.pub_dir, filename)
+            if op.exists(path):
+                os.remove(path)
+        self._discover()
+
+    def test_1(self):
+        # Only files new in a version are checksummed
+        extra = self.filenames[1].replace('19910101-19951231', '19960101-20001231')
+        self._upgrade(self.filenames, 20100101)
+        assert self._mapfile(20100101)[1] == 2
+
+        self._upgrade([extra], 20100102)
+        os.remove(op.join(self.pt.pub_dir, '.drslib_checksums'))
+        mapfile, calls = self._mapfile(20100102)
+        assert calls == 1
+
+        # The result is identical to a full rebuild
+        self._remove_caches()
+        assert self._mapfile(20100102) == (mapfile, 3)
+
+    def test_2(self):
+        # Modified files are checksummed again
+        self._upgrade(self.filenames, 20100101)
+        self._mapfile(20100101)
+        os.remove(op.join(self.pt.pub_dir, '.drslib_checksums'))
+        self._discover()
+
+        path = self.pt.versions[20100101][0][0]
+        with open(path, 'a') as fh:
+            fh.write('modified')
+        assert self._mapfile(20100101)[1] == 1
+
+    def test_3(self):
+        # A read-only archive does not prevent mapfile generation
+        if os.geteuid() == 0:
+            raise SkipTest('Permissions are not enforced for root')
+
+        self._upgrade(self.filenames, 20100101)
+        mapfile = self._mapfile(20100101)[0]
+        self._remove_caches()
+
+        mode = os.stat(self.pt.pub_dir).st_mode
+        os.chmod(self.pt.pub_dir, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        try:
+            assert self._mapfile(20100101) == (mapfile, 2)
+        finally:
+            os.chmod(self.pt.pub_dir, mode)
+
+        assert not [x for x in os.listdir(self.pt.pub_dir) if x.startswith('.drslib_')]
+
+    def test_4(self):
+        # Changing the checksum type checksums every file again
+        def calc_sha1(path):
+            with open(path, 'rb') as fh:
+                return 'SHA1', hashlib.sha1(fh.read()).hexdigest()
+
+        self._upgrade(self.filenames, 20100101)
+        self._mapfile(20100101)
+        os.remove(op.join(self.pt.pub_dir, '.drslib_checksums'))
+        self._discover()
+        mapfile = self._mapfile(20100101, calc_sha1, 'SHA1')
+        assert mapfile[1] == 2
+
+        # The result is identical to a full rebuild
+        self._remove_caches()
+        assert self._mapfile(20100101, calc_sha1, 'SHA1') == mapfile
@@ -0,0 +1,96 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test discovery of incoming directories holding files of several DRS schemes.
+
+"""
+
+import os
+import os.path as op
+
+from drslib import config
+from drslib.drs_tree import DRSTree, SchemeClassifier, discover_multi
+from drslib.cordex import CordexFileSystem
+from drslib.specs import SpecsFileSystem
+
+from drs_tree_shared import TestEg, test_dir
+import gen_drs
+
+schemes = ['specs', 'cordex', 'cmip']
+
+def _listing_filenames(listing_file):
+    for line in open(op.join(test_dir, listing_file)):
+        line = line.strip()
+        if line and line[0] != '#':
+            yield op.basename(line)
+
+def test_1():
+    # Every file in the test listings is sent to its own scheme
+    classifier = SchemeClassifier([(k, config.get_drs_scheme(k)) for k in schemes])
+    for listing_file, scheme in [('cordex_test_EUR-44.ls', 'cordex'),
+                                 ('specs_1.ls', 'specs'),
+                                 ('cmip5_test.ls', 'cmip'),
+                                 ('gridspec.ls', 'cmip')]:
+        for filename in _listing_filenames(listing_file):
+            assert classifier.classify(filename) == scheme
+
+    assert classifier.classify('tas_A1.SRESA1B_2.PCM1.atmm.2140-01_cat_2149-12.nc') is None
+    assert classifier.classify('.ftpaccess') is None
+
+
+class TestMultiScheme(TestEg):
+    __test__ = True
+
+    def setUp(self):
+        super(TestMultiScheme, self).setUp()
+
+        for listing_file in ['cordex_test_EUR-44.ls', 'specs_2.ls']:
+            gen_drs.write_listing(self.incoming, op.join(test_dir, listing_file))
+
+        self.drs_fss = []
+        for scheme, fs_cls in [('specs', SpecsFileSystem), ('cordex', CordexFileSystem)]:
+            drs_root = op.join(self.tmpdir, scheme)
+            os.mkdir(drs_root)
+            self.drs_fss.append((scheme, fs_cls(drs_root)))
+        self.drs_trees = self._make_trees()
+
+        self.components = {
+            'cordex': dict(activity='cordex', product='output', frequency='day'),
+            'specs': dict(activity='specs', product='output', institute='IPSL',
+                          realm='atmos', frequency='day'),
+            }
+
+    def _make_trees(self):
+        return [(scheme, DRSTree(drs_fs)) for scheme, drs_fs in self.drs_fss]
+
+    def test_1(self):
+        unmatched = discover_multi(self.drs_trees, self.incoming, self.components)
+        assert [filename for filename, dirpath in unmatched] == ['.ftpaccess']
+
+        # Each tree is populated as if it had been discovered on its own
+        for scheme, dt in self.drs_trees:
+            dt2 = DRSTree(dt.drs_fs)
+            dt2.discover(self.incoming, **self.components[scheme])
+            assert sorted(dt.pub_trees) == sorted(dt2.pub_trees)
+            assert sorted(dt.incoming) == sorted(dt2.incoming)
+            assert len(dt.pub_trees) > 0
+
+    def test_2(self):
+        # Existing PublisherTrees are discovered
+        discover_multi(self.drs_trees, self.incoming, self.components)
+        for scheme, dt in self.drs_trees:
+            for pt in dt.pub_trees.values():
+                pt.do_version(20120101)
+
+        drs_trees = self._make_trees()
+        discover_multi(drs_trees, self.incoming, self.components)
+        for scheme, dt in drs_trees:
+            assert len(dt.pub_trees) > 0
+            assert dt.incoming == []
+            for pt in dt.pub_trees.values():
+                assert pt.versions.keys() == [20120101]
@@ -0,0 +1,137 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test staged pipelines and pipelined discovery of incoming files.
+
+"""
+
+import os
+import os.path as op
+import threading
+import time
+
+from nose.tools import raises
+
+from drslib.pipeline import Stage, Pipeline
+from drslib.drs_tree import DRSTree
+from drslib.cordex import CordexFileSystem
+
+from drs_tree_shared import TestEg, test_dir
+import gen_drs
+
+
+def test_1():
+    # Single job stages preserve order and batch their input
+    sizes = []
+    def double(batch):
+        sizes.append(len(batch))
+        return [x * 2 for x in batch]
+
+    pipeline = Pipeline([Stage('double', double, batch_size=3),
+                         Stage('inc', lambda batch: [x + 1 for x in batch])])
+    assert list(pipeline.run(xrange(10))) == [x * 2 + 1 for x in range(10)]
+    assert sizes == [3, 3, 3, 1]
+
+def test_2():
+    # Concurrent stages see every item once and finish after the last batch
+    seen = []
+    def collect(batch):
+        seen.extend(batch)
+        return []
+    def finish():
+        yield len(seen)
+
+    pipeline = Pipeline([Stage('square', lambda batch: [x * x for x in batch],
+                               jobs=4, batch_size=7, queue_size=2),
+                         Stage('collect', collect, jobs=3, finish=finish)])
+    assert list(pipeline.run(xrange(1000))) == [1000]
+    assert sorted(seen) == [x * x for x in range(1000)]
+
+def test_3():
+    # Bounded queues hold back the source
+    fed = []
+    results = []
+    release = threading.Event()
+    def source():
+        for i in range(100):
+            fed.append(i)
+            yield i
+    def slow(batch):
+        release.wait()
+        return batch
+
+    pipeline = Pipeline([Stage('slow', slow, batch_size=2, queue_size=1)])
+    consumer = threading.Thread(target=lambda: results.extend(pipeline.run(source())))
+    consumer.start()
+    try:
+        time.sleep(0.5)
+        # One batch in the stage, one queued and one waiting to be queued
+        assert len(fed) <= 6
+    finally:
+        release.set()
+        consumer.join()
+    assert results == range(100)
+
+@raises(ZeroDivisionError)
+def test_4():
+    # Errors are raised once the pipeline has drained
+    pipeline = Pipeline([Stage('div', lambda batch: [1 / x for x in batch], jobs=2),
+                         Stage('id', lambda batch: batch)])
+    list(pipeline.run([1, 2, 0, 4] * 50))
+
+
+class TestPipelineDiscovery(TestEg):
+    __test__ = True
+
+    components = dict(activity='cordex', product='output', frequency='day')
+
+    def setUp(self):
+        super(TestPipelineDiscovery, self).setUp()
+
+        gen_drs.write_listing(self.incoming, op.join(test_dir, 'cordex_test_EUR-44.ls'))
+        drs_root = op.join(self.tmpdir, 'cordex')
+        os.mkdir(drs_root)
+        self.drs_fs = CordexFileSystem(drs_root)
+
+    def _discover(self, stage_options=None):
+        dt = DRSTree(self.drs_fs)
+        dt.set_pipeline(stage_options)
+        dt.discover(self.incoming, **self.components)
+        return dt
+
+    def test_1(self):
+        # Pipelined discovery finds the same datasets and files
+        dt1 = self._discover()
+        dt2 = self._discover({'translate': {'jobs': 2, 'batch_size': 5},
+                              'detect': {'jobs': 4},
+                              'action': {'jobs': 3}})
+        assert len(dt1.pub_trees) > 1
+        assert sorted(dt1.pub_trees) == sorted(dt2.pub_trees)
+        assert sorted(dt1.incoming) == sorted(dt2.incoming)
+        for drs_id, pt in dt2.pub_trees.items():
+            assert pt.count_todo() == dt1.pub_trees[drs_id].count_todo()
+
+    def test_2(self):
+        # Actions receive whole datasets
+        dt = DRSTree(self.drs_fs)
+        groups = {}
+        def action(drs_id, files):
+            assert drs_id not in groups
+            groups[drs_id] = sorted(filename for filename, dirpath, drs in files)
+
+        dt.discover_incoming_pipeline(self.incoming, action=action, **self.components)
+        assert dt.incoming == [] and dt.pub_trees == {}
+
+        dt2 = self._discover()
+        assert sorted(groups) == sorted(dt2.pub_trees)
+        for drs_id, pt in dt2.pub_trees.items():
+            assert groups[drs_id] == sorted(op.basename(path) for path, drs in pt._todo)
+
+    @raises(ValueError)
+    def test_3(self):
+        DRSTree(self.drs_fs).discover_incoming_pipeline(self.incoming, {'walk': {'jobs': 2}})
@@ -0,0 +1,162 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test PublisherTree link sets, lazy version lists, state tracking and
+version diffs.
+
+"""
+
+import os
+import os.path as op
+import shutil
+import sys
+import json
+import StringIO
+
+from drslib.drs_tree import DRSTree
+from drslib.publisher_tree import PublisherTree
+from drslib.drs_command import main as drstool_main
+
+from drs_tree_shared import TestCordexVersionsEg, cordex_version_filenames as filenames
+import gen_drs
+
+
+class TestLinkMap(TestCordexVersionsEg):
+    __test__ = True
+
+    def test_read_from_version_dir(self):
+        v1, v2 = self.versions
+        link_map = self.pt._link_map(v1)
+        assert sorted(link_map) == filenames[:3]
+
+        filepath, link_subdir = link_map[filenames[0]]
+        assert filepath == op.join(self.pt.pub_dir, 'files', 'd%d' % v1, filenames[0])
+        assert link_subdir == '.'
+
+    def test_rebuilt_from_files_without_version_dir(self):
+        v1, v2 = self.versions
+        shutil.rmtree(op.join(self.pt.pub_dir, 'v%d' % v2))
+        self.pt.deduce_state()
+
+        link_map = self.pt._link_map(v2)
+        assert sorted(link_map) == filenames
+
+    def test_broken_link_rebuilt_from_files(self):
+        v1, v2 = self.versions
+        link = op.join(self.pt.pub_dir, 'v%d' % v2, filenames[0])
+        os.remove(link)
+        os.symlink(op.join('..', 'files', 'd%d' % v2, filenames[0]), link)
+
+        (pt, ) = self._discover().pub_trees.values()
+        link_map = pt._link_map(v2)
+        assert sorted(link_map) == filenames
+        assert link_map[filenames[0]] == (
+            op.join(pt.pub_dir, 'files', 'd%d' % v1, filenames[0]), '.')
+
+
+class TestLazyVersions(TestCordexVersionsEg):
+    __test__ = True
+
+    def test_only_latest_loaded_by_listing(self):
+        v1, v2 = self.versions
+        pt = self._discover().pub_trees.values()[0]
+
+        assert sorted(pt.versions) == [v1, v2]
+        assert not pt.versions.is_loaded(v1) and not pt.versions.is_loaded(v2)
+        assert pt.prev_versions(v2) == [v1]
+
+        assert pt.count() == len(filenames)
+        assert pt.versions.is_loaded(v2)
+        assert not pt.versions.is_loaded(v1)
+
+        assert len(pt.versions[v1]) == 3
+        assert sorted(len(x) for x in pt.versions.values()) == [3, len(filenames)]
+
+    def test_copies_and_items_are_loaded(self):
+        v1, v2 = self.versions
+        pt = self._discover().pub_trees.values()[0]
+        assert not pt.versions.is_loaded(v1)
+
+        for versions in [pt.versions.copy(), dict(pt.versions),
+                         dict(pt.versions.items())]:
+            assert sorted(versions) == [v1, v2]
+            assert [len(versions[v]) for v in (v1, v2)] == [3, len(filenames)]
+        assert pt.versions.is_loaded(v1) and pt.versions.is_loaded(v2)
+        assert len(pt.versions.pop(v1)) == 3
+        assert sorted(pt.versions) == [v2]
+
+
+class TestStateTracking(TestCordexVersionsEg):
+    __test__ = True
+
+    def test_scanned_once_per_discovery_and_upgrade(self):
+        calls = []
+        def counting(name):
+            method = PublisherTree.__dict__[name]
+            def wrapper(pt, *args, **kwargs):
+                calls.append(name)
+                return method(pt, *args, **kwargs)
+            return wrapper
+
+        v1, v2 = self.versions
+        gen_drs.write_listing_seq(self.incoming,
+                                  [filenames[0].replace('19900101-19901231', '19890101-19891231')])
+        saved = {}
+        for name in ['_deduce_versions', '_deduce_todo', '_check_tree']:
+            saved[name] = PublisherTree.__dict__[name]
+            setattr(PublisherTree, name, counting(name))
+        try:
+            dt = self._discover()
+            (pt, ) = dt.pub_trees.values()
+            assert pt.count_todo() == 1
+            assert sorted(calls) == ['_check_tree', '_deduce_todo', '_deduce_todo', '_deduce_versions']
+
+            del calls[:]
+            pt.do_version(v2 + 1)
+            assert sorted(calls) == ['_check_tree', '_deduce_todo', '_deduce_versions']
+            assert pt.state == pt.STATE_VERSIONED
+        finally:
+            for name, method in saved.items():
+                setattr(PublisherTree, name, method)
+
+
+class TestDiff(TestCordexVersionsEg):
+    __test__ = True
+
+    def _diff_all(self, *args):
+        out = StringIO.StringIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            drstool_main(['drs_tool', 'diff', '--all', '--scheme=cordex',
+                          '-R', self.drs_fs.drs_root, '-I', self.incoming,
+                          'cordex.output'] + list(args))
+        finally:
+            sys.stdout = stdout
+
+        return [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_diff_all_versions_as_json(self):
+        v1, v2 = self.versions
+        records = self._diff_all(str(v1), str(v2))
+        assert [(r['diff'], r['filename']) for r in records] == [
+            ('V2_ONLY', x) for x in filenames[3:]]
+        assert records[0]['dataset_id'] == self.pt.drs.to_dataset_id()
+
+    def test_diff_all_skips_empty_todo(self):
+        assert self._diff_all() == []
+
+        new_file = filenames[0].replace('19900101-19901231', '19890101-19891231')
+        gen_drs.write_listing_seq(self.incoming, [new_file])
+        records = self._diff_all()
+        assert ('V2_ONLY', new_file) in [(r['diff'], r['filename']) for r in records]
+
+    def test_diff_version_by_real_path_and_size(self):
+        v1, v2 = self.versions
+        diffs = list(self.pt.diff_version(v2, v1))
+        assert len(diffs) == len(filenames)
+        assert [d[0] for d in diffs].count(self.pt.DIFF_NONE) == 3
@@ -180,6 +180,21 @@ class TestSpecsMapfile(TestListing):
         assert 'specs.output.IPSL.IPSL-CM5A-LR.decadal.S19630101.mon.ocean.day.clt.r3i1p1' in fh.getvalue()
             
 
+def test_6():
+    # Partial or temporary files are not mistaken for DRS files
+    from drslib.translate import TranslationError
+
+    filename = 'pr_day_MPI-ESM-LR_decadal_S19610101_r1i1p1_19610101-19701231.nc'
+    assert specs_fs.filename_to_drs(filename).variable == 'pr'
+    for suffix in ['.part', '.tmp']:
+        try:
+            specs_fs.filename_to_drs(filename + suffix)
+        except TranslationError:
+            pass
+        else:
+            assert False, 'Accepted %s' % (filename + suffix)
+
+
 #-----------------------------------------------------------------------------
 # drs_tool tests
 from drslib.drs_command import main as drstool_main
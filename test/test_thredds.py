@@ -0,0 +1,296 @@
+# BSD Licence
+# Copyright (c) 2011, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test checking THREDDS catalogs.
+
+"""
+
+import os
+import os.path as op
+import shutil
+import tempfile
+import threading
+import hashlib
+from StringIO import StringIO
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from unittest import TestCase
+
+from drslib import thredds
+from drslib.drs_tree import DRSTree
+from drslib.cordex import CordexFileSystem
+from drslib.mapfile import calc_md5
+
+from drs_tree_shared import TestEg
+import test_cordex_versions
+import gen_drs
+
+test_dir = op.join(op.dirname(__file__), 'thredds')
+
+checks = [thredds.DRSIdCheck, thredds.DRSPropCheck, thredds.ValidDateCheck]
+catalogs = ['good_1.xml', 'bad_drs_id.xml', 'bad_property.xml', 'bad_version.xml']
+
+
+class CatalogHandler(BaseHTTPRequestHandler):
+    # Serve test catalogs with ETags, counting full responses
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = op.join(test_dir, op.basename(self.path))
+        if not op.exists(path):
+            self.send_error(404)
+            return
+        data = open(path).read()
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.server.sent.append(self.path)
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class CatalogServer(ThreadingMixIn, HTTPServer):
+    # Persistent connections need a thread each
+    daemon_threads = True
+
+
+class TestThredds(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='drslib-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _check(self, urls, **kwargs):
+        summaries = list(thredds.check_catalogs(urls, checks, **kwargs))
+        return dict((op.basename(s['catalog']), s) for s in summaries)
+
+    def _status(self, summary, check):
+        for result in summary['checks']:
+            if result['check'] == check.__name__:
+                return result['status']
+
+    def test_1(self):
+        paths = [op.join(test_dir, x) for x in catalogs]
+        summaries = self._check(paths, jobs=3)
+
+        assert summaries['good_1.xml']['status'] == thredds.CHECK_OK
+        assert self._status(summaries['bad_drs_id.xml'], thredds.DRSIdCheck) == thredds.CHECK_FAILED
+        assert self._status(summaries['bad_property.xml'], thredds.DRSPropCheck) == thredds.CHECK_FAILED
+        assert self._status(summaries['bad_property.xml'], thredds.ValidDateCheck) == thredds.CHECK_ABORTED
+        assert self._status(summaries['bad_version.xml'], thredds.ValidDateCheck) == thredds.CHECK_FAILED
+
+    def test_2(self):
+        # Summaries are in catalog order and unreadable catalogs are reported
+        paths = [op.join(test_dir, x) for x in catalogs] + [op.join(self.tmpdir, 'missing.xml')]
+        summaries = list(thredds.check_catalogs(paths, checks, jobs=2))
+
+        assert [s['catalog'] for s in summaries] == paths
+        assert summaries[-1]['status'] == thredds.CHECK_FAILED
+        assert summaries[-1]['error']
+
+    def test_3(self):
+        master = op.join(self.tmpdir, 'catalog.xml')
+        fh = open(master, 'w')
+        fh.write('<catalog xmlns="%s" xmlns:xlink="%s">\n' % (thredds.THREDDS_NS, thredds.XLINK_NS))
+        for catalog in catalogs:
+            fh.write('<catalogRef xlink:href="cmip5/%s"/>\n' % catalog)
+        fh.write('</catalog>\n')
+        fh.close()
+
+        urls = list(thredds.read_master_catalog(master))
+        assert urls == [op.join(self.tmpdir, 'cmip5', x) for x in catalogs]
+
+    def test_4(self):
+        # Catalogs retrieved over HTTP are cached and revalidated
+        server = CatalogServer(('127.0.0.1', 0), CatalogHandler)
+        server.sent = []
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            base_url = 'http://127.0.0.1:%d/' % server.server_port
+            urls = [base_url + x for x in catalogs]
+            cache_dir = op.join(self.tmpdir, 'cache')
+
+            summaries = self._check(urls, jobs=2, fetcher=thredds.CatalogFetcher(cache_dir))
+            assert summaries['good_1.xml']['status'] == thredds.CHECK_OK
+            assert len(server.sent) == len(catalogs)
+
+            summaries = self._check(urls, jobs=2, fetcher=thredds.CatalogFetcher(cache_dir))
+            assert summaries['good_1.xml']['status'] == thredds.CHECK_OK
+            assert len(server.sent) == len(catalogs)
+
+            summaries = self._check([base_url + 'missing.xml'])
+            assert 'HTTP error 404' in summaries['missing.xml']['error']
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_5(self):
+        record = thredds.CatalogRecord.parse(op.join(test_dir, 'good_1.xml'))
+
+        assert record.dataset_count == 1
+        assert record.get_property('drs_id') == 'cmip5.output1.MOHC.HadGEM2-ES.piControl.day.land.day.r1i1p1'
+        assert record.services['HTTPServer'] == '/thredds/fileServer/'
+        assert len(record.files) == 9
+        assert len(record.aggregations) == 3
+
+        cfile = record.files[0]
+        assert cfile.name == 'mrsos_day_HadGEM2-ES_piControl_r1i1p1_19791201-19891130.nc'
+        assert cfile.service == 'HTTPServer'
+        assert cfile.size == 400999900
+        assert cfile.checksum_type == 'MD5'
+        assert cfile.tracking_id == 'eb9da3d1-3bc9-48a0-bc19-6e5b3ad0ff74'
+
+    def test_6(self):
+        file_checks = [thredds.UrlPathCheck, thredds.ChecksumCheck, thredds.TrackingIdCheck]
+        (summary, ) = thredds.check_catalogs([op.join(test_dir, 'good_1.xml')], checks + file_checks)
+
+        assert self._status(summary, thredds.UrlPathCheck) == thredds.CHECK_OK
+        assert self._status(summary, thredds.TrackingIdCheck) == thredds.CHECK_OK
+        # Checksums are prefixed with "MD5:"
+        assert self._status(summary, thredds.ChecksumCheck) == thredds.CHECK_FAILED
+
+
+class TestReconcile(TestEg):
+    __test__ = True
+
+    version = 20100101
+
+    def setUp(self):
+        super(TestReconcile, self).setUp()
+
+        drs_root = op.join(self.tmpdir, 'cordex')
+        os.mkdir(drs_root)
+        self.drs_fs = CordexFileSystem(drs_root)
+        self.incoming = op.join(self.tmpdir, 'incoming')
+        gen_drs.write_listing_seq(self.incoming, test_cordex_versions.filenames)
+
+        self.dt = DRSTree(self.drs_fs)
+        self.dt.discover(self.incoming, activity='cordex',
+                         product='output', variable='vas')
+        (self.pt, ) = self.dt.pub_trees.values()
+        self.pt.do_version(self.version)
+        self.dataset_id = self.pt.drs.to_dataset_id()
+
+    def _catalog(self, dataset_id=None, version=None, files=None):
+        # Write a catalog of the PublisherTree as esgpublish would
+        if dataset_id is None:
+            dataset_id = self.dataset_id
+        if version is None:
+            version = self.version
+        if files is None:
+            files = [(op.basename(path), op.relpath(path, self.drs_fs.drs_root), 
+                      os.stat(path).st_size, calc_md5(path)[1]) 
+                     for path in sorted(self.pt.list_files(self.version))]
+
+        path = op.join(self.tmpdir, '%s.v%d.xml' % (dataset_id, version))
+        fh = open(path, 'w')
+        fh.write('<catalog xmlns="%s">\n' % thredds.THREDDS_NS)
+        fh.write('<dataset ID="%s.v%d">\n' % (dataset_id, version))
+        fh.write('<property name="dataset_id" value="%s"/>\n' % dataset_id)
+        fh.write('<property name="dataset_version" value="%d"/>\n' % version)
+        for filename, relpath, size, checksum in files:
+            fh.write('<dataset name="%s" ID="%s" urlPath="esg_dataroot/%s">\n' % 
+                     (filename, filename, relpath))
+            fh.write('<property name="size" value="%d"/>\n' % size)
+            fh.write('<property name="checksum" value="%s"/>\n' % checksum)
+            fh.write('<property name="checksum_type" value="MD5"/>\n')
+            fh.write('</dataset>\n')
+        fh.write('</dataset>\n</catalog>\n')
+        fh.close()
+
+        return thredds.CatalogRecord.parse(path)
+
+    def _reconcile(self, records):
+        mismatches = thredds.reconcile(records, self.dt, calc_md5)
+        return [(m['kind'], m['filename']) for m in mismatches]
+
+    def test_1(self):
+        assert self._reconcile([self._catalog()]) == []
+
+    def test_2(self):
+        record = self._catalog()
+        f0, f1, f2, f3 = record.files[:4]
+        f0.properties['size'] = '10'
+        f1.properties['checksum'] = 'MD5:' + '0' * 32
+        f2.url_path = 'esg_dataroot/other/' + f2.name
+        del record.files[3]
+        record.files.append(thredds.CatalogFile('extra', 'extra.nc', 'extra.nc'))
+
+        mismatches = self._reconcile([record])
+        assert sorted(mismatches) == sorted([
+                (thredds.MISMATCH_SIZE, f0.name),
+                (thredds.MISMATCH_CHECKSUM, f1.name),
+                (thredds.MISMATCH_PATH, f2.name),
+                (thredds.MISMATCH_FILE_NOT_IN_CATALOG, f3.name),
+                (thredds.MISMATCH_FILE_NOT_ON_DISK, 'extra.nc'),
+                ])
+
+    def test_3(self):
+        other_version = self._catalog(version=self.version + 1, files=[])
+        assert self._reconcile([other_version]) == [
+            (thredds.MISMATCH_NOT_IN_CATALOG, None),
+            (thredds.MISMATCH_NOT_ON_DISK, None),
+            ]
+
+    def test_4(self):
+        wrong_product = self.dataset_id.replace('.output.', '.output2.')
+        assert wrong_product != self.dataset_id
+
+        mismatches = thredds.reconcile([self._catalog(wrong_product)], self.dt)
+        assert [m['kind'] for m in mismatches] == [thredds.MISMATCH_PRODUCT]
+        assert mismatches[0]['disk'] == self.dataset_id
+
+    def test_5(self):
+        # A version without a version directory is not on disk
+        shutil.rmtree(op.join(self.pt.pub_dir, 'v%d' % self.version))
+        self.dt = DRSTree(self.drs_fs)
+        self.dt.discover(self.incoming, activity='cordex',
+                         product='output', variable='vas')
+        (pt, ) = self.dt.pub_trees.values()
+        assert pt.versions[self.version] is None
+
+        assert self._reconcile([self._catalog(files=[])]) == [
+            (thredds.MISMATCH_NOT_ON_DISK, None)]
+
+    def test_6(self):
+        # Recorded sizes and checksums are used instead of reading files
+        record = self._catalog()
+        self.pt.version_to_mapfile(self.version, StringIO(), checksum_func=calc_md5,
+                                   checksum_type='MD5')
+        files = set(self.pt.list_files(self.version))
+
+        probes = []
+        def checksum_func(path):
+            probes.append(path)
+            return calc_md5(path)
+        stat = os.stat
+        def counting_stat(path):
+            if path in files:
+                probes.append(path)
+            return stat(path)
+        os.stat = counting_stat
+        try:
+            assert thredds.reconcile([record], self.dt, checksum_func) == []
+        finally:
+            os.stat = stat
+        assert probes == []